@@ -1,9 +1,11 @@
 ## --------- Import all packages required ---------
 
 
-import matplotlib.pyplot as plt
 # %matplotlib inline
 from skimage import data, util
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy.plotting import plt
 
 
 
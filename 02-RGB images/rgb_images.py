@@ -2,9 +2,11 @@
 
 
 import numpy as np
-import matplotlib.pyplot as plt
 # %matplotlib inline
 from skimage import color, data
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy.plotting import plt
 
 
 
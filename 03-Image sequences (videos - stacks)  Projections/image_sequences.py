@@ -2,11 +2,12 @@
 
 
 import numpy as np
-import matplotlib.pyplot as plt
 # %matplotlib inline
-from skimage import data, util
-import plotly
-import plotly.express as px
+from skimage import util
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy import datasets, projections
+from microscopy.plotting import plt, plotly, plotly_express as px
 
 
 
@@ -15,7 +16,8 @@ import plotly.express as px
 # Let's load an image sequence to work with
 # We will use a 3-D volumetric Z-stack with 2 channels showing nucleus and cytoplasm
 
-img_stack = util.img_as_float(data.cells3d())
+# The stack stays in its native uint16 format and is read from a memory-mapped cache, instead of being copied to floats all at once
+img_stack = datasets.stack('cells3d')
 
 
 # Plotly is a package that helps us animate graphical displays in Python
@@ -33,26 +35,33 @@ plt.figure(figsize = (16, 16))
 
 plt.subplot(221)
 plt.gca().set_title('Slice 15 : Cytoplasm')
-plt.imshow(img_stack[14, 0], cmap = 'inferno', vmin = 0, vmax = 1)
+plt.imshow(util.img_as_float(img_stack[14, 0]), cmap = 'inferno', vmin = 0, vmax = 1)
 
 plt.subplot(222)
 plt.gca().set_title('Slice 15 : Nucleus')
-plt.imshow(img_stack[14, 1], cmap = 'inferno', vmin = 0, vmax = 1)
+plt.imshow(util.img_as_float(img_stack[14, 1]), cmap = 'inferno', vmin = 0, vmax = 1)
 
 plt.subplot(223)
 plt.gca().set_title('Slice 30 : Cytoplasm')
-plt.imshow(img_stack[29, 0], cmap = 'inferno', vmin = 0, vmax = 1)
+plt.imshow(util.img_as_float(img_stack[29, 0]), cmap = 'inferno', vmin = 0, vmax = 1)
 
 plt.subplot(224)
 plt.gca().set_title('Slice 30 : Nucleus')
-plt.imshow(img_stack[29, 1], cmap = 'inferno', vmin = 0, vmax = 1)
+plt.imshow(util.img_as_float(img_stack[29, 1]), cmap = 'inferno', vmin = 0, vmax = 1)
 
 
 # First, let's take a MAXIMUM INTENSITY PROJECTION of all images in the stack
 # Numpy provides us a maximum function for any array, given an axis
 # In this case, our array is the 3D stack, and we're projecting along the Z-axis for slices!
-img_stack_maxp_cyto= np.max(img_stack[:,0], axis=0)
-img_stack_maxp_nuc= np.max(img_stack[:,1], axis=0)
+# For eg, np.max(img_stack[:,0], axis=0) would give the maximum projection of the cytoplasm channel
+
+# Every projection needs a full pass through the stack, so rather than one np.max / np.min / np.average call
+# per projection and per channel, we compute all of them for both channels in a single pass along Z
+img_stack_proj = projections.project(img_stack, stats = ('max', 'min', 'mean'))
+
+# The maximum and minimum stay in the native uint16 format - img_as_float rescales them to 0 to 1 for display
+img_stack_maxp_cyto= util.img_as_float(img_stack_proj['max'][0])
+img_stack_maxp_nuc= util.img_as_float(img_stack_proj['max'][1])
 
 plt.figure(figsize = (16, 8))
 plt.gcf().suptitle('Maximum intensity projections', size = 24)
@@ -65,8 +74,8 @@ plt.imshow(img_stack_maxp_nuc, cmap = 'inferno', vmin = 0, vmax = 1)
 
 
 # Similarly, let's take a MINIMUM INTENSITY PROJECTION of all images in the stack
-img_stack_minp_cyto= np.min(img_stack[:,0], axis=0)
-img_stack_minp_nuc= np.min(img_stack[:,1], axis=0)
+img_stack_minp_cyto= util.img_as_float(img_stack_proj['min'][0])
+img_stack_minp_nuc= util.img_as_float(img_stack_proj['min'][1])
 
 plt.figure(figsize = (16, 8))
 plt.gcf().suptitle('Minimum intensity projections', size = 24)
@@ -79,8 +88,9 @@ plt.imshow(img_stack_minp_nuc, cmap = 'inferno', vmin = 0, vmax = 1)
 
 
 # Let's take a MEAN INTENSITY PROJECTION of all images in the stack
-img_stack_meanp_cyto= np.average(img_stack[:,0], axis=0)
-img_stack_meanp_nuc= np.average(img_stack[:,1], axis=0)
+# The mean is already in floating point, so we divide by the largest uint16 value to put it on the same 0 to 1 scale
+img_stack_meanp_cyto= img_stack_proj['mean'][0] / np.iinfo(img_stack.dtype).max
+img_stack_meanp_nuc= img_stack_proj['mean'][1] / np.iinfo(img_stack.dtype).max
 
 plt.figure(figsize = (16, 8))
 plt.gcf().suptitle('Mean intensity projections', size = 24)
@@ -2,16 +2,20 @@
 
 
 import numpy as np
-import matplotlib.pyplot as plt
 # %matplotlib inline
-from skimage import data, util
+from skimage import data
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy import datasets
+from microscopy.plotting import plt
 
 
 ## --------- Point operations using image matrices ---------
 
 # Let's work with the middle image of the cell membrane and nuclei stack
-img_cyt30_cells3d= util.img_as_float(data.cells3d()[29, 0, :, :])
-img_nuc30_cells3d= util.img_as_float(data.cells3d()[29, 1, :, :])
+# The stack is decoded once and cached on disk, so loading a single plane is cheap
+img_cyt30_cells3d= datasets.plane(29, 0)
+img_nuc30_cells3d= datasets.plane(29, 1)
 
 plt.figure(figsize=(16,8))
 
@@ -1,18 +1,20 @@
 ## --------- Import all packages required ---------
 
 
-import matplotlib.pyplot as plt
 # %matplotlib inline
-from skimage import data, transform, util
-import matplotlib.patches as pat
+from skimage import transform
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy import datasets
+from microscopy.plotting import plt, patches as pat
 
 
 ## --------- Image matrix transformations : Translation, scaling, rotation, skew, non-affine ---------
 
-# First, we'll use a method to draw rectangles on our image (import matplotlib.patches as pat)
+# First, we'll use a method to draw rectangles on our image (matplotlib.patches, imported above as pat)
 # Let's work with the composite middle image of the cell membrane and nuclei - img_composite30_cells3d
-img_nuc30_cells3d = util.img_as_float(data.cells3d()[29, 0, :, :])
-img_cyt30_cells3d = util.img_as_float(data.cells3d()[29, 1, :, :])
+img_nuc30_cells3d = datasets.plane(29, 0)
+img_cyt30_cells3d = datasets.plane(29, 1)
 img_composite30_cells3d = 0.5*(img_nuc30_cells3d + img_cyt30_cells3d)
 
 # First, let's demo translation of a part of this image, by taking a piece and moving it around
@@ -2,9 +2,12 @@
 
 
 import numpy as np
-import matplotlib.pyplot as plt
 # %matplotlib inline
 from skimage import color, data, filters, morphology, util
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy import background, convolution, datasets, gradients, rank, scale_space, tiling, vesselness
+from microscopy.plotting import plt
 
 
 
@@ -16,7 +19,7 @@ from skimage import color, data, filters, morphology, util
 img_mitosis = util.img_as_ubyte(data.human_mitosis())
 
 # Second, we will use the image of zoomed-in nuclei from the middle of the image stack
-img_nuc30_cells3d = util.img_as_float(data.cells3d()[29, 1, :, :])
+img_nuc30_cells3d = datasets.plane(29, 1)
 
 # Third, we will pick an astronomical image - the Hubble Deep Field
 img_hubble = util.img_as_float(data.hubble_deep_field())
@@ -114,7 +117,11 @@ plt.gca().set_title('7 x 7 disk - Median filtered image')
 
 
 # Let's try this with another image
-img_nuc30_cells3d_meanfilt = filters.rank.mean(img_nuc30_cells3d, kernel_sq3)
+# img_nuc30_cells3d is a float image (values between 0 and 1), but filters.rank only works on 8- or 16-bit integer images:
+# it would quietly convert it to uint8 first, keeping only 256 grey levels, and return an image between 0 and 255
+# The rank module of our helpers works on float (and uint16) images as they are - the mean of a float image stays a float image between 0 and 1 -
+# and for square kernels it takes the same time whatever their size
+img_nuc30_cells3d_meanfilt = rank.mean(img_nuc30_cells3d, kernel_sq3)
 
 plt.figure(figsize = (12,12))
 
@@ -123,22 +130,22 @@ plt.imshow(img_nuc30_cells3d, 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('Original image')
 
 plt.subplot(222)
-plt.imshow(img_nuc30_cells3d_meanfilt, 'gray', vmin = 0, vmax = 255)
+plt.imshow(img_nuc30_cells3d_meanfilt, 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('3 x 3 Mean filtered image')
 
 # Can you now write a filter using a 7 x 7 square shaped kernel?
 plt.subplot(223)
-plt.imshow(filters.rank.mean(img_nuc30_cells3d, morphology.square(7)), 'gray', vmin = 0, vmax = 255)
+plt.imshow(rank.mean(img_nuc30_cells3d, morphology.square(7)), 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('7 x 7 square - Mean filtered image')
 
 # What about a filter using a 7 x 7 disk shaped kernel?
 plt.subplot(224)
-plt.imshow(filters.rank.mean(img_nuc30_cells3d, morphology.disk(7)), 'gray', vmin = 0, vmax = 255)
+plt.imshow(rank.mean(img_nuc30_cells3d, morphology.disk(7)), 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('7 x 7 disk - Mean filtered image')
 
 
 # Let's try this with another image
-img_nuc30_cells3d_noise5_meanfilt = filters.rank.mean(img_nuc30_cells3d_noise5, kernel_sq3)
+img_nuc30_cells3d_noise5_meanfilt = rank.mean(img_nuc30_cells3d_noise5, kernel_sq3)
 
 plt.figure(figsize = (12,12))
 
@@ -147,17 +154,17 @@ plt.imshow(img_nuc30_cells3d_noise5, 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('Noisy image')
 
 plt.subplot(222)
-plt.imshow(img_nuc30_cells3d_noise5_meanfilt, 'gray', vmin = 0, vmax = 255)
+plt.imshow(img_nuc30_cells3d_noise5_meanfilt, 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('3 x 3 Mean filtered image')
 
 # Can you now write a filter using a 7 x 7 square shaped kernel?
 plt.subplot(223)
-plt.imshow(filters.rank.mean(img_nuc30_cells3d_noise5, morphology.square(7)), 'gray', vmin = 0, vmax = 255)
+plt.imshow(rank.mean(img_nuc30_cells3d_noise5, morphology.square(7)), 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('7 x 7 square - Mean filtered image')
 
 # What about a filter using a 7 x 7 disk shaped kernel?
 plt.subplot(224)
-plt.imshow(filters.rank.mean(img_nuc30_cells3d_noise5, morphology.disk(7)), 'gray', vmin = 0, vmax = 255)
+plt.imshow(rank.mean(img_nuc30_cells3d_noise5, morphology.disk(7)), 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('7 x 7 disk - Mean filtered image')
 
 
@@ -185,8 +192,8 @@ plt.gca().set_title('Maximum-filt - Minimum-filt')
 
 
 # Let's try with our other noisy image...
-img_nuc30_cells3d_noise5_min = filters.rank.minimum(img_nuc30_cells3d_noise5, morphology.square(2))
-img_nuc30_cells3d_noise5_max = filters.rank.maximum(img_nuc30_cells3d_noise5, morphology.square(2))
+img_nuc30_cells3d_noise5_min = rank.minimum(img_nuc30_cells3d_noise5, morphology.square(2))
+img_nuc30_cells3d_noise5_max = rank.maximum(img_nuc30_cells3d_noise5, morphology.square(2))
 
 plt.figure(figsize = (12, 12))
 
@@ -195,15 +202,15 @@ plt.imshow(img_nuc30_cells3d_noise5, 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('Original image')
 
 plt.subplot(223)
-plt.imshow(img_nuc30_cells3d_noise5_min, 'gray', vmin = 0, vmax = 255)
+plt.imshow(img_nuc30_cells3d_noise5_min, 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('Minimum filtered image')
 
 plt.subplot(224)
-plt.imshow(img_nuc30_cells3d_noise5_max, 'gray', vmin = 0, vmax = 255)
+plt.imshow(img_nuc30_cells3d_noise5_max, 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('Maximum filtered image')
 
 plt.subplot(222)
-plt.imshow(img_nuc30_cells3d_noise5_max - img_nuc30_cells3d_noise5_min, 'gray', vmin = 0, vmax = 255)
+plt.imshow(img_nuc30_cells3d_noise5_max - img_nuc30_cells3d_noise5_min, 'gray', vmin = 0, vmax = 1)
 plt.gca().set_title('Maximum-filt - Minimum-filt')
 
 
@@ -255,9 +262,10 @@ plt.gca().set_title('7-radius disk median filtered image')
 
 # We already saw one way of edge detection - using a max-min filter subtraction...
 # Let's look at edge detection using gradient filters!
-img_nuc30_sobelmag = filters.sobel(img_nuc30_cells3d)
-img_nuc30_sobelh = filters.sobel_h(img_nuc30_cells3d)
-img_nuc30_sobelv = filters.sobel_v(img_nuc30_cells3d)
+# filters.sobel, filters.sobel_h and filters.sobel_v would each compute the derivatives again - the gradient computes them once and gives us all three
+nuc30_sobel = gradients.for_image(img_nuc30_cells3d)
+img_nuc30_sobelmag = nuc30_sobel.magnitude()
+img_nuc30_sobelh, img_nuc30_sobelv = nuc30_sobel.components
 
 plt.figure(figsize = (24,16))
 
@@ -275,11 +283,11 @@ plt.gca().set_title('Sobel vertical filtered image')
 
 # Similarly, you can try out the Roberts, Prewitt, and Laplace filters here
 plt.subplot(234)
-plt.imshow(filters.roberts(img_nuc30_cells3d), 'gray', vmin = 0, vmax = np.max(img_nuc30_cells3d))
+plt.imshow(gradients.for_image(img_nuc30_cells3d, 'roberts').magnitude(), 'gray', vmin = 0, vmax = np.max(img_nuc30_cells3d))
 plt.gca().set_title('Roberts filtered image')
 
 plt.subplot(235)
-plt.imshow(filters.prewitt(img_nuc30_cells3d), 'gray', vmin = 0, vmax = np.max(img_nuc30_cells3d))
+plt.imshow(gradients.for_image(img_nuc30_cells3d, 'prewitt').magnitude(), 'gray', vmin = 0, vmax = np.max(img_nuc30_cells3d))
 plt.gca().set_title('Prewitt filtered image')
 
 plt.subplot(236)
@@ -289,9 +297,12 @@ plt.gca().set_title('Laplace filtered image')
 
 # The most important class of filters we will now see are called GAUSSIAN FILTERS (these are also linear filters)
 # Let's first try the effects on the mitosis image
-img_mitosis_gauss2 = filters.gaussian(img_mitosis, sigma = 2)
-img_mitosis_gauss1 = filters.gaussian(img_mitosis, sigma = 1)
-img_mitosis_gauss7 = filters.gaussian(img_mitosis, sigma = 7)
+# We could call filters.gaussian(img_mitosis, sigma = 2) for each sigma, but blurring with sigma 1 and then with sqrt(2^2 - 1^2)
+# gives the same result as blurring once with sigma 2 - so a "scale space" builds each blur from the previous one and remembers them all
+mitosis_scales = scale_space.for_image(img_mitosis, max_sigma = 7)
+img_mitosis_gauss2 = mitosis_scales.gaussian(2)
+img_mitosis_gauss1 = mitosis_scales.gaussian(1)
+img_mitosis_gauss7 = mitosis_scales.gaussian(7)
 
 plt.figure(figsize = (16, 16))
 
@@ -313,9 +324,10 @@ plt.gca().set_title('Gaussian (sigma = 7) filtered image')
 
 
 # Let's try the effects on the more zoomed-in nuclei image
-img_nuc30_gauss2 = filters.gaussian(img_nuc30_cells3d, sigma = 2)
-img_nuc30_gauss1 = filters.gaussian(img_nuc30_cells3d, sigma = 1)
-img_nuc30_gauss7 = filters.gaussian(img_nuc30_cells3d, sigma = 7)
+nuc30_scales = scale_space.for_image(img_nuc30_cells3d, max_sigma = 7)
+img_nuc30_gauss2 = nuc30_scales.gaussian(2)
+img_nuc30_gauss1 = nuc30_scales.gaussian(1)
+img_nuc30_gauss7 = nuc30_scales.gaussian(7)
 
 plt.figure(figsize = (24, 24))
 
@@ -337,9 +349,10 @@ plt.gca().set_title('Gaussian (sigma = 7) filtered image')
 
 
 # We can also use Gaussan filtering to establish the spatial scales of an image with different-sized objects, and filter out different sized objects
-img_hubble_gauss2 = filters.gaussian(img_hubble, sigma = 2)
-img_hubble_gauss1 = filters.gaussian(img_hubble, sigma = 1)
-img_hubble_gauss7 = filters.gaussian(img_hubble, sigma = 7)
+hubble_scales = scale_space.for_image(img_hubble, max_sigma = 7)
+img_hubble_gauss2 = hubble_scales.gaussian(2)
+img_hubble_gauss1 = hubble_scales.gaussian(1)
+img_hubble_gauss7 = hubble_scales.gaussian(7)
 
 plt.figure(figsize = (16, 16))
 
@@ -361,7 +374,8 @@ plt.gca().set_title('Gaussian (sigma = 7) filtered image')
 
 
 # It's also very useful to apply a Difference of Gaussians filter to isolate a specific spatial scale
-img_hubble_dog2to7 = filters.difference_of_gaussians(img_hubble, low_sigma = 1, high_sigma = 2)
+# This is what filters.difference_of_gaussians(img_hubble, low_sigma = 1, high_sigma = 2) computes - the scale space reuses the two blurs we already have
+img_hubble_dog2to7 = hubble_scales.dog(low_sigma = 1, high_sigma = 2)
 
 plt.figure(figsize = (24, 16))
 
@@ -393,9 +407,11 @@ plt.gca().set_title('Difference of Gaussians (sigma = 2 to 7) filtered image')
 # The last important filter we will explore here is the Laplacian of Gaussian filter, which is a RIDGE detector!
 # For this, we will use the image of the retina, to try and pull out the vessels in the background
 # This is called a composite filter, since we're applying the second filter to the output of the first
-img_retina_gauss = filters.gaussian(img_retina, sigma = 2)
+# The LoG is filters.laplace(filters.gaussian(img_retina, sigma = 2)) - again, the scale space only blurs the retina once
+retina_scales = scale_space.for_image(img_retina)
+img_retina_gauss = retina_scales.gaussian(2)
 img_retina_laplace = filters.laplace(img_retina)
-img_retina_log = filters.laplace(filters.gaussian(img_retina, sigma = 2))
+img_retina_log = retina_scales.log(2)
 
 plt.figure(figsize = (16, 16))
 
@@ -418,9 +434,12 @@ plt.gca().set_title('Laplace-filtered image')
 
 # There are many other filters you can use to identify ridge-like structures
 # For example, let's try a couple of others - Sato, Frangi, Meijering
-img_retina_sato = filters.sato(img_retina)
-img_retina_frangi = filters.frangi(img_retina, sigmas=range(4, 7, 1))
-img_retina_meijering = filters.meijering(img_retina)
+# All three (filters.sato, filters.frangi and filters.meijering) start from the eigenvalues of the Hessian matrix at every sigma
+# The vesselness module computes those once per sigma and derives all three filters from them
+retina_ridges = vesselness.for_image(img_retina)
+img_retina_sato = retina_ridges.sato()
+img_retina_frangi = retina_ridges.frangi(sigmas = range(4, 7, 1))
+img_retina_meijering = retina_ridges.meijering()
 
 plt.figure(figsize = (24,12))
 
@@ -433,7 +452,7 @@ plt.imshow(img_retina_log, 'inferno')
 plt.gca().set_title('Log-filtered image')
 
 plt.subplot(233)
-plt.imshow(filters.sobel(img_retina), 'inferno')
+plt.imshow(gradients.for_image(img_retina).magnitude(), 'inferno')
 plt.gca().set_title('Sobel edge-filtered image')
 
 plt.subplot(234)
@@ -456,16 +475,39 @@ img_mitosis = util.img_as_ubyte(data.human_mitosis())
 
 img_mitosis_bgtophat = morphology.white_tophat(img_mitosis, morphology.disk(7))
 
-plt.figure(figsize = (16,8))
+# Another way is to estimate the background itself with a very wide blur, and subtract it
+# A Gaussian with sigma = 30 has a kernel 241 pixels long - convolution.gaussian notices and blurs with an FFT instead, which is much faster
+img_mitosis_background = convolution.gaussian(img_mitosis, sigma = 30)
+img_mitosis_bgsub = np.clip(util.img_as_float(img_mitosis) - img_mitosis_background, 0, 1)
 
-plt.subplot(121)
+# Uneven illumination usually varies over 50 - 100 pixels, and a top-hat that big with a real disk would take ages
+# The background module swaps the disk for an octagon made of 4 lines, so the radius doesn't change how long it takes
+img_mitosis_bgoctagon = background.white_tophat(img_mitosis, 50)
+# Or roll a paraboloid (the top of a "rolling ball", as in ImageJ) under the image: it is rolled on a shrunk copy, so it's fast too
+img_mitosis_bgrolled = img_mitosis - background.rolling_paraboloid(img_mitosis, 50)
+
+plt.figure(figsize = (24,16))
+
+plt.subplot(231)
 plt.imshow(img_mitosis, 'nipy_spectral', vmin = 0, vmax = 255)
 plt.gca().set_title('Original image')
 
-plt.subplot(122)
+plt.subplot(232)
 plt.imshow(img_mitosis_bgtophat, 'nipy_spectral', vmin = 0, vmax = 255)
 plt.gca().set_title('Spatially smoothed image')
 
+plt.subplot(233)
+plt.imshow(img_mitosis_bgsub, 'nipy_spectral', vmin = 0, vmax = 1)
+plt.gca().set_title('Gaussian (sigma = 30) background subtracted')
+
+plt.subplot(234)
+plt.imshow(img_mitosis_bgoctagon, 'nipy_spectral', vmin = 0, vmax = 255)
+plt.gca().set_title('Octagon top-hat (radius = 50)')
+
+plt.subplot(235)
+plt.imshow(img_mitosis_bgrolled, 'nipy_spectral', vmin = 0, vmax = 255)
+plt.gca().set_title('Rolling paraboloid (radius = 50) background subtracted')
+
 
 # So far, most of the filters we've seen (especially Gaussian filters) smooth out images...
 # Is there anything at all we can do to sharpen them? Enter unsharp masking....
@@ -500,3 +542,22 @@ _____NOTE_____:
 Unsharp masking is close to dubious manipulation of an image. 
 Hence, while it's great for display purposes, NEVER do this in your actual quantitative analysis pipeline!
 """
+
+
+
+## --------- Filtering images too large for memory ---------
+
+# Slide scanners produce images of 40000 x 40000 pixels and more, which no filter above can process in one go
+# tiling.apply_tiled cuts the image into tiles, adds a margin (a "halo") around each one that is as wide as the filter can reach,
+# filters the tiles one after the other and stitches their centres together - the result is exactly the same as filtering the whole image
+# Let's pretend our mitosis image is huge, and cut it into 128 x 128 tiles
+img_mitosis_tophat_tiled = tiling.apply_tiled(morphology.white_tophat, img_mitosis, morphology.disk(7), tile_shape = 128)
+print('Tiled and whole-image top-hat are identical: ', np.array_equal(img_mitosis_tophat_tiled, img_mitosis_bgtophat))
+
+# Footprints decomposed into a sequence of smaller ones (decomposition = 'sequence', faster for large disks) are tiled the same way
+disk_sequence = morphology.disk(7, decomposition = 'sequence')
+img_mitosis_opened_tiled = tiling.apply_tiled(morphology.opening, img_mitosis, disk_sequence, tile_shape = 128)
+print('Tiled and whole-image openings by a decomposed disk are identical: ', np.array_equal(img_mitosis_opened_tiled, morphology.opening(img_mitosis, disk_sequence)))
+
+# For a real slide, give out = 'some_file.npy' to write the result straight to disk, and n_workers to filter several tiles at once
+# (in a script, call it under if __name__ == '__main__': so that the worker processes can start)
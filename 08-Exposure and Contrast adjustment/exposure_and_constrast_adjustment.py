@@ -2,9 +2,12 @@
 
 
 import numpy as np
-import matplotlib.pyplot as plt
 # %matplotlib inline
-from skimage import  data, exposure, util
+from skimage import exposure
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy import datasets, histograms
+from microscopy.plotting import plt
 
 
 
@@ -12,8 +15,7 @@ from skimage import  data, exposure, util
 
 # Let's work with an image that will highlight the effects of contrast and exposure
 # Load the nuclear channel of the 30th image in the stack cells3d from skimage.data on a 0 to 1 scale
-img_nuc30_cells3d = data.cells3d()
-img_nuc30_cells3d= util.img_as_float(img_nuc30_cells3d[30, 1, :, :])
+img_nuc30_cells3d = datasets.plane(30, 1)
 
 # Let's check first whether the image is considered low contrast?
 print('Is the image low contrast? ', exposure.is_low_contrast(img_nuc30_cells3d))
@@ -81,13 +83,13 @@ plt.gca().set_title('Histogram equalized image')
 plt.imshow(img_nuc30_eqhist, cmap = 'gray', vmin = 0, vmax = 1)
 
 plt.subplot(223)
-plt.hist(img_nuc30_cells3d.flatten(), bins=64, density = True)
-img_cdf, bins = exposure.cumulative_distribution(img_nuc30_cells3d, 64)
+histograms.hist(img_nuc30_cells3d, bins=64, density = True)
+img_cdf, bins = histograms.cumulative_distribution(img_nuc30_cells3d, 64)
 plt.plot(bins, img_cdf, 'r')
 
 plt.subplot(224)
-plt.hist(img_nuc30_eqhist.flatten(), bins=64, density = True)
-img_cdf, bins = exposure.cumulative_distribution(img_nuc30_eqhist, 64)
+histograms.hist(img_nuc30_eqhist, bins=64, density = True)
+img_cdf, bins = histograms.cumulative_distribution(img_nuc30_eqhist, 64)
 plt.plot(bins, img_cdf, 'r')
 
 
@@ -106,13 +108,13 @@ plt.imshow(img_nuc30_rescaled, 'inferno', vmin = 0, vmax = 1)
 plt.gca().set_title('Clipped image')
 
 plt.subplot(223)
-plt.hist(img_nuc30_cells3d.flatten(), bins=64, density = True)
-img_cdf, bins = exposure.cumulative_distribution(img_nuc30_cells3d, 64)
+histograms.hist(img_nuc30_cells3d, bins=64, density = True)
+img_cdf, bins = histograms.cumulative_distribution(img_nuc30_cells3d, 64)
 plt.plot(bins, img_cdf, 'r')
 
 plt.subplot(224)
-plt.hist(img_nuc30_rescaled.flatten(), bins=64, density = True)
-img_cdf, bins = exposure.cumulative_distribution(img_nuc30_rescaled, 64)
+histograms.hist(img_nuc30_rescaled, bins=64, density = True)
+img_cdf, bins = histograms.cumulative_distribution(img_nuc30_rescaled, 64)
 plt.plot(bins, img_cdf, 'r')
 
 """
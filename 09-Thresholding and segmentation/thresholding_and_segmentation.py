@@ -2,9 +2,12 @@
 
 
 import numpy as np
-import matplotlib.pyplot as plt
 # %matplotlib inline
 from skimage import color, data, filters, util
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy import datasets, histograms, local_thresholds, thresholds
+from microscopy.plotting import plt
 
 
 
@@ -14,7 +17,7 @@ from skimage import color, data, filters, util
 img_cell = util.img_as_float(data.cell())
 img_mitosis = util.img_as_float(data.human_mitosis())
 img_retina = util.img_as_float(color.rgb2gray(data.retina()))
-img_nuc30_cells3d = util.img_as_float(data.cells3d()[29, 1, :, :])
+img_nuc30_cells3d = datasets.plane(29, 1)
 
 
 # Consider the first image of a single cell.... Let's identify the two parts, below ~0.3 and above ~0.3
@@ -30,7 +33,7 @@ plt.imshow(img_cell, cmap = 'nipy_spectral', vmin = 0, vmax = 1)
 plt.colorbar()
 
 plt.subplot(142)
-plt.hist(img_cell.flatten(), bins = 64, density = True, log = True)
+histograms.hist(img_cell, bins = 64, density = True, log = True)
 plt.axvline(0.4, color = 'red')
 
 plt.subplot(143)
@@ -54,8 +57,8 @@ plt.imshow(img_retina, cmap = 'nipy_spectral', vmin = 0, vmax = 1)
 plt.colorbar()
 
 plt.subplot(142)
-plt.hist(img_retina.flatten(), bins = 64, log = True, density = True)
-import matplotlib.patches as pat
+histograms.hist(img_retina, bins = 64, log = True, density = True)
+from microscopy.plotting import patches as pat
 plt.gca().add_patch(pat.Rectangle((0.25, 0), 0.2, 10, color = 'red', alpha = 0.5))
 plt.axvline(0.7, color = 'blue')
 
@@ -81,7 +84,7 @@ plt.imshow(img_mitosis, cmap = 'nipy_spectral', vmin = 0, vmax = 1)
 plt.colorbar()
 
 plt.subplot(142)
-plt.hist(img_mitosis.flatten(), bins = 64, density = True, log = True)
+histograms.hist(img_mitosis, bins = 64, density = True, log = True)
 plt.axvline(0.15, color = 'red')
 plt.axvline(0.5, color = 'blue')
 
@@ -140,7 +143,7 @@ plt.imshow(img_mitosis, cmap = 'nipy_spectral', vmin = 0, vmax = 1)
 plt.colorbar()
 
 plt.subplot(142)
-plt.hist(img_mitosis.flatten(), bins = 64, density = True, log = True)
+histograms.hist(img_mitosis, bins = 64, density = True, log = True)
 plt.axvline(0.15, color = 'red')
 plt.axvline(0.5, color = 'blue')
 
@@ -154,15 +157,24 @@ plt.imshow(img_mitosis_divs, cmap = 'nipy_spectral', vmin = 0, vmax = 1)
 
 
 # We can automate the calculation of the threshold using various built-in algorithms
-filters.try_all_threshold(img_mitosis, figsize=(12,24), verbose=False)
+# filters.try_all_threshold(img_mitosis) shows them all, but every algorithm recomputes the image histogram for itself
+# Instead, we build the histogram once and derive every threshold from it - the results are remembered for this image,
+# so asking for the same threshold again later on costs nothing
+mitosis_thresholds = thresholds.for_image(img_mitosis)
+thresholds.try_all_threshold(img_mitosis, figsize=(12,24), verbose=False)
+
+# A blank field has a single grey level, and that level is its threshold - except for the Minimum method, which needs two peaks
+img_blank = np.full((20, 20), 0.3)
+print('Thresholds of a blank field at 0.3: ', thresholds.global_thresholds(img_blank))
+print('Otsu threshold of a blank field matches filters.threshold_otsu: ', thresholds.for_image(img_blank).threshold('otsu') == filters.threshold_otsu(img_blank))
 
 
 # Where do these different algorithms place the threshold value, and how do they mask out the original image?
 
 # Let's try a few examples... We'll start with the simple Mean thresholding, which does well, but merges some nuclei
-print('The threshold value for the Mean thresholding algorithm is ', filters.threshold_mean(img_mitosis))
+print('The threshold value for the Mean thresholding algorithm is ', mitosis_thresholds.threshold('mean'))
 
-img_mitosis_mask_mean = (img_mitosis > filters.threshold_mean(img_mitosis))
+img_mitosis_mask_mean = (img_mitosis > mitosis_thresholds.threshold('mean'))
 
 plt.figure(figsize = (16,16))
 
@@ -171,8 +183,8 @@ plt.imshow(img_mitosis, 'nipy_spectral', vmin = 0, vmax = 1)
 plt.gca().set_title('Original image')
 
 plt.subplot(222)
-plt.hist(img_mitosis.flatten(), bins = 64, density = True, log = False)
-plt.axvline(filters.threshold_mean(img_mitosis), color = 'red')
+histograms.hist(img_mitosis, bins = 64, density = True, log = False)
+plt.axvline(mitosis_thresholds.threshold('mean'), color = 'red')
 
 plt.subplot(223)
 plt.imshow(img_mitosis_mask_mean, 'gray')
@@ -184,9 +196,9 @@ plt.gca().set_title('Original image through mask')
 
 
 # The Triangle thresholding is a good choice for these kinds of microscopy images
-print('The threshold value for the Triangle thresholding algorithm is ', filters.threshold_triangle(img_mitosis))
+print('The threshold value for the Triangle thresholding algorithm is ', mitosis_thresholds.threshold('triangle'))
 
-img_mitosis_mask_triangle = (img_mitosis > filters.threshold_triangle(img_mitosis))
+img_mitosis_mask_triangle = (img_mitosis > mitosis_thresholds.threshold('triangle'))
 
 plt.figure(figsize = (16,16))
 
@@ -195,8 +207,8 @@ plt.imshow(img_mitosis, 'nipy_spectral', vmin = 0, vmax = 1)
 plt.gca().set_title('Original image')
 
 plt.subplot(222)
-plt.hist(img_mitosis.flatten(), bins = 64, density = True, log = False)
-plt.axvline(filters.threshold_triangle(img_mitosis), color = 'red')
+histograms.hist(img_mitosis, bins = 64, density = True, log = False)
+plt.axvline(mitosis_thresholds.threshold('triangle'), color = 'red')
 
 plt.subplot(223)
 plt.imshow(img_mitosis_mask_triangle, 'gray')
@@ -208,9 +220,9 @@ plt.gca().set_title('Original image through mask')
 
 
 # The popular Otsu thresholding gives an even better separation between nuclei
-print('The threshold value for the Otsu thresholding algorithm is ', filters.threshold_otsu(img_mitosis))
+print('The threshold value for the Otsu thresholding algorithm is ', mitosis_thresholds.threshold('otsu'))
 
-img_mitosis_mask_otsu = (img_mitosis > filters.threshold_otsu(img_mitosis))
+img_mitosis_mask_otsu = (img_mitosis > mitosis_thresholds.threshold('otsu'))
 
 plt.figure(figsize = (16,16))
 
@@ -219,8 +231,8 @@ plt.imshow(img_mitosis, 'nipy_spectral', vmin = 0, vmax = 1)
 plt.gca().set_title('Original image')
 
 plt.subplot(222)
-plt.hist(img_mitosis.flatten(), bins = 64, density = True, log = False)
-plt.axvline(filters.threshold_otsu(img_mitosis), color = 'red')
+histograms.hist(img_mitosis, bins = 64, density = True, log = False)
+plt.axvline(mitosis_thresholds.threshold('otsu'), color = 'red')
 
 plt.subplot(223)
 plt.imshow(img_mitosis_mask_otsu, 'gray')
@@ -232,9 +244,9 @@ plt.gca().set_title('Original image through mask')
 
 
 # What about minimum thresholding, which almost removed all the nuclei?
-print('The threshold value for the Minimum thresholding algorithm is ', filters.threshold_minimum(img_mitosis))
+print('The threshold value for the Minimum thresholding algorithm is ', mitosis_thresholds.threshold('minimum'))
 
-img_mitosis_mask_minimum = (img_mitosis > filters.threshold_minimum(img_mitosis))
+img_mitosis_mask_minimum = (img_mitosis > mitosis_thresholds.threshold('minimum'))
 
 plt.figure(figsize = (16,16))
 
@@ -243,8 +255,8 @@ plt.imshow(img_mitosis, 'nipy_spectral', vmin = 0, vmax = 1)
 plt.gca().set_title('Original image')
 
 plt.subplot(222)
-plt.hist(img_mitosis.flatten(), bins = 64, density = True, log = True)
-plt.axvline(filters.threshold_minimum(img_mitosis), color = 'red')
+histograms.hist(img_mitosis, bins = 64, density = True, log = True)
+plt.axvline(mitosis_thresholds.threshold('minimum'), color = 'red')
 
 plt.subplot(223)
 plt.imshow(img_mitosis_mask_minimum, 'gray')
@@ -256,9 +268,9 @@ plt.gca().set_title('Original image through mask')
 
 
 # Finally, let's look at Yen thresholding, which mostly picked out the brightest dividers!
-print('The threshold value for the Yen thresholding algorithm is ', filters.threshold_yen(img_mitosis))
+print('The threshold value for the Yen thresholding algorithm is ', mitosis_thresholds.threshold('yen'))
 
-img_mitosis_mask_yen = (img_mitosis > filters.threshold_yen(img_mitosis))
+img_mitosis_mask_yen = (img_mitosis > mitosis_thresholds.threshold('yen'))
 
 plt.figure(figsize = (16,16))
 
@@ -267,8 +279,8 @@ plt.imshow(img_mitosis, 'nipy_spectral', vmin = 0, vmax = 1)
 plt.gca().set_title('Original image')
 
 plt.subplot(222)
-plt.hist(img_mitosis.flatten(), bins = 64, density = True, log = True)
-plt.axvline(filters.threshold_yen(img_mitosis), color = 'red')
+histograms.hist(img_mitosis, bins = 64, density = True, log = True)
+plt.axvline(mitosis_thresholds.threshold('yen'), color = 'red')
 
 plt.subplot(223)
 plt.imshow(img_mitosis_mask_yen, 'gray')
@@ -283,14 +295,16 @@ plt.gca().set_title('Original image through mask')
 # Let's illustrate this with the example of text segmentation
 img_page = data.page()
 
-filters.try_all_threshold(img_page, figsize=(12,12), verbose=False)
+thresholds.try_all_threshold(img_page, figsize=(12,12), verbose=False)
 
 
 # The uneven background makes it very obvious that a single global threshold is not appropriate
 
 # The most popular local thresholding algorithm is Niblack thresholding
 # Here, you must specify a kernel size (odd number only!) within which to compute the threshold - you can play around with this value
-img_page_niblack = (img_page > filters.threshold_niblack(img_page, 55))
+# The local mean and standard deviation come from integral images of the page that are built only once, so trying other sizes is cheap
+page_local = local_thresholds.for_image(img_page)
+img_page_niblack = (img_page > page_local.niblack(55))
 
 plt.figure(figsize = (16,8))
 
@@ -303,6 +317,17 @@ plt.imshow(img_page_niblack, 'gray')
 plt.gca().set_title('Locally Niblack-thresholded image, kernel footprint 71 pixels')
 
 
+# Let's play around with the kernel size and the k factor - all these masks reuse the same integral images
+page_sweep = page_local.sweep('niblack', windows = (15, 55, 95), ks = (0.1, 0.4))
+
+plt.figure(figsize = (24,12))
+
+for i, ((window, k), mask) in enumerate(page_sweep.items()):
+    plt.subplot(2, 3, i + 1)
+    plt.imshow(mask, 'gray')
+    plt.gca().set_title(f'Niblack, kernel {window} pixels, k = {k}')
+
+
 # Let's now work on a more complicated image of nuclei zoomed-in, which shows the value of filtering before thresholding
 img_nuc30_nuclei = img_nuc30_cells3d * (img_nuc30_cells3d > 0.12)
 
@@ -316,7 +341,7 @@ plt.gca().set_title('Original image')
 plt.imshow(img_nuc30_cells3d, cmap = 'nipy_spectral', vmin = 0, vmax = 1)
 
 plt.subplot(232)
-plt.hist(img_nuc30_cells3d.flatten(), bins = 64, density = True, log = True)
+histograms.hist(img_nuc30_cells3d, bins = 64, density = True, log = True)
 plt.axvline(0.12, color = 'red')
 
 plt.subplot(233)
@@ -328,7 +353,7 @@ plt.gca().set_title('Gaussian-filtered image')
 plt.imshow(img_nuc30_gauss2, cmap = 'nipy_spectral', vmin = 0, vmax = 1)
 
 plt.subplot(235)
-plt.hist(img_nuc30_gauss2.flatten(), bins = 64, density = True, log = True)
+histograms.hist(img_nuc30_gauss2, bins = 64, density = True, log = True)
 plt.axvline(0.12, color = 'red')
 
 plt.subplot(236)
@@ -337,6 +362,6 @@ plt.imshow(img_nuc30_gauss2_nuclei, cmap = 'nipy_spectral', vmin = 0, vmax = 1)
 
 
 # What thresholding algorithm do you think should work best for this image?
-filters.try_all_threshold(filters.gaussian(img_nuc30_cells3d, sigma =1), figsize=(8,16), verbose = False)
+thresholds.try_all_threshold(filters.gaussian(img_nuc30_cells3d, sigma =1), figsize=(8,16), verbose = False)
 # PLay with the values of sigma, and see what is the best compromise to separate all the nuclei
 
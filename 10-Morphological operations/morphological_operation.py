@@ -1,16 +1,20 @@
 ## --------- Import all packages required ---------
 
 
-import matplotlib.pyplot as plt
+import numpy as np
 # %matplotlib inline
 from skimage import color, data, filters, morphology, util
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy import binary, component_trees, datasets
+from microscopy.plotting import plt
 
 
 
 ## --------- Morphological operations ---------
 
 # Let's choose the Otsu-threshold from above and create a mask for our nuclei
-img_nuc30_cells3d = util.img_as_float(data.cells3d()[29, 1, :, :])
+img_nuc30_cells3d = datasets.plane(29, 1)
 img_nuc30_mask = (img_nuc30_cells3d > filters.threshold_otsu(filters.gaussian(img_nuc30_cells3d, sigma = 1)))
 
 plt.figure(figsize=(18,6))
@@ -35,6 +39,12 @@ strel = morphology.square(5) # Can you find an appropriate size and shape of mor
 
 img_nuc30_mask_closed = morphology.closing(img_nuc30_mask, strel)
 
+# A mask only needs one bit per pixel, not the byte that numpy uses for each True / False
+# binary.pack stores 64 pixels in one number, and closes, opens, erodes or dilates them all at once - handy for very large masks
+img_nuc30_mask_packed = binary.pack(img_nuc30_mask)
+print('Bytes per mask: ', img_nuc30_mask.nbytes, ' unpacked, ', img_nuc30_mask_packed.nbytes, ' packed')
+print('Packed and numpy closing are identical: ', np.array_equal(img_nuc30_mask_packed.closing(strel).unpack(), img_nuc30_mask_closed))
+
 plt.figure(figsize=(24,6))
 
 plt.subplot(141)
@@ -80,6 +90,21 @@ plt.imshow(img_nuc30_cells3d * img_nuc30_mask_areaclosed, 'nipy_spectral')
 plt.gca().set_title('New masked image')
 
 
+# Trying one threshold after another is slow: area_closing first builds a "component tree" of the whole mask every time
+# component_trees.for_image builds it once (kind = 'min' for closings, 'max' for openings), and then each threshold is almost free
+img_nuc30_mask_tree = component_trees.for_image(img_nuc30_mask, connectivity = 2, kind = 'min')
+area_thrs = [30, 100, 300, 1000]
+img_nuc30_mask_sweep = img_nuc30_mask_tree.sweep(area_thrs)
+print('Sweep and area_closing are identical at 300 px: ', np.array_equal(img_nuc30_mask_sweep[area_thrs.index(300)], img_nuc30_mask_areaclosed))
+
+plt.figure(figsize=(24,6))
+
+for i, (thr, img_closed) in enumerate(zip(area_thrs, img_nuc30_mask_sweep)):
+    plt.subplot(1, len(area_thrs), i + 1)
+    plt.imshow(img_closed, 'gray')
+    plt.gca().set_title('Area closing, threshold = ' + str(thr))
+
+
 # We can also try to remove small holes
 
 area_thr = 300 # Can you find an appropriate threshold size to fill the holes?
@@ -111,6 +136,10 @@ area_thr = 300
 
 img_nuc30_mask_filt = filters.median(morphology.area_closing(img_nuc30_mask, area_threshold = area_thr, connectivity = 1), morphology.square(4))
 
+# The median of a mask is just a vote: a pixel stays True if at least half of its neighbours are True
+# binary.median counts those votes with running sums, and gives the same mask much faster on large images, whatever the footprint size
+print('binary.median and filters.median are identical: ', np.array_equal(binary.median(component_trees.area_closing(img_nuc30_mask, area_threshold = area_thr, connectivity = 1), morphology.square(4)), img_nuc30_mask_filt))
+
 plt.figure(figsize=(24,6))
 
 plt.subplot(141)
@@ -197,7 +226,7 @@ plt.imshow(img_retina_mask, 'gray')
 plt.gca().set_title('Thresholded mask')
 
 plt.subplot(143)
-plt.imshow(morphology.dilation(img_retina_skeleton, morphology.square(3)), 'gray')
+plt.imshow(binary.pack(img_retina_skeleton).dilation(morphology.square(3)).unpack(), 'gray') # Same as morphology.dilation, on the packed mask
 plt.gca().set_title('Skeletonized mask to show vessel shapes')
 
 plt.subplot(144)
@@ -2,35 +2,32 @@
 
 
 import numpy as np
-import matplotlib.pyplot as plt
 # %matplotlib inline
-from skimage import  data, filters, measure, morphology, util
+from skimage import measure
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The shared helpers live in the "microscopy" folder, one level above this chapter
+from microscopy import datasets, labels, measurements, nuclei, profiling, tiled_labels, volumes
+from microscopy.plotting import plt
 
 
 
 ## --------- Feature extraction and quantifying object propertiess ---------
 
 
-img_nuc30_cells3d = util.img_as_float(data.cells3d()[29, 1, :, :])
+img_nuc30_cells3d = datasets.plane(29, 1)
 
-img_nuc30_mask = (img_nuc30_cells3d > filters.threshold_otsu(filters.gaussian(img_nuc30_cells3d, sigma = 1)))
-
-# We can fix this by either closing again, or by using a filter! For eg, a median filter, applied twice!
-# We can fix this by area opening!
+# We start from the segmentation pipeline we built step by step in chapter 10: Otsu threshold of the blurred image,
+# area closing and a median filter to fill the holes, then area opening and another median filter to remove the small bright spots
 area_thr = 300
 
-img_nuc30_mask_filt = filters.median(morphology.area_closing(img_nuc30_mask, area_threshold = area_thr, connectivity = 1), morphology.square(4))
-
-
-# On the left edge, we still have some small bright spots that we can get rid of
-
-img_nuc30_mask_final = filters.median(morphology.area_opening(img_nuc30_mask_filt, area_threshold = area_thr, connectivity = 1), morphology.square(3))
-
-
-# We've now reached the last part of our pipeline - quantifying the properties of the different nuclei
-
-# The very first thing we want to do is to label our different nuclei as individual connected components
-img_nuc30_labeled = measure.label(img_nuc30_mask_final)
+# The last step of that pipeline is to label our different nuclei as individual connected components
+# The nuclei module runs the whole chain for us - and from the command line it runs it on a whole folder of images at once:
+# python -m microscopy.nuclei your_folder_of_images -o nuclei.csv --labels-dir labels
+# Which step of the pipeline takes the most time? The profiling module times each of them while it runs, and measures the memory they allocate
+# (add --profile trace.json to the command above to get the same table for a whole folder, and a trace to open in ui.perfetto.dev)
+with profiling.recording():
+    img_nuc30_labeled = nuclei.segment(img_nuc30_cells3d, area_threshold = area_thr)
+print(profiling.summary())
 
 plt.figure(figsize=(16,8))
 
@@ -60,6 +57,14 @@ plt.gca().set_title('Nucleus 14 = label 14')
 
 print("Number of nuclei = ", np.max(img_nuc30_labeled))
 
+# measure.label needs the whole mask in memory, and gives a label image of 4 bytes per pixel - fine here, but a whole slide would not fit
+# tiled_labels.label labels the mask one tile at a time and joins the nuclei cut by the tile borders, so only a tile is ever in memory
+# (give it out = 'labels.npy' to write the labels straight to a file). It stores them in the smallest dtype that fits (uint8 for < 256 nuclei),
+# and gives the area and bounding box of every nucleus along the way
+img_nuc30_labeled_tiled, nuc30_areas, nuc30_bboxes = tiled_labels.label(img_nuc30_labeled > 0, tile_shape = 64)
+print('Same labels, tile by tile: ', np.array_equal(img_nuc30_labeled_tiled, img_nuc30_labeled), ', stored as ', img_nuc30_labeled_tiled.dtype)
+print('Area and bounding box of nucleus 1: ', nuc30_areas[1 - 1], nuc30_bboxes[1 - 1])
+
 
 # We will now compute all the properties of each nucleus
 propvalues = measure.regionprops(label_image = img_nuc30_labeled, intensity_image = img_nuc30_cells3d)
@@ -77,15 +82,56 @@ for prop in propvalues[k - 1]:
 plt.figure(figsize=(6,6))
 plt.imshow(k * (img_nuc30_labeled == k), 'nipy_spectral', vmin = 0, vmax = np.max(img_nuc30_labeled) + 1)
 
+# img_nuc30_labeled == k builds a mask as big as the whole image just to look at one nucleus
+# labels.SparseLabels keeps each nucleus as its bounding box and its mask cropped to it, so one nucleus only costs its own pixels
+# - handy when there are thousands of nuclei in a large image
+nuc30_sparse = labels.SparseLabels.from_dense(img_nuc30_labeled)
+print('Sparse labels: ', nuc30_sparse.nbytes, ' bytes, dense label image: ', img_nuc30_labeled.nbytes, ' bytes')
+print('Mean intensity of nucleus ', k, ': ', nuc30_sparse.intensity(k, img_nuc30_cells3d).mean(), ', regionprops: ', propvalues[k - 1].intensity_mean)
+print('Sparse labels back to a label image are identical: ', np.array_equal(nuc30_sparse.to_dense(), img_nuc30_labeled)) # And back to a label image in one go
+
+plt.figure(figsize=(12,6))
+
+plt.subplot(121)
+plt.imshow(nuc30_sparse.mask(k), 'gray')
+plt.gca().set_title('Nucleus ' + str(k) + ', cropped to its bounding box')
+
+plt.subplot(122)
+plt.imshow(img_nuc30_cells3d[nuc30_sparse.bbox(k)] * nuc30_sparse.mask(k), 'nipy_spectral')
+plt.gca().set_title('Nucleus ' + str(k) + ' in the original image')
+
+
+# When we already know which properties we need, we can measure them for all the nuclei at once
+# This gives one column (array) per property, with one row per nucleus - much faster than regionprops when there are thousands of objects
+nuc30_table = measurements.regionprops_columns(img_nuc30_labeled, img_nuc30_cells3d, properties = ['label', 'area', 'centroid', 'intensity_mean'])
+
+# Thin objects are the tricky case for the orientation: a horizontal line lies along the
+# column axis, which is +pi/2 or -pi/2 (the same axis), and for symmetric shapes regionprops'
+# own roundoff may pick either sign, so the orientations are compared as axes (modulo pi)
+img_lines = np.zeros((12, 20), dtype = int)
+img_lines[1, 2:15] = 1 # Horizontal line
+img_lines[3:11, 17] = 2 # Vertical line
+img_lines[5:7, 2:14] = 3 # Symmetric T: two full rows
+img_lines[7, 7:9] = 3 # plus two pixels in the middle
+lines_table = measurements.regionprops_columns(img_lines, properties = ['label', 'orientation'])
+lines_orientation = np.array([region.orientation for region in measure.regionprops(img_lines)])
+print('Orientation of thin objects equal to regionprops: ', np.allclose(np.exp(2j * lines_table['orientation']), np.exp(2j * lines_orientation)))
+
 
 # Let's display the mask with nuclei colored by various properties
+# Each nucleus gets filled with its own property value - the labels module does this with a single lookup
+# over the label image (value of nucleus k stored at index k), instead of one full-image pass per nucleus
+img_nuc30_painted = labels.paint_labels_many(img_nuc30_labeled, {
+  'area': nuc30_table['area'],
+  'centroidX': nuc30_table['centroid-1'],
+  'intmean': nuc30_table['intensity_mean'],
+}, labels = nuc30_table['label'])
+
 plt.figure(figsize = (16,16))
 
 # Colored by area
 plt.subplot(221)
-img_nuc30_areas = np.zeros_like(img_nuc30_labeled, dtype='float64') # Initialize a container for the composite image
-for k in range(1, np.max(img_nuc30_labeled)): # Go through each of the objects individually
-  img_nuc30_areas += propvalues[k-1].area*(img_nuc30_labeled == k) # Multiply its mask by its property value, and add it up into a composite image
+img_nuc30_areas = img_nuc30_painted['area'] # Composite image of all the nuclei, each colored by its own area
 plt.imshow(img_nuc30_areas, 'nipy_spectral', vmin = 0, vmax = 1.1*np.max(img_nuc30_areas)) # Display that composite image with appropriate scale
 plt.gca().set_title('Colored by area')
 plt.colorbar()
@@ -94,9 +140,7 @@ plt.colorbar()
 
 # Colored by X-coordinate of centroid
 plt.subplot(222)
-img_nuc30_centroidX = np.zeros_like(img_nuc30_labeled, dtype='float64')
-for k in range(1, np.max(img_nuc30_labeled)):
-  img_nuc30_centroidX += propvalues[k-1].centroid[1]*(img_nuc30_labeled == k)
+img_nuc30_centroidX = img_nuc30_painted['centroidX']
 plt.imshow(img_nuc30_centroidX, 'nipy_spectral', vmin = 0, vmax = 1.1*np.max(img_nuc30_centroidX))
 plt.gca().set_title('Colored by centroid X-coordinate')
 plt.colorbar()
@@ -105,9 +149,7 @@ plt.colorbar()
 
 # Colored by mean intensity
 plt.subplot(223)
-img_nuc30_intmean = np.zeros_like(img_nuc30_labeled, dtype='float64')
-for k in range(1, np.max(img_nuc30_labeled)):
-  img_nuc30_intmean += propvalues[k-1].mean_intensity*(img_nuc30_labeled == k)
+img_nuc30_intmean = img_nuc30_painted['intmean']
 plt.imshow(img_nuc30_intmean, 'nipy_spectral', vmin = 0, vmax = 1.1*np.max(img_nuc30_intmean))
 plt.gca().set_title('Colored by mean fluorescence intensity')
 plt.colorbar()
@@ -120,3 +162,29 @@ plt.imshow(img_nuc30_cells3d, 'inferno')
 plt.gca().set_title('Original image')
 plt.colorbar()
 
+
+
+## --------- Segmenting nuclei in 3D ---------
+
+# So far we have segmented a single plane, but cells3d is a stack of 60 planes - and every nucleus spans many of them
+# The volumes module runs the same pipeline on the whole nucleus channel in 3D: blur, Otsu threshold, area closing, median, area opening, median,
+# and finally labelling, where voxels touching by a face, an edge or a corner (26-connectivity) belong to the same nucleus
+# The planes are 0.29 micrometres apart and the pixels 0.26 micrometres wide, so the filters are stretched along Z accordingly
+# The volume is processed 16 planes at a time, so this also works for stacks far too large for memory
+nuc_spacing = datasets.SPACING['cells3d']
+img_nuc_labeled_3d = volumes.segment_volume(datasets.channel(1), spacing = nuc_spacing, chunk_size = 16)
+print("Number of nuclei in 3D = ", np.max(img_nuc_labeled_3d))
+
+# In 3D, the area becomes a volume (in cubic micrometres), and we can also measure the surface area and the sphericity of each nucleus
+nuc_table_3d = volumes.measure_volume(img_nuc_labeled_3d, datasets.channel(1), spacing = nuc_spacing)
+
+plt.figure(figsize = (16,8))
+
+plt.subplot(121)
+plt.imshow(img_nuc_labeled_3d[29], 'nipy_spectral', vmin = 0, vmax = np.max(img_nuc_labeled_3d) + 1)
+plt.gca().set_title('3D labels, plane 30')
+
+plt.subplot(122)
+plt.scatter(nuc_table_3d['volume'], nuc_table_3d['sphericity'])
+plt.gca().set_xlabel('Volume (cubic micrometres)')
+plt.gca().set_ylabel('Sphericity')
@@ -0,0 +1,7 @@
+"""Benchmarks of the hot operation of every chapter, on synthetic images and bundled samples.
+
+Run them from the top of the repository with ``python -m benchmarks``; see
+:mod:`benchmarks.runner` for the options. Nothing is downloaded: the images are
+either generated (:mod:`benchmarks.images`) or among the samples shipped inside
+scikit-image itself. The cases are defined in :mod:`benchmarks.cases`.
+"""
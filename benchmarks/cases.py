@@ -0,0 +1,350 @@
+"""One benchmark per hot operation of each chapter.
+
+Each case is a function registered with :func:`case`, which states the chapter it
+comes from, the kind of input it takes and the parameter grid to sweep. The runner
+prepares the inputs outside the timed region:
+
+``image``
+    grayscale image in the dtype being benchmarked;
+``rgb``
+    the same image as three identical colour channels;
+``stack``
+    16 planes of the image, like a Z stack;
+``mask``
+    boolean mask of the nuclei (Otsu threshold of the image), benchmarked as dtype ``bool``;
+``labels``
+    label image of that mask, with ``image`` as the intensity image.
+
+Rank filters only take integer images, so their cases are restricted to uint8/uint16.
+"""
+
+import itertools
+
+import numpy as np
+from skimage import color, exposure, filters, measure, morphology, transform, util
+
+from microscopy import background, binary, component_trees, convolution, gradients, local_thresholds, measurements, projections, rank, tiled_labels, vesselness
+from microscopy.labels import SparseLabels
+
+from .images import DTYPES
+
+
+INPUTS = ('image', 'rgb', 'stack', 'mask', 'labels')
+
+CASES = {}
+
+_INTEGER = ('uint8', 'uint16')
+
+
+class Case:
+    """A benchmarked operation and the grid of parameters to run it with."""
+
+    def __init__(self, name, chapter, func, inputs, dtypes, params):
+        self.name = name
+        self.chapter = chapter
+        self.func = func
+        self.inputs = inputs
+        self.dtypes = dtypes
+        self.params = params
+
+    def variants(self):
+        """Every combination of the parameter grid, as dicts."""
+        names = list(self.params)
+        for values in itertools.product(*(self.params[name] for name in names)):
+            yield dict(zip(names, values))
+
+    def __repr__(self):
+        return f'Case({self.name!r}, chapter={self.chapter})'
+
+
+def case(chapter, inputs='image', dtypes=DTYPES, **params):
+    """Register the decorated function as a benchmark; ``params`` maps names to the values to sweep."""
+    if inputs not in INPUTS:
+        raise ValueError(f'Unknown input kind {inputs!r}, expected one of {INPUTS}')
+
+    def register(func):
+        CASES[func.__name__] = Case(func.__name__, chapter, func, inputs, tuple(dtypes), params)
+        return func
+    return register
+
+
+# --------- 01 - 05: display, colour, stacks, point operations, geometry ---------
+
+@case(1)
+def img_as_float(image):
+    return util.img_as_float(image)
+
+
+@case(1)
+def invert(image):
+    return util.invert(image)
+
+
+@case(2, inputs='rgb')
+def rgb2gray(rgb):
+    return color.rgb2gray(rgb)
+
+
+@case(3, inputs='stack')
+def z_projections(stack):
+    return projections.project(stack, stats=('max', 'min', 'mean'))
+
+
+@case(4)
+def point_operations(image):
+    # Chapter 04: scale the brightness, then clip back to the valid range
+    return np.clip(util.img_as_float(image) * 1.5, 0, 1)
+
+
+@case(5, angle=(30,))
+def rotate(image, angle):
+    return transform.rotate(image, angle)
+
+
+@case(5, strength=(10,))
+def swirl(image, strength):
+    return transform.swirl(image, strength=strength, radius=image.shape[0] // 2)
+
+
+# --------- 06: filtering ---------
+
+@case(6, dtypes=_INTEGER, radius=(1, 3, 7))
+def rank_mean(image, radius):
+    return filters.rank.mean(image, morphology.disk(radius))
+
+
+@case(6, dtypes=_INTEGER, size=(3, 7, 31))
+def rank_minimum_square(image, size):
+    return filters.rank.minimum(image, np.ones((size, size), dtype=bool))
+
+
+@case(6, size=(3, 7, 31))
+def box_minimum(image, size):
+    return rank.minimum(image, np.ones((size, size), dtype=bool))
+
+
+@case(6, size=(3, 7, 31))
+def box_mean(image, size):
+    return rank.mean(image, np.ones((size, size), dtype=bool))
+
+
+@case(6, radius=(3, 7, 15))
+def disk_mean(image, radius):
+    return rank.mean(image, morphology.disk(radius))
+
+
+@case(6, dtypes=_INTEGER, size=(3, 15))
+def rank_median(image, size):
+    return filters.rank.median(image, np.ones((size, size), dtype=bool))
+
+
+@case(6, size=(3, 15), bins=(None, 256))
+def histogram_median(image, size, bins):
+    return rank.median(image, np.ones((size, size), dtype=bool), bins=bins)
+
+
+@case(6, radius=(1, 3, 7))
+def median(image, radius):
+    return filters.median(image, morphology.disk(radius))
+
+
+@case(6, sigma=(1, 4, 16))
+def gaussian(image, sigma):
+    return filters.gaussian(image, sigma=sigma)
+
+
+@case(6, sigma=(1, 4, 16, 50))
+def fast_gaussian(image, sigma):
+    return convolution.gaussian(image, sigma=sigma)
+
+
+@case(6, sigmas=((2, 7),))
+def difference_of_gaussians(image, sigmas):
+    return filters.difference_of_gaussians(image, *sigmas)
+
+
+@case(6, sigmas=((2, 7),))
+def fast_difference_of_gaussians(image, sigmas):
+    return convolution.difference_of_gaussians(image, *sigmas)
+
+
+@case(6)
+def sobel(image):
+    return filters.sobel(image)
+
+
+@case(6)
+def sobel_all(image):
+    return filters.sobel(image), filters.sobel_h(image), filters.sobel_v(image)
+
+
+@case(6)
+def gradient_all(image):
+    grad = gradients.Gradient(image)
+    return grad.magnitude(), grad.components, grad.orientation()
+
+
+@case(6, sigmas=((4, 5, 6),))
+def frangi(image, sigmas):
+    return filters.frangi(image, sigmas=sigmas)
+
+
+@case(6)
+def ridge_filters(image):
+    return filters.sato(image), filters.frangi(image, sigmas=range(4, 7)), filters.meijering(image)
+
+
+@case(6)
+def shared_ridge_filters(image):
+    ridges = vesselness.RidgeFilters(image)
+    return ridges.sato(), ridges.frangi(sigmas=range(4, 7)), ridges.meijering()
+
+
+@case(6, radius=(3, 7))
+def white_tophat(image, radius):
+    return morphology.white_tophat(image, morphology.disk(radius))
+
+
+@case(6, radius=(7, 25, 50, 100))
+def octagon_tophat(image, radius):
+    return background.white_tophat(image, radius)
+
+
+@case(6, radius=(25, 50, 100))
+def rolling_paraboloid(image, radius):
+    return image - background.rolling_paraboloid(image, radius)
+
+
+@case(6)
+def unsharp_mask(image):
+    return filters.unsharp_mask(image)
+
+
+# --------- 07 - 09: histograms, exposure, thresholds ---------
+
+@case(7, bins=(64,))
+def histogram(image, bins):
+    return np.histogram(image, bins)
+
+
+@case(8)
+def equalize_hist(image):
+    return exposure.equalize_hist(image)
+
+
+@case(8)
+def rescale_percentiles(image):
+    low, high = np.percentile(image, (5, 95))
+    return exposure.rescale_intensity(image, in_range=(low, high), out_range=np.float32)
+
+
+@case(9)
+def threshold_otsu(image):
+    return filters.threshold_otsu(image)
+
+
+@case(9, window=(15, 55))
+def threshold_niblack(image, window):
+    return filters.threshold_niblack(image, window)
+
+
+@case(9, window=(15, 55))
+def local_niblack(image, window):
+    # Fresh tables every time: the cost of one call, not of a memoised one
+    return local_thresholds.LocalThresholds(image).niblack(window)
+
+
+# --------- 10 - 11: morphology and measurements ---------
+
+@case(10, inputs='mask', dtypes=('bool',), area=(300,))
+def area_closing(mask, area):
+    return morphology.area_closing(mask, area_threshold=area, connectivity=1)
+
+
+@case(10, inputs='mask', dtypes=('bool',), area=(300,))
+def area_opening(mask, area):
+    return morphology.area_opening(mask, area_threshold=area, connectivity=1)
+
+
+@case(10, inputs='mask', dtypes=('bool',), areas=((30, 100, 300, 1000),))
+def area_closing_sweep(mask, areas):
+    return [morphology.area_closing(mask, area_threshold=area, connectivity=1) for area in areas]
+
+
+@case(10, inputs='mask', dtypes=('bool',), areas=((30, 100, 300, 1000),))
+def tree_area_closing_sweep(mask, areas):
+    return component_trees.ComponentTree(mask, kind='min').sweep(areas)
+
+
+@case(10, dtypes=('uint8',), areas=((30, 100, 300, 1000),))
+def grey_area_opening_sweep(image, areas):
+    return [morphology.area_opening(image, area_threshold=area, connectivity=1) for area in areas]
+
+
+@case(10, dtypes=('uint8',), areas=((30, 100, 300, 1000),))
+def tree_grey_area_opening_sweep(image, areas):
+    return component_trees.ComponentTree(image).sweep(areas)
+
+
+@case(10, inputs='mask', dtypes=('bool',), size=(3, 4))
+def median_mask(mask, size):
+    return filters.median(mask, np.ones((size, size), dtype=bool))
+
+
+@case(10, inputs='mask', dtypes=('bool',), size=(3, 4, 15))
+def binary_median(mask, size):
+    return binary.median(mask, np.ones((size, size), dtype=bool))
+
+
+@case(10, inputs='mask', dtypes=('bool',), size=(5, 31))
+def closing(mask, size):
+    return morphology.closing(mask, np.ones((size, size), dtype=bool))
+
+
+@case(10, inputs='mask', dtypes=('bool',), size=(5, 31))
+def packed_closing(mask, size):
+    # Packing and unpacking included
+    return binary.pack(mask).closing(np.ones((size, size), dtype=bool)).unpack()
+
+
+@case(10, inputs='mask', dtypes=('bool',))
+def skeletonize(mask):
+    return morphology.skeletonize(mask)
+
+
+@case(11, inputs='mask', dtypes=('bool',))
+def label(mask):
+    return measure.label(mask)
+
+
+@case(11, inputs='mask', dtypes=('bool',), tile=(256, 1024))
+def tiled_label(mask, tile):
+    return tiled_labels.label(mask, tile_shape=tile)
+
+
+@case(11, inputs='labels')
+def regionprops(labels, image):
+    # What chapter 11 reads from every nucleus
+    return [(r.area, r.centroid, r.intensity_mean) for r in measure.regionprops(labels, intensity_image=image)]
+
+
+@case(11, inputs='labels')
+def regionprops_columns(labels, image):
+    return measurements.regionprops_columns(labels, image, ('label', 'area', 'centroid', 'intensity_mean'))
+
+
+@case(11, inputs='labels', objects=(10, 100))
+def object_intensities(labels, image, objects):
+    # Looking at a few nuclei one by one, with a full-frame mask each time (all of them if there are fewer)
+    return [image[labels == k].mean() for k in range(1, min(objects, labels.max()) + 1)]
+
+
+@case(11, inputs='labels', objects=(10, 100))
+def sparse_object_intensities(labels, image, objects):
+    sparse = SparseLabels.from_dense(labels)
+    return [sparse.intensity(k, image).mean() for k in range(1, min(objects, labels.max()) + 1)]
+
+
+@case(11, inputs='labels')
+def sparse_labels_round_trip(labels, image):
+    return SparseLabels.from_dense(labels).to_dense()
@@ -0,0 +1,72 @@
+"""Input images for the benchmarks: synthetic fields of nuclei of any size, or bundled samples.
+
+The synthetic images look like the chapters' fluorescence images - bright, blurred,
+roughly round nuclei on a dim, uneven and noisy background - so that thresholds,
+morphology and measurements have realistic work to do, and they can be made at any
+size, which the samples cannot. They are generated once per size and seed and then
+converted to the requested dtype.
+"""
+
+import functools
+
+import numpy as np
+from scipy import ndimage
+from skimage import color, data, util
+
+
+DTYPES = ('uint8', 'uint16', 'float32', 'float64')
+
+# Samples stored inside the scikit-image package, so they never need a download
+SAMPLES = ('camera', 'coins', 'moon', 'page', 'cell', 'retina', 'hubble_deep_field', 'immunohistochemistry')
+
+# One nucleus per this many pixels, about the density of human_mitosis
+_PIXELS_PER_NUCLEUS = 2000
+
+
+@functools.lru_cache(maxsize=4)
+def _nuclei_field(size, seed):
+    rng = np.random.default_rng(seed)
+    image = np.zeros((size, size), dtype=np.float32)
+    n = max(1, size * size // _PIXELS_PER_NUCLEUS)
+    centres = rng.uniform(0, size, (n, 2))
+    radii = rng.uniform(4, 12, n)
+    brightness = rng.uniform(0.4, 1, n).astype(np.float32)
+    for (cy, cx), r, b in zip(centres, radii, brightness):
+        # Draw each disc in its own small window
+        y0, y1 = int(max(cy - r, 0)), int(min(cy + r + 1, size))
+        x0, x1 = int(max(cx - r, 0)), int(min(cx + r + 1, size))
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        disc = (yy - cy) ** 2 + (xx - cx) ** 2 <= r * r
+        image[y0:y1, x0:x1][disc] = b
+    image = ndimage.gaussian_filter(image, 2)
+    # Uneven illumination and camera noise
+    image += np.linspace(0, 0.15, size, dtype=np.float32)[None, :]
+    image += rng.normal(0, 0.03, image.shape).astype(np.float32)
+    np.clip(image, 0, 1, out=image)
+    image.flags.writeable = False
+    return image
+
+
+def convert(image, dtype):
+    """``image`` (float between 0 and 1, or any integer type) in ``dtype``, scaled like ``util.img_as_*``."""
+    converters = {
+        'uint8': util.img_as_ubyte,
+        'uint16': util.img_as_uint,
+        'float32': util.img_as_float32,
+        'float64': util.img_as_float64,
+    }
+    # Always a fresh, writeable copy: some functions refuse read-only buffers
+    return np.array(converters[np.dtype(dtype).name](image), order='C')
+
+
+def nuclei(size, dtype='float64', seed=0):
+    """Synthetic ``size`` x ``size`` fluorescence image of nuclei, in ``dtype``."""
+    return convert(_nuclei_field(size, seed), dtype)
+
+
+def sample(name, dtype='float64'):
+    """Bundled ``skimage.data`` sample ``name``, converted to grayscale and ``dtype``."""
+    image = getattr(data, name)()
+    if image.ndim == 3:
+        image = color.rgb2gray(image[..., :3])
+    return convert(image, dtype)
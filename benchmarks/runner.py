@@ -0,0 +1,181 @@
+"""Run the benchmark cases and write the results as JSON.
+
+From the top of the repository::
+
+    python -m benchmarks                                  # all cases, 256 / 1024 / 4096 px, all dtypes
+    python -m benchmarks median gaussian --sizes 256 8192 --dtypes uint8 -o after.json
+    python -m benchmarks --source camera --source coins   # bundled samples instead of synthetic images
+    python -m benchmarks -o after.json --compare before.json
+
+Each variant is run once under ``tracemalloc`` to measure its peak memory (this also
+warms up imports and caches), then timed ``--repeat`` times; the best time is kept
+and turned into megapixels per second. The JSON output has one entry per variant,
+in a fixed order and with sorted keys, so two runs can be compared with ``diff`` or
+with ``--compare``.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import scipy
+import skimage
+from skimage import filters, measure
+
+from . import images
+from .cases import CASES
+
+
+SIZES = (256, 1024, 4096)
+
+# A run slower than this is not repeated
+_SLOW = 2.0
+
+_STACK_DEPTH = 16
+
+
+def _inputs(kind, image):
+    # Arguments of a case for the input ``kind``, built from one grayscale image
+    if kind == 'image':
+        return (image,)
+    if kind == 'rgb':
+        return (np.stack([image] * 3, axis=-1),)
+    if kind == 'stack':
+        return (np.stack([image] * _STACK_DEPTH),)
+    mask = image > filters.threshold_otsu(image)
+    if kind == 'mask':
+        return (mask,)
+    return measure.label(mask), image
+
+
+def _measure(func, args, repeat):
+    # Peak memory first (the first call also pays for lazy imports), then the best of ``repeat`` timings
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        func(*args)
+        first = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    times = []
+    for _ in range(repeat if first < _SLOW else 1):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), peak
+
+
+def key(name, source, shape, dtype, params):
+    """Stable identifier of a benchmark variant, e.g. ``median[synthetic,1024x1024,uint8,radius=3]``."""
+    extra = ''.join(f',{k}={v}' for k, v in sorted(params.items()))
+    return f"{name}[{source},{'x'.join(map(str, shape))},{dtype}{extra}]"
+
+
+def run(names=None, sizes=SIZES, dtypes=images.DTYPES, sources=('synthetic',), repeat=3, verbose=True):
+    """Run the selected cases; returns the list of result dicts."""
+    cases = [CASES[name] for name in (names or CASES)]
+    results = []
+    for source in sources:
+        for size in (sizes if source == 'synthetic' else (None,)):
+            for dtype in (*dtypes, 'bool'):
+                selected = [c for c in cases if dtype in c.dtypes]
+                if not selected:
+                    continue
+                # Masks are made from the float image
+                image_dtype = 'float64' if dtype == 'bool' else dtype
+                if source == 'synthetic':
+                    image = images.nuclei(size, image_dtype)
+                else:
+                    image = images.sample(source, image_dtype)
+                prepared = {}
+                for c in selected:
+                    if c.inputs not in prepared:
+                        prepared[c.inputs] = _inputs(c.inputs, image)
+                    for params in c.variants():
+                        args = prepared[c.inputs]
+                        with warnings.catch_warnings():
+                            warnings.simplefilter('ignore')
+                            seconds, peak = _measure(lambda *a: c.func(*a, **params), args, repeat)
+                        megapixels = image.size / 1e6 * (_STACK_DEPTH if c.inputs == 'stack' else 1)
+                        result = {
+                            'key': key(c.name, source, image.shape, dtype, params),
+                            'name': c.name,
+                            'chapter': c.chapter,
+                            'source': source,
+                            'shape': list(image.shape),
+                            'dtype': dtype,
+                            'params': {k: v if v is None or np.isscalar(v) else list(v) for k, v in params.items()},
+                            'seconds': round(seconds, 6),
+                            'megapixels_per_s': round(megapixels / seconds, 3),
+                            'peak_memory_mb': round(peak / 2 ** 20, 3),
+                        }
+                        results.append(result)
+                        if verbose:
+                            print(f"{result['key']:<60} {seconds * 1e3:10.2f} ms "
+                                  f"{result['megapixels_per_s']:10.2f} MP/s {result['peak_memory_mb']:10.1f} MB")
+    return sorted(results, key=lambda r: (r['chapter'], r['key']))
+
+
+def environment():
+    """Versions and machine the results were obtained with."""
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'skimage': skimage.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(results, baseline):
+    """Lines comparing ``results`` with the ``baseline`` results, variant by variant."""
+    before = {r['key']: r for r in baseline}
+    lines = []
+    for r in results:
+        if r['key'] in before:
+            old = before[r['key']]
+            lines.append(f"{r['key']:<60} speed-up {old['seconds'] / r['seconds']:7.2f}x "
+                         f"{r['peak_memory_mb'] - old['peak_memory_mb']:+10.1f} MB")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the hot operation of every chapter.')
+    parser.add_argument('cases', nargs='*', help=f'cases to run (default: all): {", ".join(CASES)}')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='sizes of the synthetic images')
+    parser.add_argument('--dtypes', nargs='+', default=images.DTYPES, choices=images.DTYPES)
+    parser.add_argument('--source', action='append', choices=('synthetic',) + images.SAMPLES,
+                        help='synthetic images (default) and/or bundled skimage samples; repeat to use several')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per variant, best one kept')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error(f'unknown cases: {", ".join(sorted(unknown))}')
+    results = run(args.cases, args.sizes, args.dtypes, args.source or ('synthetic',), args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('\n'.join(compare(results, baseline)) or 'Nothing to compare')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,7 @@
+"""Shared helpers for the Image Processing for Microscopy chapters.
+
+The chapter scripts stay self-contained tutorials; anything they share (loading the
+sample datasets, faster versions of the heavy operations) lives in this package.
+Add the repository root to ``sys.path`` (the chapters do this for you) and import the
+submodule you need, e.g. ``from microscopy import datasets``.
+"""
@@ -0,0 +1,37 @@
+"""Caches keyed on the identity of an image array.
+
+Several helpers (scale spaces, histograms, thresholds) reuse work done on the same
+image. They key their caches on the array object itself rather than on its
+contents: looking an entry up is free, and the entry disappears as soon as the
+image is garbage collected. The flip side is that an image must not be modified in
+place once something has been cached for it - the arrays handed out by
+``microscopy.datasets`` are read-only for exactly this reason.
+"""
+
+import weakref
+
+
+class ImageKeyedCache:
+    """Dictionary-like cache mapping ``(image, key)`` to a value, by image identity."""
+
+    def __init__(self):
+        self._entries = {}
+
+    def _forget(self, image_id):
+        self._entries.pop(image_id, None)
+
+    def get(self, image, key, factory):
+        """Return the value cached for ``(image, key)``, calling ``factory()`` to create it if needed."""
+        image_id = id(image)
+        entry = self._entries.get(image_id)
+        if entry is None or entry[0]() is not image:
+            # The callback runs when the image is freed, before its id can be reused
+            entry = (weakref.ref(image, lambda _, image_id=image_id: self._forget(image_id)), {})
+            self._entries[image_id] = entry
+        values = entry[1]
+        if key not in values:
+            values[key] = factory()
+        return values[key]
+
+    def clear(self):
+        self._entries.clear()
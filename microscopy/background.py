@@ -0,0 +1,241 @@
+"""Background subtraction for uneven illumination, in a time that does not grow with the radius.
+
+Chapter 06 flattens the background of the mitosis image with
+``morphology.white_tophat(image, morphology.disk(7))``: the image minus its opening
+by a disk. The opening takes the minimum and then the maximum over the disk around
+every pixel, so it costs the disk's area per pixel - about 150 comparisons for a
+radius of 7, but 8000 for the radii of 50 - 100 px that the illumination of a
+widefield microscope needs. Two ways around that:
+
+* :func:`white_tophat` (and :func:`opening`, :func:`black_tophat`, ...) replace the
+  disk by an octagon, which is the sum of four line segments - horizontal,
+  vertical and the two diagonals. Eroding by the octagon is eroding by each segment
+  in turn, and the minimum over a segment costs three comparisons per pixel
+  whatever its length (van Herk / Gil-Werman, as in :mod:`.rank`; the diagonals are
+  sheared into columns first). The octagon's vertices reach about 8% beyond the
+  disk's radius from a radius of about 7 (17% at a radius of 5). Below a radius
+  of 5 it would be a coarse square or diamond, so the disk itself is used - it
+  has at most 49 pixels. :func:`footprint` returns the shape used, for
+  comparison.
+* :func:`rolling_paraboloid` estimates the background itself, like ImageJ's
+  "subtract background": a paraboloid rolled under the intensity surface, i.e. an
+  opening by a paraboloid (a good approximation of the top of a rolling ball). A
+  paraboloid is separable - ``x ** 2 + y ** 2`` - so the opening is done one axis
+  at a time, on a copy of the image shrunk by block minima, and the background is
+  interpolated back to full size. The background is smooth on the scale of the
+  radius, so little is lost: a 100 px radius takes about as long as a 25 px one.
+
+Outside the image nothing counts, as in :mod:`.rank`: the minima and maxima only
+see the pixels inside, and results keep the image's dtype.
+"""
+
+import math
+
+import numpy as np
+from scipy import ndimage
+from skimage import morphology, transform
+
+from .rank import _extreme, _line_extreme
+
+
+# Smaller radii use morphology.disk itself
+_OCTAGON_RADIUS = 5
+
+
+def _segments(radius):
+    # (direction, half-length) of the segments whose sum is the octagon of ``radius``: it reaches
+    # ``axial + 2 * diagonal`` pixels along the axes and sqrt(2) * (axial + diagonal) along the
+    # diagonals, both about ``radius`` for a diagonal of (1 - 1 / sqrt(2)) * radius
+    if radius < 0:
+        raise ValueError('radius must be non-negative')
+    radius = int(round(radius))
+    diagonal = int(round(radius * (1 - 1 / math.sqrt(2))))
+    axial = radius - 2 * diagonal
+    return [((0, 1), axial), ((1, 0), axial), ((1, 1), diagonal), ((1, -1), diagonal)]
+
+
+def footprint(radius):
+    """The octagon used in place of ``morphology.disk(radius)`` (the disk below a radius of 5), as a boolean array."""
+    segments = _segments(radius)
+    if round(radius) < _OCTAGON_RADIUS:
+        return morphology.disk(int(round(radius))).astype(bool)
+    # The octagon reaches as far along both axes: one axis segment and both diagonals
+    reach = sum(half * abs(direction[0]) for direction, half in segments)
+    point = np.zeros((2 * reach + 1,) * 2, dtype=np.uint8)
+    point[reach, reach] = 1
+    return _apply(point, segments, largest=True).astype(bool)
+
+
+def _diagonal_indices(shape, direction):
+    # Where each pixel goes when the diagonal ``direction`` is sheared into a column
+    rows, cols = np.indices(shape, sparse=True)
+    height = shape[0]
+    columns = cols - rows + (height - 1) if direction == (1, 1) else cols + rows
+    return rows, columns
+
+
+def _line(image, direction, half, ufunc, fill):
+    # Extreme over the segment of ``half`` pixels either side of every pixel, along ``direction``
+    if half == 0:
+        return image
+    size = 2 * half + 1
+    if direction == (0, 1):
+        return _line_extreme(image, 1, size, ufunc, fill)
+    if direction == (1, 0):
+        return _line_extreme(image, 0, size, ufunc, fill)
+    rows, columns = _diagonal_indices(image.shape, direction)
+    sheared = np.full((image.shape[0], image.shape[0] + image.shape[1] - 1), fill, dtype=image.dtype)
+    sheared[rows, columns] = image
+    return _line_extreme(sheared, 0, size, ufunc, fill)[rows, columns]
+
+
+def _apply(image, segments, largest):
+    # Erosion (or dilation) by the sum of the segments, the outside of the image never counting:
+    # pad once by the total reach so that each segment sees the others' results, not the fill
+    fill = _extreme(image.dtype, not largest)
+    ufunc = np.maximum if largest else np.minimum
+    reach = [0, 0]
+    for direction, half in segments:
+        reach[0] += half * abs(direction[0])
+        reach[1] += half * abs(direction[1])
+    padded = np.pad(image, [(r, r) for r in reach], constant_values=fill)
+    for direction, half in segments:
+        padded = _line(padded, direction, half, ufunc, fill)
+    return padded[reach[0]:reach[0] + image.shape[0], reach[1]:reach[1] + image.shape[1]]
+
+
+def _filter(image, radius, largest):
+    # Erosion (or dilation) by footprint(radius): the octagon's segments, or the small disk directly
+    segments = _segments(radius)
+    if round(radius) < _OCTAGON_RADIUS:
+        operation = ndimage.grey_dilation if largest else ndimage.grey_erosion
+        return operation(image, footprint=footprint(radius), mode='constant', cval=_extreme(image.dtype, not largest))
+    return _apply(image, segments, largest)
+
+
+def _check(image):
+    image = np.asarray(image)
+    if image.ndim != 2:
+        raise ValueError('the octagon filters work on 2D images')
+    return image
+
+
+def erosion(image, radius):
+    """Minimum over the octagon of ``radius`` around every pixel."""
+    image = _check(image)
+    return np.ascontiguousarray(_filter(image, radius, largest=False))
+
+
+def dilation(image, radius):
+    """Maximum over the octagon of ``radius`` around every pixel."""
+    image = _check(image)
+    return np.ascontiguousarray(_filter(image, radius, largest=True))
+
+
+def opening(image, radius):
+    """Opening by the octagon of ``radius``: removes bright details it does not fit in."""
+    image = _check(image)
+    return np.ascontiguousarray(_filter(_filter(image, radius, largest=False), radius, largest=True))
+
+
+def closing(image, radius):
+    """Closing by the octagon of ``radius``: fills dark details it does not fit in."""
+    image = _check(image)
+    return np.ascontiguousarray(_filter(_filter(image, radius, largest=True), radius, largest=False))
+
+
+def white_tophat(image, radius):
+    """Like ``morphology.white_tophat(image, morphology.disk(radius))``, with the octagon: bright details."""
+    image = _check(image)
+    return image - opening(image, radius)
+
+
+def black_tophat(image, radius):
+    """Like ``morphology.black_tophat(image, morphology.disk(radius))``, with the octagon: dark details."""
+    image = _check(image)
+    return closing(image, radius) - image
+
+
+def _shrink(image, factor):
+    # Minimum over blocks of ``factor`` pixels along each axis (edge blocks padded with their own pixels)
+    if factor == 1:
+        return image
+    padded = np.pad(image, [(0, -n % factor) for n in image.shape], mode='edge')
+    shape = []
+    for n in padded.shape:
+        shape += [n // factor, factor]
+    return padded.reshape(shape).min(axis=tuple(range(1, 2 * image.ndim, 2)))
+
+
+def _parabolic(image, curvature, largest):
+    # Erosion (dilation) by the paraboloid -curvature * d ** 2 (+), one axis at a time:
+    # min over k of image[i + k] + curvature * k ** 2 along each axis
+    span = float(image.max() - image.min())
+    result = image
+    for axis in range(image.ndim):
+        source = result
+        result = source.copy()
+        n = source.shape[axis]
+        # Beyond this offset the parabola rises above the whole intensity range
+        reach = min(n - 1, int(math.sqrt(span / curvature))) if curvature > 0 else n - 1
+        for k in range(1, reach + 1):
+            penalty = curvature * k * k
+            ahead = [slice(None)] * image.ndim
+            behind = [slice(None)] * image.ndim
+            ahead[axis], behind[axis] = slice(k, None), slice(None, -k)
+            ahead, behind = tuple(ahead), tuple(behind)
+            if largest:
+                np.maximum(result[behind], source[ahead] - penalty, out=result[behind])
+                np.maximum(result[ahead], source[behind] - penalty, out=result[ahead])
+            else:
+                np.minimum(result[behind], source[ahead] + penalty, out=result[behind])
+                np.minimum(result[ahead], source[behind] + penalty, out=result[ahead])
+    return result
+
+
+def rolling_paraboloid(image, radius, height=None, shrink=None):
+    """Background of ``image`` under a paraboloid rolled beneath it, in the image's dtype.
+
+    Parameters
+    ----------
+    image : ndarray
+        Grayscale image of any number of dimensions, with bright objects on a darker,
+        uneven background (use ``image.max() - image`` for dark objects).
+    radius : float
+        Radius in pixels of the ball the paraboloid stands for: objects narrower than
+        about this are left out of the background.
+    height : float, optional
+        Height, in intensity units, the paraboloid rises by at ``radius`` pixels from its
+        apex is ``height / 2``. By default ``radius * (image.max() - image.min()) / 255``:
+        the ball of ImageJ and ``restoration.rolling_ball`` for an image spanning 0 - 255,
+        scaled with the image's contrast so that the same radius suits any dtype.
+    shrink : int, optional
+        The image is shrunk by this factor (block minima) before rolling the
+        paraboloid; by default ``radius // 10``.
+
+    Returns
+    -------
+    background : ndarray
+        Never above the image, so ``image - background`` is the corrected image.
+    """
+    image = np.asarray(image)
+    if radius <= 0:
+        raise ValueError('radius must be positive')
+    if height is None:
+        # A constant image is its own background, whatever the height
+        height = radius * float(image.max() - image.min()) / 255 or radius
+    if shrink is None:
+        shrink = max(1, int(radius // 10))
+    work = np.float64 if image.dtype == np.float64 else np.float32
+    small = _shrink(image, shrink).astype(work)
+    # The paraboloid drops by height / 2 at ``radius`` full-size pixels, i.e. radius / shrink small ones
+    curvature = height / (2 * radius ** 2) * shrink ** 2
+    background = _parabolic(_parabolic(small, curvature, largest=False), curvature, largest=True)
+    if shrink > 1:
+        padded_shape = [s * shrink for s in small.shape]
+        background = transform.resize(background, padded_shape, order=1, mode='edge', anti_aliasing=False,
+                                      preserve_range=True)
+        background = background[tuple(slice(0, n) for n in image.shape)]
+    if np.issubdtype(image.dtype, np.integer):
+        background = np.floor(background)
+    return np.minimum(background, image, dtype=work).astype(image.dtype)
@@ -0,0 +1,120 @@
+"""Run the chapter scripts as batch jobs, stage by stage, without a display.
+
+Each chapter is a plain script divided into sections by ``## --------- Title ---------``
+headers. :func:`stages` cuts a chapter at those headers into :class:`Stage` objects -
+callables running one section in a namespace shared with the previous ones - and
+:func:`run_chapter` runs them in order, timing each, with plotting switched to
+``'headless'`` (compute only, matplotlib and plotly are never imported) or ``'files'``
+(figures rendered on the Agg backend to PNG files, each closed right after it is
+saved). See :mod:`microscopy.plotting`.
+
+From the top of the repository::
+
+    python -m microscopy.batch                       # every chapter, headless
+    python -m microscopy.batch 06 09 --mode files    # figures in ./figures/06-001.png, ...
+"""
+
+import argparse
+import glob
+import os
+import re
+import time
+
+from . import plotting
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_HEADER = re.compile(r'^## -+ *(.*?) *-+ *$')
+
+
+class Stage:
+    """One section of a chapter script, run with ``stage(namespace)``."""
+
+    def __init__(self, title, source, path, first_line):
+        self.title = title
+        self.path = path
+        # Pad with empty lines so tracebacks point at the right line of the chapter
+        self.code = compile('\n' * (first_line - 1) + source, path, 'exec')
+
+    def __call__(self, namespace):
+        exec(self.code, namespace)
+
+    def __repr__(self):
+        return f'Stage({self.title!r})'
+
+
+def chapter_path(chapter):
+    """Path of the script of ``chapter``, given by its number (``6`` or ``'06'``) or folder name."""
+    prefix = f'{int(chapter):02d}-' if str(chapter).isdigit() else str(chapter)
+    matches = sorted(glob.glob(os.path.join(ROOT, glob.escape(prefix) + '*', '*.py')))
+    if not matches:
+        raise ValueError(f'No chapter matching {chapter!r} in {ROOT}')
+    return matches[0]
+
+
+def chapters():
+    """Numbers of all the chapters, in order."""
+    names = sorted(os.listdir(ROOT))
+    return [name[:2] for name in names if name[:2].isdigit() and os.path.isdir(os.path.join(ROOT, name))]
+
+
+def stages(path):
+    """Split the chapter script at ``path`` into :class:`Stage` objects, one per section."""
+    with open(path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    result = []
+    title, start = 'Preamble', 0
+    for i, line in enumerate(lines):
+        match = _HEADER.match(line)
+        if match and i > start:
+            result.append(Stage(title, '\n'.join(lines[start:i]), path, start + 1))
+            start = i
+        if match:
+            title = match.group(1)
+    result.append(Stage(title, '\n'.join(lines[start:]), path, start + 1))
+    return result
+
+
+def run_chapter(chapter, mode='headless', output_dir='figures', verbose=True):
+    """Run every stage of ``chapter`` with plotting in ``mode``.
+
+    The script runs from its own folder, like when you run it by hand. Returns a list
+    of ``(stage title, seconds)``.
+    """
+    path = chapter_path(chapter)
+    prefix = os.path.basename(os.path.dirname(path))[:2]
+    previous_mode, cwd = plotting.get_mode(), os.getcwd()
+    plotting.set_mode(mode, output_dir=os.path.abspath(output_dir), prefix=prefix)
+    namespace = {'__name__': '__main__', '__file__': path}
+    timings = []
+    try:
+        os.chdir(os.path.dirname(path))
+        for stage in stages(path):
+            start = time.perf_counter()
+            stage(namespace)
+            plotting.save_figures()
+            timings.append((stage.title, time.perf_counter() - start))
+            if verbose:
+                print(f'{prefix}  {timings[-1][1]:8.2f} s  {stage.title}')
+    finally:
+        os.chdir(cwd)
+        plotting.set_mode(previous_mode)
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the chapter scripts without a display.')
+    parser.add_argument('chapters', nargs='*', help='chapter numbers (default: all)')
+    parser.add_argument('--mode', choices=('headless', 'files'), default='headless',
+                        help="'headless' skips all plotting, 'files' saves every figure as a PNG")
+    parser.add_argument('--output-dir', default='figures', help="where 'files' mode writes the figures")
+    args = parser.parse_args(argv)
+    total = time.perf_counter()
+    for chapter in args.chapters or chapters():
+        run_chapter(chapter, args.mode, args.output_dir)
+    print(f'Done in {time.perf_counter() - total:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""Fast operations on boolean masks.
+
+Chapters 10 and 11 smooth their nuclei masks with ``filters.median(mask,
+morphology.square(4))``, which runs a general median filter - sorting the values under
+the footprint at every pixel - on what is really a vote: the median of a set of
+booleans is True when at least half of them are. :func:`median` counts the votes
+instead. The count under a box footprint is a running sum along each axis in turn
+(a couple of passes over the mask, whatever the footprint size); under any other
+footprint (a disk, say) it is a sum of running sums along the rows of the footprint.
+The counts are kept in the smallest unsigned type that holds the footprint size;
+running sums may wrap around, but their differences are exact.
+
+Masks themselves take one byte per pixel as numpy booleans. :class:`PackedMask` keeps
+them at one bit per pixel, 64 pixels to a 64-bit word along the last axis, which is
+8x less memory; logical operations then handle 64 pixels per instruction, and so do
+erosion, dilation, opening and closing by rectangles (``morphology.square(5)``) and
+crosses (``morphology.diamond(1)``): a rectangle is a line along each axis in turn,
+and the erosion by a line of ``n`` pixels is the AND of ``log2(n)`` shifted copies of
+the mask - shifts of whole rows, or bit shifts within and across words along the
+last axis. The area is a popcount of the words::
+
+    packed = binary.pack(mask)
+    closed = packed.closing(morphology.square(5))
+    print(closed.area(), (closed ^ packed).area())
+    closed.unpack()
+"""
+
+import numpy as np
+from scipy import ndimage
+from skimage import filters
+
+
+def _count_dtype(size):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if size <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def _box_sums(counts, size, axis, dtype):
+    # Sums of ``size`` consecutive elements along ``axis``: the output is ``size - 1`` shorter
+    cumulative = np.cumsum(counts, axis=axis, dtype=dtype)
+    n = cumulative.shape[axis] - size + 1
+    head = [slice(None)] * counts.ndim
+    head[axis] = slice(size - 1, None)
+    sums = cumulative[tuple(head)].copy()
+    rest, previous = list(head), [slice(None)] * counts.ndim
+    rest[axis], previous[axis] = slice(1, None), slice(0, n - 1)
+    sums[tuple(rest)] -= cumulative[tuple(previous)]
+    return sums
+
+
+def _runs(row):
+    # (start, stop) of each run of True in a 1D boolean array
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], row.view(np.uint8), [0]))))
+    return list(zip(edges[::2], edges[1::2]))
+
+
+def votes(mask, footprint):
+    """Number of True pixels of ``mask`` under ``footprint`` centred on every pixel.
+
+    The footprint is centred like in ``scipy.ndimage`` (on index ``n // 2`` along an
+    axis of length ``n``) and the mask is extended by repeating its edges, like
+    ``filters.median`` does. The counts are in the smallest unsigned integer type
+    that holds ``footprint.sum()``.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    footprint = np.asarray(footprint, dtype=bool)
+    if footprint.ndim != mask.ndim:
+        raise ValueError(f'The footprint has {footprint.ndim} dimensions, the mask {mask.ndim}')
+    dtype = _count_dtype(int(footprint.sum()))
+    padded = np.pad(mask, [(n // 2, n - 1 - n // 2) for n in footprint.shape], mode='edge')
+    if footprint.all():
+        counts = padded.view(np.uint8)
+        for axis, n in enumerate(footprint.shape):
+            counts = _box_sums(counts, n, axis, dtype)
+        return counts
+
+    # Any other footprint: along each of its rows, the count over a run of True is
+    # the difference of two running sums along the last axis
+    shape = mask.shape
+    cumulative = np.zeros(padded.shape[:-1] + (padded.shape[-1] + 1,), dtype=dtype)
+    np.cumsum(padded, axis=-1, dtype=dtype, out=cumulative[..., 1:])
+    counts = np.zeros(shape, dtype=dtype)
+    for offset in np.ndindex(footprint.shape[:-1]):
+        rows = tuple(slice(o, o + n) for o, n in zip(offset, shape[:-1]))
+        for start, stop in _runs(footprint[offset]):
+            counts += cumulative[rows + (slice(stop, stop + shape[-1]),)]
+            counts -= cumulative[rows + (slice(start, start + shape[-1]),)]
+    return counts
+
+
+def median(mask, footprint=None, out=None):
+    """Median filter of a boolean ``mask`` by majority vote; same result as ``filters.median``.
+
+    A pixel of the output is True when at least half of the pixels under the footprint
+    are True (for an even number of pixels, ties go to True, as in
+    ``scipy.ndimage.median_filter``). Images that are not boolean are passed on to
+    ``filters.median``.
+
+    Parameters
+    ----------
+    mask : ndarray of bool
+        Mask to smooth, of any number of dimensions.
+    footprint : ndarray, optional
+        Neighbourhood of each pixel, e.g. ``morphology.square(4)`` or
+        ``morphology.disk(3)``; by default the full 3 x 3 (x 3...) neighbourhood.
+    out : ndarray of bool, optional
+        Array to write the result into.
+    """
+    if np.asarray(mask).dtype != bool:
+        return filters.median(mask, footprint, out=out)
+    if footprint is None:
+        footprint = ndimage.generate_binary_structure(mask.ndim, mask.ndim)
+    size = int(np.count_nonzero(footprint))
+    if size == 0:
+        raise ValueError('The footprint is empty')
+    return np.greater_equal(votes(mask, footprint), size - size // 2, out=out)
+
+
+_WORD = 64
+
+_ONES = np.uint64(2 ** 64 - 1)
+
+
+def _shift(words, axis, k, fill):
+    # Packed mask whose pixel x along ``axis`` is pixel x + k of ``words``; pixels
+    # from outside the mask are ``fill``. The padding bits of the last word must
+    # already be ``fill``.
+    fill_word = _ONES if fill else np.uint64(0)
+    if axis != words.ndim - 1:
+        result = np.full_like(words, fill_word)
+        n = words.shape[axis]
+        if abs(k) < n:
+            source, target = [slice(None)] * words.ndim, [slice(None)] * words.ndim
+            source[axis] = slice(max(k, 0), n + min(k, 0))
+            target[axis] = slice(max(-k, 0), n - max(k, 0))
+            result[tuple(target)] = words[tuple(source)]
+        return result
+    q, r = divmod(k, _WORD)
+    n = words.shape[-1]
+    # Enough fill words on both sides for word j + q and j + q + 1 to exist
+    margin = abs(q) + 1
+    padded = np.pad(words, [(0, 0)] * (words.ndim - 1) + [(margin, margin)], constant_values=fill_word)
+    low = padded[..., margin + q:margin + q + n]
+    if r == 0:
+        return low.copy()
+    high = padded[..., margin + q + 1:margin + q + 1 + n]
+    return (low >> np.uint64(r)) | (high << np.uint64(_WORD - r))
+
+
+def _window(words, axis, length, step, erode):
+    # AND (erosion) or OR (dilation) of the pixels 0, step, ..., (length - 1) * step
+    # away along ``axis`` (step is 1 or -1): windows of 1, 2, 4... pixels, each made
+    # of two shifted copies of the previous one, then two overlapping windows of the
+    # largest power of two that fits. Pixels outside the mask are ``erode``, so the
+    # windows always grow away from the pixel, never across the far edge of the mask.
+    combine = np.bitwise_and if erode else np.bitwise_or
+    window, size = words, 1
+    while 2 * size <= length:
+        window = combine(window, _shift(window, axis, step * size, erode))
+        size *= 2
+    if size < length:
+        window = combine(window, _shift(window, axis, step * (length - size), erode))
+    return window
+
+
+def _line(words, axis, start, length, erode):
+    # AND / OR of the pixels start .. start + length - 1 away along ``axis``, with
+    # start <= 0 < start + length: a window backwards and one forwards from each pixel
+    forward = _window(words, axis, start + length, 1, erode)
+    if start == 0:
+        return forward
+    backward = _window(words, axis, 1 - start, -1, erode)
+    return np.bitwise_and(forward, backward) if erode else np.bitwise_or(forward, backward)
+
+
+def _footprint_lines(footprint, ndim):
+    # A footprint as (lines, combine): the footprint is the sum of lines along each
+    # axis (a rectangle, combine='product') or their union (a cross, combine='union').
+    # Each line is (axis, first offset, length) relative to the centre n // 2.
+    footprint = np.asarray(footprint, dtype=bool)
+    if footprint.ndim != ndim:
+        raise ValueError(f'The footprint has {footprint.ndim} dimensions, the mask {ndim}')
+    centre = tuple(n // 2 for n in footprint.shape)
+    lines = [(axis, -centre[axis], n) for axis, n in enumerate(footprint.shape) if n > 1]
+    if footprint.all():
+        return lines, 'product'
+    cross = np.zeros_like(footprint)
+    for axis in range(ndim):
+        index = list(centre)
+        index[axis] = slice(None)
+        cross[tuple(index)] = True
+    if (footprint == cross).all():
+        return lines, 'union'
+    raise ValueError('Packed masks support rectangular footprints (e.g. morphology.square) '
+                     'and crosses (e.g. morphology.diamond(1)) only')
+
+
+def pack(mask):
+    """Pack a boolean ``mask`` into a :class:`PackedMask`, 64 pixels per word along its last axis."""
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim == 0:
+        raise ValueError('Cannot pack a 0-dimensional mask')
+    n_words = -(-mask.shape[-1] // _WORD)
+    padded = np.zeros(mask.shape[:-1] + (n_words * _WORD,), dtype=bool)
+    padded[..., :mask.shape[-1]] = mask
+    words = np.packbits(padded, axis=-1, bitorder='little').view('<u8').astype(np.uint64, copy=False)
+    return PackedMask(words, mask.shape)
+
+
+class PackedMask:
+    """A boolean mask stored as bits; see :func:`pack`.
+
+    Supports ``&``, ``|``, ``^`` and ``~`` with other packed masks of the same shape,
+    :meth:`area`, and binary morphology by rectangles and crosses, with the same
+    results as ``morphology.binary_erosion`` / ``binary_dilation`` (and so
+    ``binary_opening`` / ``binary_closing``): the mask is taken to be True outside the
+    image for an erosion and False for a dilation, and even-sized footprints are
+    centred on index ``n // 2``. For odd-sized footprints these are also the results
+    of ``morphology.erosion``, ``dilation``, ``opening`` and ``closing``.
+    """
+
+    def __init__(self, words, shape):
+        self.words = words
+        self.shape = tuple(shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def _padding(self):
+        # Mask of the padding bits at the end of the last word
+        used = self.shape[-1] - _WORD * (self.words.shape[-1] - 1)
+        return np.uint64(0) if used == _WORD else _ONES << np.uint64(used)
+
+    def _with_padding(self, fill):
+        words = self.words.copy()
+        if fill:
+            words[..., -1] |= self._padding()
+        return words
+
+    def _new(self, words):
+        # Keep the padding bits False, so that area and unpack need not care
+        words[..., -1] &= ~self._padding()
+        return PackedMask(words, self.shape)
+
+    def unpack(self):
+        """The mask as a numpy boolean array."""
+        bits = np.unpackbits(self.words.astype('<u8', copy=False).view(np.uint8), axis=-1, bitorder='little')
+        return bits[..., :self.shape[-1]].view(bool)
+
+    def area(self):
+        """Number of True pixels."""
+        return int(np.bitwise_count(self.words).sum(dtype=np.int64))
+
+    def _check(self, other):
+        if not isinstance(other, PackedMask) or other.shape != self.shape:
+            raise ValueError('Both operands must be packed masks of the same shape')
+
+    def __and__(self, other):
+        self._check(other)
+        return PackedMask(self.words & other.words, self.shape)
+
+    def __or__(self, other):
+        self._check(other)
+        return PackedMask(self.words | other.words, self.shape)
+
+    def __xor__(self, other):
+        self._check(other)
+        return PackedMask(self.words ^ other.words, self.shape)
+
+    def __invert__(self):
+        return self._new(~self.words)
+
+    def erosion(self, footprint):
+        """Binary erosion by a rectangle or cross ``footprint``."""
+        lines, combine = _footprint_lines(footprint, self.ndim)
+        words = self._with_padding(True)
+        if combine == 'product':
+            for axis, start, length in lines:
+                words = _line(words, axis, start, length, erode=True)
+        elif lines:
+            # Erosion by a union of lines is the intersection of the erosions
+            words = np.bitwise_and.reduce([_line(words, axis, start, length, erode=True)
+                                           for axis, start, length in lines])
+        return self._new(words)
+
+    def dilation(self, footprint):
+        """Binary dilation by a rectangle or cross ``footprint``."""
+        lines, combine = _footprint_lines(footprint, self.ndim)
+        words = self.words.copy()
+        # The footprint is mirrored, as in scipy.ndimage.binary_dilation
+        lines = [(axis, -(start + length - 1), length) for axis, start, length in lines]
+        if combine == 'product':
+            for axis, start, length in lines:
+                words = _line(words, axis, start, length, erode=False)
+        elif lines:
+            words = np.bitwise_or.reduce([_line(words, axis, start, length, erode=False)
+                                          for axis, start, length in lines])
+        return self._new(words)
+
+    def opening(self, footprint):
+        """Binary opening: erosion, then dilation."""
+        return self.erosion(footprint).dilation(footprint)
+
+    def closing(self, footprint):
+        """Binary closing: dilation, then erosion."""
+        return self.dilation(footprint).erosion(footprint)
+
+    def __repr__(self):
+        return f'PackedMask(shape={self.shape}, area={self.area()})'
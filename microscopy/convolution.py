@@ -0,0 +1,409 @@
+"""Convolution that picks the fastest way to compute it: separable, direct or by FFT.
+
+The cost of a spatial convolution grows with the kernel. A Gaussian is separable (one
+1D pass per axis), so ``filters.gaussian`` costs about ``2 * (8 * sigma + 1)``
+multiply-adds per pixel of a 2D image: cheap at sigma 1 and 2, but already more
+than a Fourier transform at sigma 7 and far more at the sigmas of 20 - 50 used to
+estimate an uneven background. Kernels that are not separable, like the mean over
+``morphology.disk(7)``, cost their full number of pixels per pixel. A convolution by
+FFT costs about ``log2`` of the number of pixels per pixel, whatever the kernel.
+
+:func:`convolve`, :func:`correlate` and :func:`gaussian` estimate the cost of each
+method from the image and kernel shapes and use the cheapest:
+
+* ``'separable'`` - one ``ndimage.correlate1d`` pass per axis, for kernels given as
+  1D factors (a sequence with one 1D array per axis) or 2D kernels of rank one;
+* ``'direct'`` - ``ndimage.correlate`` with the full kernel;
+* ``'fft'`` - the image is padded by the kernel's reach with the boundary ``mode``
+  (so borders are the same as the spatial filters'), padded further to a size
+  ``scipy.fft.next_fast_len`` likes, transformed with ``rfftn``, multiplied by the
+  kernel's spectrum and transformed back. Spectra are cached per kernel and FFT
+  shape (and ``scipy.fft`` caches its own plans), so applying the same kernel to
+  many images of one size transforms the kernel once.
+
+The methods agree to within floating point rounding (about 1e-6 of the image's range
+in float32, 1e-12 in float64). A :class:`KernelBank` applies several kernels to one
+image with a single forward transform, and :func:`difference_of_gaussians` computes
+both blurs with one forward and one inverse transform.
+"""
+
+import math
+from collections import OrderedDict
+
+import numpy as np
+from scipy import fft, ndimage
+from skimage import util
+
+
+METHODS = ('auto', 'separable', 'direct', 'fft')
+
+# Kernel spectra are kept until they take more than this many bytes
+SPECTRUM_CACHE_BYTES = 64 * 2 ** 20
+
+# 'auto' does not use the FFT when its padded image, spectrum and inverse transform
+# would take more than this many bytes, e.g. for large volumes; spatial filters need
+# no more than a copy of the image
+FFT_MAX_BYTES = 2 ** 30
+
+# ndimage boundary modes and the np.pad modes that extend an image the same way
+_PADDING = {'nearest': 'edge', 'reflect': 'symmetric', 'mirror': 'reflect', 'wrap': 'wrap', 'constant': 'constant'}
+
+# Rough costs in nanoseconds per pixel, measured with float64 images: a 1D pass costs
+# _PASS_COST plus _TAP_COST per kernel value, a direct convolution _PASS_COST / 2 plus
+# _DIRECT_COST per non-zero kernel value (ndimage skips the zeros), and an rfftn /
+# irfftn pair of n points _FFT_COST * n * log2(n) in total (less than half as much in
+# single precision, while ndimage computes in double precision whatever the image)
+_PASS_COST = 18
+_TAP_COST = 0.5
+_DIRECT_COST = 1.0
+_FFT_COST = 2.2
+_FFT_COST_SINGLE = 0.9
+
+_spectra = OrderedDict()
+
+
+class _Kernel:
+    """A kernel as a sum of separable terms ``(weight, 1D factors)``, or a dense array.
+
+    ``shifts`` place it: along each axis, output pixel ``i`` is the sum over ``m`` of
+    ``kernel[m] * image[i + shift - m]`` (``shift = n // 2`` for ``ndimage.convolve``).
+    """
+
+    def __init__(self, shape, shifts, terms=None, dense=None):
+        self.shape = tuple(shape)
+        self.shifts = tuple(shifts)
+        self.terms = terms
+        self.dense = dense
+        parts = [dense] if dense is not None else [f for _, factors in terms for f in factors]
+        self._key = (self.shape, self.shifts, tuple(w for w, _ in terms or ()),
+                     tuple(hash(np.ascontiguousarray(p, dtype=np.float64).tobytes()) for p in parts))
+
+    @property
+    def separable(self):
+        return self.terms is not None
+
+    def spectrum(self, fft_shape, dtype):
+        """Arrays whose (broadcast) product is the kernel's spectrum for ``fft_shape``.
+
+        The spectrum of an outer product is the outer product of the 1D spectra, so a
+        kernel with a single separable term gives one line per axis and never needs
+        the full spectrum in memory; other kernels give their full spectrum.
+        """
+        key = (self._key, fft_shape, np.dtype(dtype).str)
+        if key in _spectra:
+            _spectra.move_to_end(key)
+            return _spectra[key]
+        ndim = len(fft_shape)
+        if self.dense is not None:
+            parts = (fft.rfftn(self.dense, fft_shape, axes=tuple(range(ndim))),)
+        else:
+            terms = []
+            for weight, factors in self.terms:
+                lines = [_along((fft.rfft if axis == ndim - 1 else fft.fft)(factor, fft_shape[axis]), axis, ndim)
+                         for axis, factor in enumerate(factors)]
+                lines[0] = lines[0] * weight
+                terms.append(lines)
+            parts = terms[0] if len(terms) == 1 else (sum(math.prod(lines) for lines in terms),)
+        parts = tuple(np.ascontiguousarray(p, dtype=dtype) for p in parts)
+        for p in parts:
+            p.flags.writeable = False
+        _spectra[key] = parts
+        # Spectra larger than the whole budget are not kept at all
+        while _spectra and sum(p.nbytes for parts in _spectra.values() for p in parts) > SPECTRUM_CACHE_BYTES:
+            _spectra.popitem(last=False)
+        return parts
+
+
+def _along(line, axis, ndim):
+    # ``line`` as an array along ``axis`` of an ``ndim``-dimensional array, for broadcasting
+    return line.reshape((1,) * axis + (-1,) + (1,) * (ndim - axis - 1))
+
+
+def _factorise(kernel):
+    # 1D factors of a kernel: itself in 1D, the rank-one SVD of a 2D kernel, or None
+    if kernel.ndim == 1:
+        return [kernel]
+    if kernel.ndim != 2:
+        return None
+    u, s, vt = np.linalg.svd(kernel)
+    if s[0] == 0 or s[1:].sum() > 1e-10 * s[0]:
+        return None
+    scale = math.sqrt(s[0])
+    return [u[:, 0] * scale, vt[0] * scale]
+
+
+def _as_kernel(kernel, ndim, flip):
+    # A _Kernel for ``ndimage.convolve`` (flip False) or ``ndimage.correlate`` (flip True)
+    if isinstance(kernel, _Kernel):
+        return kernel
+    if isinstance(kernel, (list, tuple)):
+        factors = [np.asarray(f, dtype=np.float64).reshape(-1) for f in kernel]
+    else:
+        kernel = np.asarray(kernel, dtype=np.float64)
+        if kernel.ndim != ndim:
+            raise ValueError(f'the kernel has {kernel.ndim} dimensions and the image {ndim}')
+        factors = _factorise(kernel)
+        if factors is None:
+            if flip:
+                kernel = kernel[(slice(None, None, -1),) * ndim]
+            shape = kernel.shape
+            shifts = [n - 1 - n // 2 if flip else n // 2 for n in shape]
+            return _Kernel(shape, shifts, dense=kernel)
+    if len(factors) != ndim:
+        raise ValueError(f'{len(factors)} kernel factors for an image with {ndim} dimensions')
+    if flip:
+        factors = [f[::-1] for f in factors]
+    shape = [len(f) for f in factors]
+    shifts = [n - 1 - n // 2 if flip else n // 2 for n in shape]
+    return _Kernel(shape, shifts, terms=[(1.0, factors)])
+
+
+def gaussian_kernel(sigma, ndim=2, truncate=4.0):
+    """The Gaussian of ``filters.gaussian`` as 1D factors, one per axis (``sigma`` may be per axis)."""
+    sigmas = np.broadcast_to(np.asarray(sigma, dtype=np.float64), (ndim,))
+    factors = []
+    for s in sigmas:
+        if s == 0:
+            factors.append(np.ones(1))
+            continue
+        radius = int(truncate * float(s) + 0.5)
+        x = np.arange(-radius, radius + 1)
+        phi = np.exp(-0.5 / (s * s) * x ** 2)
+        factors.append(phi / phi.sum())
+    return factors
+
+
+def _fft_shape(shape):
+    # Sizes at least ``shape`` with small prime factors only; the last axis gets the real transform
+    return tuple(fft.next_fast_len(int(n), real=axis == len(shape) - 1) for axis, n in enumerate(shape))
+
+
+def _costs(shape, kernels, dtype, n_outputs=1):
+    # Estimated cost of each method for the kernels, summed; a method a kernel cannot use costs inf
+    size = math.prod(shape)
+    padded = [n + max(k.shape[axis] for k in kernels) - 1 for axis, n in enumerate(shape)]
+    points = math.prod(_fft_shape(padded))
+    single = dtype == np.float32
+    costs = {
+        'separable': 0.0,
+        'direct': 0.0,
+        # One forward transform, one inverse per output
+        'fft': (_FFT_COST_SINGLE if single else _FFT_COST) / 2 * points * math.log2(max(points, 2)) * (1 + n_outputs),
+    }
+    if 3 * points * (4 if single else 8) > FFT_MAX_BYTES:
+        costs['fft'] = math.inf
+    for k in kernels:
+        if k.separable:
+            costs['separable'] += size * sum(_PASS_COST + _TAP_COST * len(f) for _, factors in k.terms for f in factors)
+            nonzero = sum(math.prod(np.count_nonzero(f) for f in factors) for _, factors in k.terms)
+        else:
+            costs['separable'] = math.inf
+            nonzero = np.count_nonzero(k.dense)
+        costs['direct'] += size * (_PASS_COST / 2 + _DIRECT_COST * nonzero)
+    return costs
+
+
+def choose(shape, kernel, dtype=np.float64, correlation=False):
+    """The method :func:`convolve` would use for an image of ``shape`` and ``dtype`` and ``kernel``, with ``method='auto'``."""
+    kernel = _as_kernel(kernel, len(shape), correlation)
+    costs = _costs(shape, [kernel], _float_dtype(dtype))
+    return min(costs, key=costs.get)
+
+
+def _float_dtype(dtype):
+    return np.float32 if np.dtype(dtype) == np.float32 else np.float64
+
+
+def _spatial(image, kernel, method, mode, cval, dtype):
+    # Correlate with the kernel reversed; ``origin`` moves its centre to ``shift``
+    def origin(n, shift):
+        return n - 1 - shift - n // 2
+
+    if method == 'separable':
+        result = None
+        for weight, factors in kernel.terms:
+            term, outside = image, cval
+            for axis, (factor, shift) in enumerate(zip(factors, kernel.shifts)):
+                term = ndimage.correlate1d(term, factor[::-1], axis, output=dtype, mode=mode, cval=outside,
+                                           origin=origin(len(factor), shift))
+                # Outside the image the previous passes turned cval into cval times their factors' sums
+                outside = outside * float(factor.sum())
+            if weight != 1:
+                term *= weight
+            result = term if result is None else np.add(result, term, out=result)
+        return result
+    dense = kernel.dense
+    if dense is None:
+        dense = sum(weight * math.prod(_along(f, axis, len(factors)) for axis, f in enumerate(factors))
+                    for weight, factors in kernel.terms)
+    return ndimage.correlate(image.astype(dtype, copy=False), dense[(slice(None, None, -1),) * dense.ndim],
+                             output=dtype, mode=mode, cval=cval,
+                             origin=[origin(n, s) for n, s in zip(kernel.shape, kernel.shifts)])
+
+
+def _fft(image, kernels, mode, cval, dtype, workers):
+    # One forward transform of the padded image, one product and inverse transform per kernel
+    ndim = image.ndim
+    before = [max(k.shape[axis] - 1 - k.shifts[axis] for k in kernels) for axis in range(ndim)]
+    after = [max(k.shifts[axis] for k in kernels) for axis in range(ndim)]
+    fft_shape = _fft_shape([n + b + a for n, b, a in zip(image.shape, before, after)])
+    # Padding straight to the FFT shape saves rfftn a copy; the extra pixels are only read
+    # by outputs that are cropped away
+    after = [f - n - b for f, n, b in zip(fft_shape, image.shape, before)]
+    extra = {'constant_values': cval} if mode == 'constant' else {}
+    padded = np.pad(image.astype(dtype, copy=False), list(zip(before, after)), mode=_PADDING[mode], **extra)
+    axes = tuple(range(ndim))
+    spectrum = fft.rfftn(padded, axes=axes, overwrite_x=True, workers=workers)
+    del padded
+    for i, k in enumerate(kernels):
+        # The last kernel may overwrite the image's spectrum
+        product = spectrum if i == len(kernels) - 1 else spectrum.copy()
+        for part in k.spectrum(fft_shape, spectrum.dtype):
+            product *= part
+        full = fft.irfftn(product, fft_shape, axes=axes, overwrite_x=True, workers=workers)
+        del product
+        # Output pixel i sits at i + shift in the padded image's linear convolution
+        yield full[tuple(slice(s + b, s + b + n) for s, b, n in zip(k.shifts, before, image.shape))]
+
+
+def _check(image, method, mode):
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {', '.join(METHODS)}, not {method!r}")
+    if mode not in _PADDING:
+        raise ValueError(f"mode must be one of {', '.join(_PADDING)}, not {mode!r}")
+    if np.iscomplexobj(image):
+        raise TypeError('complex images are not supported')
+
+
+def _apply(image, kernel, mode, cval, method, workers, flip):
+    image = np.asarray(image)
+    _check(image, method, mode)
+    kernel = _as_kernel(kernel, image.ndim, flip)
+    if method == 'auto':
+        costs = _costs(image.shape, [kernel], _float_dtype(image.dtype))
+        method = min(costs, key=costs.get)
+    elif method == 'separable' and not kernel.separable:
+        raise ValueError('the kernel is not separable')
+    dtype = _float_dtype(image.dtype)
+    if method == 'fft':
+        return np.ascontiguousarray(next(_fft(image, [kernel], mode, cval, dtype, workers)))
+    return _spatial(image, kernel, method, mode, cval, dtype)
+
+
+def convolve(image, kernel, mode='nearest', cval=0.0, method='auto', workers=None):
+    """Convolution of ``image`` with ``kernel``, as ``ndimage.convolve`` computes it, as floats.
+
+    Parameters
+    ----------
+    image : ndarray
+        Image of any number of dimensions. The result is ``float32`` for ``float32``
+        images, ``float64`` otherwise (integers are not rounded back).
+    kernel : ndarray or sequence of 1D arrays
+        The kernel, with as many dimensions as the image, or one 1D factor per axis
+        for a separable kernel (their outer product).
+    mode, cval :
+        Boundary handling, as in ``scipy.ndimage``: ``'nearest'``, ``'reflect'``,
+        ``'mirror'``, ``'wrap'`` or ``'constant'``.
+    method : {'auto', 'separable', 'direct', 'fft'}
+        ``'auto'`` picks the cheapest for this image and kernel shape.
+    workers : int, optional
+        Threads used by ``scipy.fft`` for the FFT method.
+    """
+    return _apply(image, kernel, mode, cval, method, workers, flip=False)
+
+
+def correlate(image, kernel, mode='nearest', cval=0.0, method='auto', workers=None):
+    """Correlation of ``image`` with ``kernel``, as ``ndimage.correlate`` computes it; see :func:`convolve`."""
+    return _apply(image, kernel, mode, cval, method, workers, flip=True)
+
+
+def gaussian(image, sigma=1, mode='nearest', cval=0.0, truncate=4.0, method='auto', workers=None):
+    """Gaussian blur, like ``filters.gaussian`` but by FFT when the kernel is large.
+
+    Integer images are rescaled to 0..1 like ``filters.gaussian`` does; ``float32``
+    images stay ``float32``. ``sigma`` may be given per axis.
+    """
+    image = util.img_as_float(image)
+    return convolve(image, gaussian_kernel(sigma, image.ndim, truncate), mode, cval, method, workers)
+
+
+def difference_of_gaussians(image, low_sigma, high_sigma=None, mode='nearest', cval=0.0, truncate=4.0,
+                            method='auto', workers=None):
+    """Like ``filters.difference_of_gaussians``: the blur at ``low_sigma`` minus the blur at ``high_sigma``.
+
+    By FFT the two blurs share both transforms: the difference of the two kernels'
+    spectra is applied in one go. ``high_sigma`` defaults to 1.6 x ``low_sigma``.
+    """
+    if high_sigma is None:
+        high_sigma = 1.6 * np.asarray(low_sigma, dtype=np.float64)
+    if np.any(np.asarray(high_sigma) < np.asarray(low_sigma)):
+        raise ValueError('high_sigma must be equal to or larger than low_sigma')
+    image = util.img_as_float(image)
+    _check(image, method, mode)
+    low = gaussian_kernel(low_sigma, image.ndim, truncate)
+    high = gaussian_kernel(high_sigma, image.ndim, truncate)
+    # Pad the narrower factors with zeros, so both terms have the same centre
+    padded_low = [np.pad(f, (len(h) - len(f)) // 2) for f, h in zip(low, high)]
+    shape = [len(f) for f in high]
+    dog = _Kernel(shape, [n // 2 for n in shape], terms=[(1.0, padded_low), (-1.0, high)])
+    if method == 'auto':
+        costs = _costs(image.shape, [dog], _float_dtype(image.dtype))
+        method = min(costs, key=costs.get)
+    if method == 'fft':
+        return np.ascontiguousarray(next(_fft(image, [dog], mode, cval, _float_dtype(image.dtype), workers)))
+    result = convolve(image, low, mode, cval, method)
+    result -= convolve(image, high, mode, cval, method)
+    return result
+
+
+class KernelBank:
+    """Several kernels applied to images with one forward FFT per image.
+
+    A filter bank - blurs at several sigmas, the derivatives of a Gaussian, oriented
+    kernels - applies many kernels to the same image. By FFT the image is padded and
+    transformed once, then each kernel costs one product and one inverse transform::
+
+        bank = convolution.KernelBank([convolution.gaussian_kernel(s) for s in (10, 20, 40)])
+        blur10, blur20, blur40 = bank.apply(image)
+
+    Kernels are as for :func:`convolve` (or :func:`correlate` with ``correlation=True``);
+    ``method='auto'`` picks the FFT when it is cheaper for all the kernels together than
+    applying them one by one in space.
+    """
+
+    def __init__(self, kernels, mode='nearest', cval=0.0, method='auto', correlation=False, workers=None):
+        if mode not in _PADDING:
+            raise ValueError(f"mode must be one of {', '.join(_PADDING)}, not {mode!r}")
+        if method not in METHODS:
+            raise ValueError(f"method must be one of {', '.join(METHODS)}, not {method!r}")
+        self.kernels = list(kernels)
+        self.mode = mode
+        self.cval = cval
+        self.method = method
+        self.correlation = correlation
+        self.workers = workers
+
+    def __len__(self):
+        return len(self.kernels)
+
+    def apply(self, image):
+        """The image filtered with every kernel, as a list in the kernels' order."""
+        image = np.asarray(image)
+        _check(image, self.method, self.mode)
+        kernels = [_as_kernel(k, image.ndim, self.correlation) for k in self.kernels]
+        method = self.method
+        if method == 'auto':
+            fft_cost = _costs(image.shape, kernels, _float_dtype(image.dtype), n_outputs=len(kernels))['fft']
+            spatial_cost = sum(min(c for m, c in _costs(image.shape, [k], np.float64).items() if m != 'fft')
+                               for k in kernels)
+            method = 'fft' if fft_cost < spatial_cost else 'spatial'
+        dtype = _float_dtype(image.dtype)
+        if method == 'fft':
+            return [np.ascontiguousarray(r) for r in _fft(image, kernels, self.mode, self.cval, dtype, self.workers)]
+        results = []
+        for k in kernels:
+            spatial_method = method if method != 'spatial' else ('separable' if k.separable else 'direct')
+            if spatial_method == 'separable' and not k.separable:
+                raise ValueError('the kernel is not separable')
+            results.append(_spatial(image, k, spatial_method, self.mode, self.cval, dtype))
+        return results
@@ -0,0 +1,100 @@
+"""Memory-mapped access to the scikit-image sample datasets used in the chapters.
+
+``data.cells3d()`` decodes the whole (60, 2, 256, 256) uint16 TIFF every time it is
+called, and most chapters only want one plane of it. Here each dataset is decoded
+once into an on-disk ``.npy`` cache, every later request is served from a read-only
+``np.memmap`` of that file, and the float planes the chapters work with are kept in a
+small in-process LRU so running several chapters back to back only touches the stack
+once.
+
+The cache lives in ``~/.cache/image-processing-for-microscopy`` unless the
+``MICROSCOPY_CACHE_DIR`` environment variable points somewhere else.
+"""
+
+import functools
+import os
+import tempfile
+
+import numpy as np
+from skimage import data, util
+
+
+CACHE_DIR = os.environ.get(
+    'MICROSCOPY_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'image-processing-for-microscopy'),
+)
+
+# Number of float planes kept alive by plane() - a 256 x 256 float64 plane is 512 kB
+PLANE_CACHE_SIZE = 16
+
+# Voxel size in micrometres, (Z, Y, X), as documented for skimage.data.cells3d
+SPACING = {'cells3d': (0.29, 0.26, 0.26)}
+
+
+def cache_path(name):
+    """Path of the on-disk cache file for the dataset ``skimage.data.<name>``."""
+    return os.path.join(CACHE_DIR, name + '.npy')
+
+
+def _materialise(name, path):
+    # Decode the dataset once and write it atomically, so that several chapters
+    # started at the same time never see a half-written cache file
+    array = np.asarray(getattr(data, name)())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@functools.lru_cache(maxsize=None)
+def stack(name='cells3d'):
+    """Return the dataset ``skimage.data.<name>`` as a read-only memory map.
+
+    The dataset is decoded and written to the cache on first use only; afterwards
+    the pixels are paged in from disk on demand and shared between processes.
+    """
+    path = cache_path(name)
+    if not os.path.exists(path):
+        _materialise(name, path)
+    return np.load(path, mmap_mode='r')
+
+
+def channel(c, name='cells3d'):
+    """Read-only (Z, Y, X) view of one channel of a (Z, C, Y, X) stack, in its native dtype."""
+    return stack(name)[:, c]
+
+
+@functools.lru_cache(maxsize=PLANE_CACHE_SIZE)
+def _float_plane(name, index):
+    img = util.img_as_float(np.asarray(stack(name)[index]))
+    # The same array is handed to every caller, so it must not be modified in place
+    img.flags.writeable = False
+    return img
+
+
+def plane(z, c=None, name='cells3d', as_float=True):
+    """Return one plane of a stack, e.g. ``plane(29, 1)`` for ``data.cells3d()[29, 1, :, :]``.
+
+    With ``as_float=True`` (the default) this is ``util.img_as_float`` of the plane,
+    cached and read-only - use ``.copy()`` if you want to edit the pixels. With
+    ``as_float=False`` the native-dtype memory-mapped view is returned instead.
+    """
+    index = (z,) if c is None else (z, c)
+    if not as_float:
+        return stack(name)[index]
+    return _float_plane(name, index)
+
+
+def clear_cache(remove_files=False):
+    """Forget the in-process caches, and optionally delete the on-disk ``.npy`` files too."""
+    _float_plane.cache_clear()
+    stack.cache_clear()
+    if remove_files and os.path.isdir(CACHE_DIR):
+        for entry in os.listdir(CACHE_DIR):
+            if entry.endswith('.npy'):
+                os.unlink(os.path.join(CACHE_DIR, entry))
@@ -0,0 +1,203 @@
+"""Image gradients computed once, then read as magnitude, components, orientation or thin edges.
+
+Chapter 06 calls ``filters.sobel``, ``filters.sobel_h`` and ``filters.sobel_v`` on the
+same image. Each of them convolves the whole image with a 3 x 3 kernel per axis, so
+the two derivatives are computed three times over, and an orientation or a
+non-maximum suppression would need them again. A :class:`Gradient` computes the
+derivative along each axis once, in float32, and derives everything else from those
+buffers::
+
+    grad = gradients.for_image(img_nuc30_cells3d)
+    magnitude = grad.magnitude()            # filters.sobel
+    rows, cols = grad.components            # filters.sobel_h, filters.sobel_v
+    angle = grad.orientation()
+    edges = grad.suppressed()               # magnitude, zero except on the edge crests
+
+The Sobel, Scharr and Prewitt kernels are separable - a ``[1, 0, -1]`` derivative along
+one axis times a 3-tap smoothing along the others - so each component is a few
+whole-array additions of shifted views of the image, padded once, instead of a full
+3 x 3 (x 3) convolution. Roberts' 2 x 2 diagonal kernels are 2D only. Values, boundary handling and scaling are those of
+``skimage.filters`` (magnitudes are divided by ``sqrt(ndim)``), to within float32
+rounding; every method takes an ``out=`` array to write its result into.
+"""
+
+import math
+
+import numpy as np
+from skimage import util
+
+from ._cache import ImageKeyedCache
+from .convolution import _PADDING
+
+
+# Smoothing applied across the derivative by each separable operator, as in skimage.filters
+SMOOTHING = {
+    'sobel': np.array([1, 2, 1]) / 4,
+    'scharr': np.array([3, 10, 3]) / 16,
+    'prewitt': np.full(3, 1 / 3),
+}
+
+OPERATORS = (*SMOOTHING, 'roberts')
+
+_gradients = ImageKeyedCache()
+
+
+def _as_float32(image):
+    # Floats keep their values, integers are rescaled like img_as_float does
+    image = np.asarray(image)
+    if image.dtype.kind == 'f':
+        return image.astype(np.float32, copy=False)
+    return util.img_as_float32(image)
+
+
+def _pad(image, width, mode, cval):
+    extra = {'constant_values': cval} if mode == 'constant' else {}
+    return np.pad(image, width, mode=_PADDING[mode], **extra)
+
+
+def _shifted(array, axis, start, stop):
+    # View of ``array`` cut to ``start:stop`` along ``axis``
+    index = [slice(None)] * array.ndim
+    index[axis] = slice(start, stop)
+    return array[tuple(index)]
+
+
+def _smooth(array, axis, weights):
+    # 3-tap symmetric filter along ``axis``, dropping the padding pixel at either end
+    before, middle, after = (_shifted(array, axis, start, stop) for start, stop in ((0, -2), (1, -1), (2, None)))
+    result = np.add(before, after)
+    result *= np.float32(weights[0])
+    result += middle * np.float32(weights[1])
+    return result
+
+
+def _derivative(array, axis):
+    # Convolution with [1, 0, -1] along ``axis``: next minus previous pixel
+    return np.subtract(_shifted(array, axis, 2, None), _shifted(array, axis, 0, -2))
+
+
+def _output(out, shape):
+    if out is None:
+        return np.empty(shape, dtype=np.float32)
+    if out.shape != tuple(shape) or out.dtype != np.float32:
+        raise ValueError(f'out must be a float32 array of shape {tuple(shape)}')
+    return out
+
+
+class Gradient:
+    """The derivatives of an image along each axis, and what can be derived from them.
+
+    Parameters
+    ----------
+    image : ndarray
+        Grayscale image. Integer images are rescaled to 0..1 like ``filters.sobel``
+        does; any image is then filtered in float32.
+    operator : {'sobel', 'scharr', 'prewitt', 'roberts'}
+        The derivative kernels. ``'roberts'`` only works on 2D images; its two
+        components are the derivatives along the diagonals.
+    mode, cval :
+        Boundary handling, as in ``skimage.filters``.
+    """
+
+    def __init__(self, image, operator='sobel', mode='reflect', cval=0.0):
+        if operator not in OPERATORS:
+            raise ValueError(f"operator must be one of {', '.join(OPERATORS)}, not {operator!r}")
+        image = _as_float32(image)
+        if operator == 'roberts' and image.ndim != 2:
+            raise ValueError('the Roberts operator only works on 2D images')
+        if mode not in _PADDING:
+            raise ValueError(f"mode must be one of {', '.join(_PADDING)}, not {mode!r}")
+        self.operator = operator
+        self.shape = image.shape
+        if operator == 'roberts':
+            # The 2 x 2 kernels of skimage, centred so that they reach one pixel down and right
+            padded = _pad(image, ((0, 1), (0, 1)), mode, cval)
+            components = [padded[1:, 1:] - padded[:-1, :-1], padded[1:, :-1] - padded[:-1, 1:]]
+        else:
+            padded = _pad(image, 1, mode, cval)
+            components = []
+            for axis in range(image.ndim):
+                # Smooth across the derivative first, then differentiate along it
+                component = padded
+                for other in range(image.ndim):
+                    if other != axis:
+                        component = _smooth(component, other, SMOOTHING[operator])
+                components.append(_derivative(component, axis))
+        for component in components:
+            component.flags.writeable = False
+        self.components = tuple(components)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def component(self, axis, out=None):
+        """The derivative along ``axis`` (``filters.sobel(image, axis=axis)``); for Roberts, along a diagonal."""
+        out = _output(out, self.shape)
+        out[...] = self.components[axis]
+        return out
+
+    def magnitude(self, out=None):
+        """Gradient magnitude, e.g. ``filters.sobel(image)``: the root mean square of the components."""
+        out = _output(out, self.shape)
+        if self.ndim == 2:
+            np.hypot(*self.components, out=out)
+        else:
+            np.square(self.components[0], out=out)
+            for component in self.components[1:]:
+                out += component ** 2
+            np.sqrt(out, out=out)
+        out /= np.float32(math.sqrt(self.ndim))
+        return out
+
+    def _row_col(self):
+        # Derivatives down the rows and along the columns (Roberts' diagonals rotated by 45 degrees)
+        if self.ndim != 2:
+            raise ValueError('orientations are only defined for 2D images')
+        first, second = self.components
+        if self.operator == 'roberts':
+            return first + second, first - second
+        return first, second
+
+    def orientation(self, out=None):
+        """Direction of the gradient in radians, from the column axis towards increasing rows (-pi..pi)."""
+        out = _output(out, self.shape)
+        rows, cols = self._row_col()
+        np.arctan2(rows, cols, out=out)
+        return out
+
+    def suppressed(self, out=None):
+        """Non-maximum suppression: the magnitude where it peaks across the edge, 0 elsewhere.
+
+        Each pixel is compared with its two neighbours along the gradient direction,
+        rounded to a multiple of 45 degrees, as in the first steps of the Canny
+        detector; the result is one-pixel-thin edge crests ready to be thresholded.
+        """
+        out = self.magnitude(out)
+        rows, cols = self._row_col()
+        # Direction sector 0 - 3 for 0, 45, 90 and 135 degrees (opposite directions are the same)
+        sector = np.rint(np.arctan2(rows, cols) * (4 / np.pi)).astype(np.int8) % 4
+        padded = np.pad(out, 1)
+        height, width = self.shape
+        keep = np.zeros(self.shape, dtype=bool)
+        for s, (dr, dc) in enumerate(((0, 1), (1, 1), (1, 0), (1, -1))):
+            ahead = padded[1 + dr:1 + dr + height, 1 + dc:1 + dc + width]
+            behind = padded[1 - dr:1 - dr + height, 1 - dc:1 - dc + width]
+            keep |= (sector == s) & (out >= ahead) & (out >= behind)
+        out[~keep] = 0
+        return out
+
+
+def gradient(image, operator='sobel', mode='reflect', cval=0.0):
+    """The :class:`Gradient` of ``image``, computed now (see :func:`for_image` to share it)."""
+    return Gradient(image, operator, mode, cval)
+
+
+def for_image(image, operator='sobel', mode='reflect', cval=0.0):
+    """Return the :class:`Gradient` of ``image`` for this operator, computing it on first use.
+
+    It is cached on the identity of ``image``, like :func:`.scale_space.for_image`, so
+    the magnitude, components and orientation asked for in different places share
+    the same derivatives.
+    """
+    return _gradients.get(image, ('gradient', operator, mode, cval), lambda: Gradient(image, operator, mode, cval))
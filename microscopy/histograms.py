@@ -0,0 +1,145 @@
+"""Image histograms computed once per image and bin count, and drawn without rescanning the pixels.
+
+``plt.hist(img.flatten(), bins=64)`` copies the image into a new 1D array, bins it,
+and does it all again for the next figure showing the same image - chapters 07 to 09
+draw the same few histograms over and over, on linear and on log axes, and
+``exposure.cumulative_distribution`` bins the image once more for the CDF overlay.
+:func:`histogram` bins an image once per ``(bins, range)`` and remembers the result
+on the image; :func:`hist` hands those precomputed bars to matplotlib, so drawing a
+histogram only ever touches ``bins`` numbers.
+
+Integer images are counted with ``np.bincount`` on their native values (one count
+per grey level, a chunk at a time so no full-size copy is made) and the grey-level
+counts are then gathered into the requested bins. Float images are binned in a
+single ``np.histogram`` pass over a view of the pixels. Either way the bins are the
+ones ``plt.hist`` / ``np.histogram`` would use: ``bins`` equal bins between the
+minimum and the maximum of the image, unless ``range`` is given.
+"""
+
+import numpy as np
+
+from ._cache import ImageKeyedCache
+from .plotting import plt
+
+
+_histograms = ImageKeyedCache()
+
+# Pixels converted to indices at a time when counting integer images
+_CHUNK = 1 << 20
+
+# Integer images spanning more grey levels than this are binned like float images
+_MAX_LEVELS = 1 << 20
+
+
+class Histogram:
+    """Counts of an image in ``len(edges) - 1`` bins, with the derived density and CDF.
+
+    Attributes
+    ----------
+    counts : ndarray of int64
+        Number of pixels in each bin.
+    edges : ndarray
+        Bin edges, as returned by ``np.histogram``.
+    centers : ndarray
+        Bin centers.
+    density : ndarray
+        Counts normalised so that the histogram integrates to 1.
+    cdf : ndarray
+        Cumulative distribution at the bin centers, ending at 1.
+    """
+
+    def __init__(self, counts, edges):
+        self.counts = counts
+        self.edges = edges
+        self.centers = (edges[:-1] + edges[1:]) / 2
+        total = counts.sum()
+        self.density = counts / (total * np.diff(edges))
+        self.cdf = np.cumsum(counts) / total
+
+    def __repr__(self):
+        return f'Histogram(bins={len(self.counts)}, range=({self.edges[0]}, {self.edges[-1]}))'
+
+
+def _level_counts(image):
+    # Count every grey level of an integer image; returns (levels, counts) for the
+    # levels present, or None when the image spans too many levels to count this way
+    flat = image.reshape(-1)
+    if flat.dtype.kind == 'u' and flat.dtype.itemsize <= 2:
+        offset, length = 0, 1 << (8 * flat.dtype.itemsize)
+    else:
+        offset, top = int(flat.min()), int(flat.max())
+        length = top - offset + 1
+        if length > _MAX_LEVELS:
+            return None
+    counts = np.zeros(length, dtype=np.int64)
+    for start in range(0, flat.size, _CHUNK):
+        chunk = flat[start:start + _CHUNK].astype(np.intp)
+        if offset:
+            chunk -= offset
+        counts += np.bincount(chunk, minlength=length)
+    present = np.flatnonzero(counts)
+    return present + offset, counts[present]
+
+
+def _compute(image, bins, range):
+    if image.size == 0:
+        raise ValueError('Cannot compute the histogram of an empty image')
+    if np.issubdtype(image.dtype, np.integer):
+        levels = _level_counts(image)
+        if levels is not None:
+            levels, level_counts = levels
+            if range is None:
+                range = (levels[0], levels[-1])
+            # Same binning as np.histogram of the pixels, done on one value per grey level
+            counts, edges = np.histogram(levels, bins, range, weights=level_counts)
+            return Histogram(np.rint(counts).astype(np.int64), edges)
+    # ravel() is a view for contiguous images, so nothing is copied
+    counts, edges = np.histogram(image.ravel(), bins, range)
+    return Histogram(counts.astype(np.int64), edges)
+
+
+def histogram(image, bins=64, range=None):
+    """(Memoised) :class:`Histogram` of ``image``.
+
+    Parameters
+    ----------
+    image : ndarray
+        Image of any shape. It must not be modified once its histogram is cached.
+    bins : int
+        Number of equal-width bins.
+    range : (float, float), optional
+        Lower and upper edges of the bins; defaults to the minimum and maximum of the image.
+
+    Examples
+    --------
+    >>> h = histogram(img_mitosis, bins=64)
+    >>> h.counts.sum() == img_mitosis.size
+    True
+    """
+    range = None if range is None else tuple(range)
+    return _histograms.get(image, ('histogram', bins, range), lambda: _compute(image, bins, range))
+
+
+def cumulative_distribution(image, nbins=256):
+    """``(cdf, bin_centers)`` of ``image``, like ``exposure.cumulative_distribution``.
+
+    The result comes from the memoised :func:`histogram`, so a histogram and its CDF
+    drawn with the same number of bins share a single pass over the pixels. For
+    float images it equals ``exposure.cumulative_distribution``; integer images get
+    ``nbins`` bins rather than one bin per grey level.
+    """
+    h = histogram(image, nbins)
+    return h.cdf, h.centers
+
+
+def hist(image, bins=64, range=None, density=False, log=False, ax=None, **kwargs):
+    """Draw the histogram of ``image`` like ``plt.hist(image.flatten(), ...)``, from the memoised counts.
+
+    Extra keyword arguments go to ``Axes.hist``. Returns what ``Axes.hist`` returns,
+    ``(n, bins, patches)``.
+    """
+    if ax is None:
+        ax = plt.gca()
+    h = histogram(image, bins, range)
+    # One weighted sample per bin gives exactly the bars of the full histogram
+    return ax.hist(h.centers, bins=h.edges, weights=h.counts, density=density, log=log, **kwargs)
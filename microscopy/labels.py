@@ -0,0 +1,229 @@
+"""Helpers for working with label images, such as the output of ``measure.label``.
+
+Colouring every object by one of its properties is a lookup: build a table with the
+value of object ``k`` at index ``k`` and index it with the label image. That is a
+single gather over the pixels, however many objects there are, instead of one
+full-image pass (and one temporary mask) per object. :class:`SparseLabels` goes the
+other way: it keeps every object as the mask cropped to its bounding box, so one
+object can be looked at or measured without touching the rest of the image.
+"""
+
+import numpy as np
+
+
+def _lookup_table(labeled, values, labels, background):
+    values = np.asarray(values)
+    if labels is None:
+        labels = np.arange(1, len(values) + 1)
+    else:
+        labels = np.asarray(labels)
+    if len(labels) != len(values):
+        raise ValueError(f'Got {len(values)} values for {len(labels)} labels')
+    if len(labels) and labels.min() < 0:
+        raise ValueError('Labels must be non-negative integers')
+    n_labels = max(int(labeled.max()) if labeled.size else 0, int(labels.max()) if len(labels) else 0)
+    dtype = np.result_type(values.dtype, np.min_scalar_type(background))
+    lut = np.full((n_labels + 1,) + values.shape[1:], background, dtype=dtype)
+    lut[labels] = values
+    lut[0] = background
+    return lut
+
+
+def paint_labels(labeled, values, labels=None, background=0):
+    """Return an image where each object of ``labeled`` is filled with its property value.
+
+    Parameters
+    ----------
+    labeled : ndarray of int
+        Label image, 0 being the background.
+    values : sequence
+        One value per object. By default ``values[k - 1]`` belongs to label ``k``,
+        which is the order ``measure.regionprops`` returns the objects in.
+    labels : sequence of int, optional
+        The label each entry of ``values`` belongs to, if they are not ``1..N``.
+        Labels without a value are painted with ``background``.
+    background : scalar
+        Value for the background and for unlisted labels.
+
+    Examples
+    --------
+    >>> areas = [prop.area for prop in measure.regionprops(labeled)]
+    >>> img_areas = paint_labels(labeled, areas)
+    """
+    return _lookup_table(labeled, values, labels, background)[labeled]
+
+
+def paint_labels_many(labeled, values, labels=None, background=0):
+    """Paint several properties at once, sharing a single gather over the label image.
+
+    ``values`` maps a property name to its per-object values (same ordering rules as
+    :func:`paint_labels`) and the result maps each name to its painted image.
+    """
+    names = list(values)
+    if not names:
+        return {}
+    table = np.stack([np.asarray(values[name]) for name in names], axis=-1)
+    painted = _lookup_table(labeled, table, labels, background)[labeled]
+    return {name: painted[..., i] for i, name in enumerate(names)}
+
+
+class SparseLabels:
+    """The objects of a label image, each stored as its bounding box and its mask cropped to it.
+
+    Looking at or measuring one object with ``labeled == k`` builds a mask the size
+    of the whole image, and a label image costs its full size however few pixels
+    the objects cover. Here the memory is that of the objects' bounding boxes (one
+    byte per pixel, all the crops in a single buffer), and anything about one object
+    - its mask, its pixel coordinates, the intensities under it - costs the size of
+    that object only::
+
+        nuclei = labels.SparseLabels.from_dense(img_nuc30_labeled)
+        nuclei.mask(14)                                # cropped to nuclei.bbox(14)
+        nuclei.intensity(14, img_nuc30_cells3d)        # the intensities of nucleus 14
+        labeled = nuclei.to_dense()                    # back to a label image
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the label image.
+    labels : sequence of int
+        Label of each object, in increasing order.
+    bboxes : array of int, shape (N, 2 * ndim)
+        Bounding box of each object as in ``regionprops``: the first pixel along each
+        axis, then the pixel past the last one.
+    masks : sequence of ndarray of bool
+        Mask of each object, cropped to its bounding box.
+    """
+
+    def __init__(self, shape, labels, bboxes, masks):
+        self._layout(shape, labels, bboxes)
+        if len(masks) != len(self.labels):
+            raise ValueError(f'Got {len(masks)} masks for {len(self.labels)} labels')
+        buffer = np.empty(self._offsets[-1], dtype=bool)
+        for i, mask in enumerate(masks):
+            if mask.shape != tuple(self._extents[i]):
+                raise ValueError(f'The mask of label {self.labels[i]} does not have the shape of its bounding box')
+            buffer[self._offsets[i]:self._offsets[i + 1]] = mask.ravel()
+        self._store(buffer)
+
+    def _layout(self, shape, labels, bboxes):
+        # Shape of every crop, and where it starts in the buffer
+        self.shape = tuple(shape)
+        self.labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        self.bboxes = np.asarray(bboxes, dtype=np.int64).reshape(len(self.labels), 2 * self.ndim)
+        if np.any(np.diff(self.labels) <= 0):
+            raise ValueError('Labels must be in increasing order')
+        self._extents = self.bboxes[:, self.ndim:] - self.bboxes[:, :self.ndim]
+        self._offsets = np.zeros(len(self.labels) + 1, dtype=np.int64)
+        np.cumsum(np.prod(self._extents, axis=1), out=self._offsets[1:])
+
+    def _store(self, buffer):
+        buffer.flags.writeable = False
+        self._buffer = buffer
+        self.areas = np.add.reduceat(buffer, self._offsets[:-1]) if len(self.labels) else np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def from_dense(cls, labeled):
+        """Sparse copy of the label image ``labeled``, in one vectorised pass over its object pixels."""
+        labeled = np.asarray(labeled)
+        ndim = labeled.ndim
+        index = np.flatnonzero(labeled)
+        values = labeled.ravel()[index]
+        if len(values) and 0 < values.min() and values.max() <= labeled.size:
+            # Labels no larger than the image, as measure.label makes them: a lookup table instead of a sort
+            counts = np.bincount(values)
+            present = np.flatnonzero(counts)
+            lookup = np.zeros(len(counts), dtype=np.int64)
+            lookup[present] = np.arange(len(present))
+            objects = lookup[values]
+        else:
+            present, objects = np.unique(values, return_inverse=True)
+        del values
+        coordinates = np.unravel_index(index, labeled.shape)
+        del index
+        bboxes = np.empty((len(present), 2 * ndim), dtype=np.int64)
+        bboxes[:, :ndim] = np.iinfo(np.int64).max
+        bboxes[:, ndim:] = 0
+        for axis, coordinate in enumerate(coordinates):
+            np.minimum.at(bboxes[:, axis], objects, coordinate)
+            np.maximum.at(bboxes[:, ndim + axis], objects, coordinate + 1)
+        sparse = cls.__new__(cls)
+        sparse._layout(labeled.shape, present, bboxes)
+        # Every object pixel goes to its crop's start in the buffer plus its flat index in the crop
+        position = sparse._offsets[objects]
+        crop_stride = np.ones(len(objects), dtype=np.int64)
+        for axis in reversed(range(ndim)):
+            coordinate = coordinates[axis] - bboxes[objects, axis]
+            coordinate *= crop_stride
+            position += coordinate
+            crop_stride *= sparse._extents[objects, axis]
+        buffer = np.zeros(sparse._offsets[-1], dtype=bool)
+        buffer[position] = True
+        sparse._store(buffer)
+        return sparse
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return self._buffer.nbytes + self.labels.nbytes + self.bboxes.nbytes + self._offsets.nbytes + self.areas.nbytes
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        i = np.searchsorted(self.labels, label)
+        return i < len(self.labels) and self.labels[i] == label
+
+    def _index(self, label):
+        if label not in self:
+            raise KeyError(label)
+        return int(np.searchsorted(self.labels, label))
+
+    def bbox(self, label):
+        """Slices of the bounding box of ``label``, to crop any image of the same shape."""
+        i = self._index(label)
+        return tuple(slice(start, stop) for start, stop in zip(self.bboxes[i, :self.ndim], self.bboxes[i, self.ndim:]))
+
+    def mask(self, label):
+        """Mask of ``label`` cropped to :meth:`bbox` (read-only)."""
+        i = self._index(label)
+        return self._buffer[self._offsets[i]:self._offsets[i + 1]].reshape(self._extents[i])
+
+    def coords(self, label):
+        """Coordinates of the pixels of ``label`` in the whole image, one row per pixel (like ``regionprops``)."""
+        i = self._index(label)
+        return np.argwhere(self.mask(label)) + self.bboxes[i, :self.ndim]
+
+    def intensity(self, label, image):
+        """Values of ``image`` under ``label``, in raster order (extra trailing axes, e.g. channels, are kept)."""
+        return np.asarray(image[self.bbox(label)])[self.mask(label)]
+
+    def to_dense(self, dtype=None, out=None):
+        """The label image, written in one vectorised pass over the objects' pixels.
+
+        The result has the smallest unsigned dtype holding the largest label unless
+        ``dtype`` is given; ``out`` is an array to write it into instead.
+        """
+        if out is None:
+            largest = int(self.labels[-1]) if len(self.labels) else 0
+            out = np.zeros(self.shape, dtype=dtype or np.min_scalar_type(largest))
+        else:
+            out[...] = 0
+        # Position of every object pixel in its crop, then in the whole image: the flat index of
+        # the crop's first pixel plus the pixel's coordinates in the crop times the image strides
+        objects = np.repeat(np.arange(len(self.labels)), self.areas)
+        local = np.flatnonzero(self._buffer)
+        local -= self._offsets[objects]
+        strides = np.cumprod((1,) + self.shape[:0:-1])[::-1]
+        index = (self.bboxes[:, :self.ndim] @ strides)[objects]
+        for axis in reversed(range(1, self.ndim)):
+            local, coordinate = np.divmod(local, self._extents[objects, axis])
+            coordinate *= strides[axis]
+            index += coordinate
+        local *= strides[0]
+        index += local
+        np.put(out, index, self.labels[objects])
+        return out
@@ -0,0 +1,169 @@
+"""Local (adaptive) thresholds for any window size, from summed-area tables built once.
+
+``filters.threshold_niblack`` and ``filters.threshold_sauvola`` pad the image and
+build integral images of ``I`` and ``I**2`` on every call, so sweeping the window
+size - which chapter 09 invites you to do - redoes all of that work each time.
+:class:`LocalThresholds` pads the image once (wide enough for the largest window
+asked for so far), builds both tables once, and then evaluates the local mean and
+standard deviation of any window in O(1) per pixel with eight (in 3D) or four (in
+2D) table lookups. Integer images get exact int64 tables, float images float64.
+
+With the default ``mode='reflect'`` the borders are handled exactly like in
+``threshold_niblack`` / ``threshold_sauvola``; ``mode='symmetric'`` matches the
+``'reflect'`` mode of ``scipy.ndimage`` used by ``threshold_local``.
+"""
+
+import itertools
+import math
+
+import numpy as np
+from skimage.util import dtype_limits
+
+from ._cache import ImageKeyedCache
+
+
+METHODS = ('niblack', 'sauvola', 'phansalkar', 'mean')
+
+_tables = ImageKeyedCache()
+
+
+def _window(window, ndim):
+    window = (window,) * ndim if np.isscalar(window) else tuple(window)
+    if len(window) != ndim or any(w < 1 or w % 2 == 0 for w in window):
+        raise ValueError(f'Window size must be an odd integer or {ndim} odd integers, got {window}')
+    return window
+
+
+class LocalThresholds:
+    """Summed-area tables of an image and of its square, shared by all local threshold methods.
+
+    Parameters
+    ----------
+    image : ndarray
+        Grayscale image, 2D or more.
+    mode : str
+        ``np.pad`` mode used past the image borders.
+    """
+
+    def __init__(self, image, mode='reflect'):
+        self.image = np.asarray(image)
+        self.mode = mode
+        self._margin = -1
+        self._integral = self._integral_sq = None
+
+    def _tables_for(self, window):
+        # Rebuild the tables (once) with a wider margin if this window is the largest so far
+        margin = max(w // 2 for w in window)
+        if margin > self._margin:
+            margin = max(margin, 2 * self._margin)
+            exact = np.issubdtype(self.image.dtype, np.integer)
+            dtype = np.int64 if exact else np.float64
+            padded = np.pad(self.image.astype(dtype), margin, mode=self.mode)
+            self._integral = self._integral_image(padded)
+            padded *= padded
+            self._integral_sq = self._integral_image(padded)
+            self._margin = margin
+        return self._integral, self._integral_sq
+
+    @staticmethod
+    def _integral_image(padded):
+        # Summed-area table with a leading row/column of zeros, so no window needs special-casing
+        table = np.zeros(tuple(n + 1 for n in padded.shape), dtype=padded.dtype)
+        table[(slice(1, None),) * padded.ndim] = padded
+        for axis in range(padded.ndim):
+            np.cumsum(table, axis=axis, out=table)
+        return table
+
+    def _box_sum(self, table, window):
+        result = None
+        shape = self.image.shape
+        for corner in itertools.product((0, 1), repeat=len(shape)):
+            index = tuple(
+                slice(self._margin + w // 2 + 1, self._margin + w // 2 + 1 + n) if c
+                else slice(self._margin - w // 2, self._margin - w // 2 + n)
+                for c, w, n in zip(corner, window, shape)
+            )
+            # Inclusion-exclusion: corners with an odd number of "low" ends are subtracted
+            term = -table[index] if (len(shape) - sum(corner)) % 2 else table[index]
+            result = term if result is None else result + term
+        return result
+
+    def mean_std(self, window):
+        """Local mean and standard deviation over a ``window`` (odd size, or one odd size per axis)."""
+        window = _window(window, self.image.ndim)
+        integral, integral_sq = self._tables_for(window)
+        area = math.prod(window)
+        m = self._box_sum(integral, window) / area
+        g2 = self._box_sum(integral_sq, window) / area
+        # Rounding can make g2 a hair smaller than m**2 on flat areas
+        s = np.sqrt(np.clip(g2 - m * m, 0, None))
+        return m, s
+
+    def _range(self):
+        imin, imax = dtype_limits(self.image, clip_negative=False)
+        return imax - imin
+
+    def threshold(self, method, window, k=None, **params):
+        """Threshold image of ``method`` for one window size.
+
+        ``method`` is one of ``'niblack'`` (``m - k s``, k = 0.2), ``'sauvola'``
+        (``m (1 + k (s / r - 1))``, k = 0.2, r = half the dtype range),
+        ``'phansalkar'`` (``m (1 + p exp(-q m) + k (s / r - 1))`` on intensities
+        scaled to 0..1, k = 0.25, r = 0.5, p = 2, q = 10) or ``'mean'``
+        (``m - offset``, offset = 0).
+        """
+        m, s = self.mean_std(window)
+        return self._apply(method, m, s, k, params)
+
+    def _apply(self, method, m, s, k, params):
+        if method == 'niblack':
+            return m - (0.2 if k is None else k) * s
+        if method == 'sauvola':
+            r = params.get('r') or 0.5 * self._range()
+            return m * (1 + (0.2 if k is None else k) * (s / r - 1))
+        if method == 'phansalkar':
+            # Defined for intensities between 0 and 1
+            scale = np.iinfo(self.image.dtype).max if np.issubdtype(self.image.dtype, np.integer) else 1
+            k = 0.25 if k is None else k
+            r, p, q = params.get('r', 0.5), params.get('p', 2), params.get('q', 10)
+            m_scaled, s_scaled = m / scale, s / scale
+            return scale * m_scaled * (1 + p * np.exp(-q * m_scaled) + k * (s_scaled / r - 1))
+        if method == 'mean':
+            return m - params.get('offset', 0)
+        raise ValueError(f'Unknown local threshold method {method!r}, expected one of {METHODS}')
+
+    def niblack(self, window, k=0.2):
+        return self.threshold('niblack', window, k)
+
+    def sauvola(self, window, k=0.2, r=None):
+        return self.threshold('sauvola', window, k, r=r)
+
+    def phansalkar(self, window, k=0.25, r=0.5, p=2, q=10):
+        return self.threshold('phansalkar', window, k, r=r, p=p, q=q)
+
+    def local_mean(self, window, offset=0):
+        return self.threshold('mean', window, offset=offset)
+
+    def sweep(self, method, windows, ks=(None,), **params):
+        """Masks ``image > threshold`` for every combination of window size and ``k``.
+
+        The local statistics are computed once per window and shared by all the
+        ``k`` values. Returns a dict keyed by ``(window, k)``.
+
+        Examples
+        --------
+        >>> masks = for_image(img_page).sweep('niblack', windows=(15, 35, 55), ks=(0.1, 0.2))
+        >>> masks[35, 0.2].shape == img_page.shape
+        True
+        """
+        masks = {}
+        for window in windows:
+            m, s = self.mean_std(window)
+            for k in ks:
+                masks[window, k] = self.image > self._apply(method, m, s, k, params)
+        return masks
+
+
+def for_image(image, mode='reflect'):
+    """Return the (memoised) :class:`LocalThresholds` of ``image``."""
+    return _tables.get(image, ('local_thresholds', mode), lambda: LocalThresholds(image, mode))
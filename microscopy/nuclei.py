@@ -0,0 +1,282 @@
+"""The nuclei segmentation pipeline of chapters 10 and 11, and a command line to run it on many images.
+
+Chapter 10 builds the pipeline step by step and chapter 11 measures its output:
+Otsu threshold of the Gaussian-blurred image, area closing, median filter, area
+opening, median filter again, labelling and measurement. :func:`segment` and
+:func:`measure_nuclei` are that exact chain, so a whole plate of fields can go
+through it from the command line::
+
+    python -m microscopy.nuclei plate/*.tif -o nuclei.csv --workers 8 --labels-dir labels
+
+Inputs can be files, directories (every TIFF/PNG inside) or glob patterns. Images are
+processed on a process pool; the measurements of each image are appended to a single
+CSV (or Parquet, with ``pyarrow``) file as soon as it is done, one row per nucleus
+with the image path in the first column, and the run ends with images/s and
+objects/s. The label images saved with ``--labels-dir`` keep the subfolders of the
+images. An image that cannot be read or segmented is reported and skipped. With
+``--profile trace.json`` every stage of the pipeline is timed in every worker (see
+:mod:`microscopy.profiling`): a summary table is printed at the end and the stages
+are written as a Chrome trace.
+"""
+
+import argparse
+import contextlib
+import csv
+import glob
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from skimage import filters, io, measure, util
+
+from . import binary, component_trees, measurements, profiling
+
+
+AREA_THRESHOLD = 300
+
+PROPERTIES = (
+    'label', 'area', 'centroid', 'bbox', 'intensity_mean', 'intensity_max',
+    'axis_major_length', 'axis_minor_length', 'eccentricity', 'orientation',
+)
+
+EXTENSIONS = ('.tif', '.tiff', '.png')
+
+
+@profiling.profiled
+def segment(image, area_threshold=AREA_THRESHOLD, sigma=1):
+    """Label image of the nuclei in a 2D fluorescence ``image``, as in chapters 10 and 11."""
+    image = util.img_as_float(image)
+    with profiling.stage('otsu threshold', image) as step:
+        mask = step.output(image > filters.threshold_otsu(filters.gaussian(image, sigma=sigma)))
+    # Fill the holes, smooth the outlines, then remove the small bright spots
+    # (np.ones((n, n)) is morphology.square(n); binary.median is filters.median for masks, by majority vote;
+    # the area filters are morphology.area_closing / area_opening, with the component tree of a mask made by labelling it)
+    with profiling.stage('area closing', mask) as step:
+        mask = step.output(component_trees.ComponentTree(mask, connectivity=1, kind='min').filter(area_threshold))
+    with profiling.stage('median 4x4', mask) as step:
+        mask = step.output(binary.median(mask, np.ones((4, 4), dtype=bool)))
+    with profiling.stage('area opening', mask) as step:
+        mask = step.output(component_trees.ComponentTree(mask, connectivity=1, kind='max').filter(area_threshold))
+    with profiling.stage('median 3x3', mask) as step:
+        mask = step.output(binary.median(mask, np.ones((3, 3), dtype=bool)))
+    with profiling.stage('label', mask) as step:
+        return step.output(measure.label(mask))
+
+
+@profiling.profiled
+def measure_nuclei(image, properties=PROPERTIES, area_threshold=AREA_THRESHOLD, sigma=1):
+    """Segment ``image`` and measure its nuclei; returns ``(label_image, columns)``."""
+    labeled = segment(image, area_threshold, sigma)
+    with profiling.stage('regionprops', labeled) as step:
+        columns = measurements.regionprops_columns(labeled, util.img_as_float(image), properties)
+        step.output(*columns.values())
+    return labeled, columns
+
+
+def find_images(inputs, extensions=EXTENSIONS):
+    """Image files named by ``inputs``: files, directories (searched recursively) or glob patterns."""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(extensions))
+        elif os.path.isfile(item):
+            paths.append(item)
+        else:
+            paths.extend(p for p in sorted(glob.glob(item, recursive=True)) if p.lower().endswith(extensions))
+    return paths
+
+
+def _read(path, channel):
+    image = io.imread(path)
+    if channel is not None:
+        image = image[..., channel]
+    if image.ndim != 2:
+        raise ValueError(f'expected a 2D image, got shape {image.shape}; choose a channel with --channel')
+    return image
+
+
+def label_paths(paths, labels_dir):
+    """Where to save the label image of each of ``paths``: under ``labels_dir``, in the same folders as the images.
+
+    The folders are taken relative to the deepest folder holding all the images, so
+    ``A01/field1.tif`` and ``A02/field1.tif`` give ``A01/field1_labels.tif`` and
+    ``A02/field1_labels.tif``. Raises ``ValueError`` if two images would still share a
+    label file (the same image twice, or ``field1.tif`` next to ``field1.png``).
+    """
+    if not paths:
+        return []
+    paths = [os.path.abspath(path) for path in paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    names = [os.path.join(labels_dir, os.path.splitext(os.path.relpath(path, root))[0] + '_labels.tif')
+             for path in paths]
+    owners = {}
+    for path, name in zip(paths, names):
+        key = os.path.normcase(name)
+        if key in owners:
+            raise ValueError(f'{owners[key]} and {path} would both save their labels to {name}')
+        owners[key] = path
+    return names
+
+
+def _process(path, labels_path, channel, properties, area_threshold, sigma, profile):
+    # Runs in the worker processes: everything is done there, only the measurements
+    # (and the profiled stages) come back
+    recording = profiling.recording(profile != 'time') if profile else contextlib.nullcontext()
+    with recording, profiling.capture() as stages:
+        try:
+            with profiling.stage('read', path) as step:
+                image = step.output(_read(path, channel))
+            labeled, columns = measure_nuclei(image, properties, area_threshold, sigma)
+            if labels_path is not None:
+                with profiling.stage('save labels', labeled):
+                    os.makedirs(os.path.dirname(labels_path), exist_ok=True)
+                    io.imsave(labels_path, labeled.astype(np.uint32), check_contrast=False)
+            result = path, columns, int(labeled.max()), None
+        except Exception as e:
+            result = path, None, 0, f'{type(e).__name__}: {e}'
+    return (*result, stages)
+
+
+class _CsvWriter:
+
+    def __init__(self, path):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._header = None
+
+    def write(self, columns):
+        if self._header is None:
+            self._header = list(columns)
+            self._writer.writerow(self._header)
+        self._writer.writerows(zip(*(columns[name].tolist() for name in self._header)))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter:
+
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Writing Parquet files needs pyarrow; use a .csv output or install pyarrow') from None
+        self._pa = pyarrow
+        self._path = path
+        self._writer = None
+
+    def write(self, columns):
+        # One row group per image
+        table = self._pa.table(columns)
+        if self._writer is None:
+            self._writer = self._pa.parquet.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table.cast(self._writer.schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def run(paths, output, properties=PROPERTIES, n_workers=None, labels_dir=None, channel=None,
+        area_threshold=AREA_THRESHOLD, sigma=1, verbose=True, profile=None):
+    """Segment and measure every image in ``paths``, streaming the measurements to ``output``.
+
+    ``output`` ends in ``.csv`` or ``.parquet``. The label images are saved under
+    ``labels_dir``, if given, as laid out by :func:`label_paths`. With ``verbose`` one line is printed
+    per image. With ``profile`` (``'memory'`` or ``'time'``, to skip ``tracemalloc``)
+    the stages of every image are recorded, in whichever process ran them, and added
+    to :func:`microscopy.profiling.events`. Returns a dict with the numbers of images,
+    failed images and objects, and the elapsed time in seconds.
+    """
+    if not paths:
+        raise ValueError('No images to process')
+    properties = tuple(properties)
+    if 'label' not in properties:
+        properties = ('label',) + properties
+    # Check that no two images share a label file before anything is written
+    labels = label_paths(paths, labels_dir) if labels_dir is not None else [None] * len(paths)
+    writer = _ParquetWriter(output) if output.lower().endswith('.parquet') else _CsvWriter(output)
+    # The stages are recorded by whichever process runs them, then added here
+    options = (channel, properties, area_threshold, sigma, profile)
+
+    stats = {'images': 0, 'failed': 0, 'objects': 0}
+
+    def collect(path, columns, n_objects, error, stages):
+        profiling.add(stages)
+        stats['images'] += 1
+        if error is not None:
+            stats['failed'] += 1
+            print(f'Skipping {path}: {error}', file=sys.stderr)
+            return
+        stats['objects'] += n_objects
+        if n_objects:
+            writer.write({'image': np.full(n_objects, path, dtype=object), **columns})
+        if verbose:
+            print(f'[{stats["images"]}/{len(paths)}] {path}: {n_objects} nuclei')
+
+    start = time.perf_counter()
+    try:
+        if n_workers is not None and n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                # A few images per worker in flight, so memory stays bounded on large plates
+                pending = set()
+                for path, labels_path in zip(paths, labels):
+                    if len(pending) >= 2 * n_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            collect(*future.result())
+                    pending.add(pool.submit(_process, path, labels_path, *options))
+                for future in wait(pending).done:
+                    collect(*future.result())
+        else:
+            for path, labels_path in zip(paths, labels):
+                collect(*_process(path, labels_path, *options))
+    finally:
+        writer.close()
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def report(stats):
+    """One-line throughput summary of the ``stats`` returned by :func:`run`."""
+    seconds = max(stats['seconds'], 1e-9)
+    return (f'{stats["images"]} images ({stats["failed"]} failed), {stats["objects"]} nuclei '
+            f'in {stats["seconds"]:.1f} s: {stats["images"] / seconds:.2f} images/s, '
+            f'{stats["objects"] / seconds:.1f} objects/s')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Segment and measure the nuclei of many images.')
+    parser.add_argument('inputs', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-o', '--output', required=True, help='measurements file, .csv or .parquet')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('--labels-dir', help='also save the label images (as TIFF) in this folder, '
+                        'in the same subfolders as the images')
+    parser.add_argument('--channel', type=int, help='channel to segment in multichannel images (last axis)')
+    parser.add_argument('--area-threshold', type=int, default=AREA_THRESHOLD,
+                        help='largest hole filled / spot removed, in pixels')
+    parser.add_argument('--sigma', type=float, default=1, help='Gaussian blur before Otsu thresholding')
+    parser.add_argument('--properties', nargs='+', default=PROPERTIES, help='regionprops properties to measure')
+    parser.add_argument('--profile', metavar='TRACE', help='time every stage, print a summary and write a Chrome trace '
+                        '(JSON, for chrome://tracing or ui.perfetto.dev) to this file')
+    parser.add_argument('--profile-memory', action='store_true', help='with --profile, also trace the memory allocated')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the final report')
+    args = parser.parse_args(argv)
+
+    paths = find_images(args.inputs)
+    profile = None if args.profile is None else 'memory' if args.profile_memory else 'time'
+    stats = run(paths, args.output, args.properties, args.workers, args.labels_dir, args.channel,
+                args.area_threshold, args.sigma, verbose=not args.quiet, profile=profile)
+    print(report(stats))
+    if profile is not None:
+        print(profiling.summary())
+        profiling.write_trace(args.profile)
+
+
+if __name__ == '__main__':
+    main()
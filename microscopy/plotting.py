@@ -0,0 +1,150 @@
+"""Lazily imported plotting modules, which can be switched off or sent to files.
+
+The chapters draw dozens of figures and never close them; run as a batch job that
+means importing matplotlib (and plotly in chapter 03) before any computation starts,
+and keeping hundreds of MB of figures alive until the end. The chapters therefore get
+their plotting modules from here, as proxies that import the real module only when
+it is first used, and that behave according to the current mode:
+
+``'interactive'`` (default)
+    The proxies forward everything to ``matplotlib.pyplot``, ``matplotlib.patches``
+    and plotly, exactly as if the chapter imported them itself.
+``'headless'``
+    Nothing is imported and nothing is drawn: every plotting call returns a no-op
+    object, so only the computations run.
+``'files'``
+    matplotlib runs on the Agg backend and every figure is saved as a PNG file and
+    closed as soon as the next one is started (and by :func:`save_figures`); plotly
+    figures are skipped.
+
+The mode comes from the ``MICROSCOPY_PLOTS`` environment variable, or from
+:func:`set_mode`; ``microscopy.batch`` sets it for you.
+"""
+
+import importlib
+import os
+import sys
+
+
+MODES = ('interactive', 'headless', 'files')
+
+_state = {
+    'mode': os.environ.get('MICROSCOPY_PLOTS', 'interactive'),
+    'output_dir': os.environ.get('MICROSCOPY_FIGURES_DIR', 'figures'),
+    'prefix': 'figure',
+    'count': 0,
+}
+
+# pyplot functions that start a new figure; in 'files' mode the previous ones are saved first
+_NEW_FIGURE = ('figure', 'subplots', 'subplot_mosaic')
+
+
+def set_mode(mode, output_dir=None, prefix=None):
+    """Switch to ``mode`` (one of ``MODES``); in ``'files'`` mode figures go to ``output_dir/prefix-NNN.png``."""
+    if mode not in MODES:
+        raise ValueError(f'Unknown plotting mode {mode!r}, expected one of {MODES}')
+    if _state['mode'] == 'files':
+        save_figures()
+    _state['mode'] = mode
+    if output_dir is not None:
+        _state['output_dir'] = output_dir
+    if prefix is not None:
+        _state['prefix'] = prefix
+        _state['count'] = 0
+
+
+def get_mode():
+    return _state['mode']
+
+
+def enabled():
+    """Whether plotting calls draw anything at all."""
+    return _state['mode'] != 'headless'
+
+
+def save_figures():
+    """In ``'files'`` mode, save every open matplotlib figure and close it. Returns the file names."""
+    if _state['mode'] != 'files' or 'matplotlib.pyplot' not in sys.modules:
+        return []
+    pyplot = sys.modules['matplotlib.pyplot']
+    os.makedirs(_state['output_dir'], exist_ok=True)
+    paths = []
+    for number in pyplot.get_fignums():
+        _state['count'] += 1
+        path = os.path.join(_state['output_dir'], f"{_state['prefix']}-{_state['count']:03d}.png")
+        figure = pyplot.figure(number)
+        figure.savefig(path)
+        pyplot.close(figure)
+        paths.append(path)
+    return paths
+
+
+class _Null:
+    """Stands in for any plotting object when plotting is off: every call, attribute and item is itself."""
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __getattr__(self, name):
+        return self
+
+    def __getitem__(self, key):
+        return self
+
+    def __setitem__(self, key, value):
+        pass
+
+    def __iter__(self):
+        return iter(())
+
+    def __repr__(self):
+        return '<plotting disabled>'
+
+
+_NULL = _Null()
+
+
+class _LazyModule:
+    """Module proxy importing ``name`` on first use; ``files=False`` modules are skipped in ``'files'`` mode."""
+
+    def __init__(self, name, files=True):
+        self._name = name
+        self._files = files
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            if _state['mode'] == 'files' and self._name.startswith('matplotlib'):
+                import matplotlib
+                if 'matplotlib.pyplot' in sys.modules:
+                    sys.modules['matplotlib.pyplot'].switch_backend('Agg')
+                else:
+                    matplotlib.use('Agg')
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        mode = _state['mode']
+        if mode == 'headless' or (mode == 'files' and not self._files):
+            return _NULL
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return f'<lazy module {self._name!r}>'
+
+
+class _Pyplot(_LazyModule):
+
+    def __getattr__(self, attr):
+        if _state['mode'] == 'files':
+            if attr in _NEW_FIGURE:
+                save_figures()
+            elif attr == 'show':
+                return save_figures
+        return super().__getattr__(attr)
+
+
+plt = _Pyplot('matplotlib.pyplot')
+patches = _LazyModule('matplotlib.patches')
+plotly = _LazyModule('plotly', files=False)
+plotly_express = _LazyModule('plotly.express', files=False)
@@ -0,0 +1,285 @@
+"""Per-stage timing and memory records for the pipelines, exported as a Chrome trace.
+
+When a pipeline is slow the first question is which stage the time goes to: in the
+nuclei clean-up chain of chapters 10 and 11 it could be the area closing, either of
+the two median filters or the labelling. The pipelines therefore mark their stages,
+either with the :func:`stage` context manager::
+
+    with profiling.stage('area closing', mask) as step:
+        mask = morphology.area_closing(mask, 300)
+        step.output(mask)
+
+or with the :func:`profiled` decorator, which records the arrays going in and out of
+a function by itself. Each stage records its wall time, the CPU time of the process
+(more than the wall time when numpy or scipy use several threads), the memory
+allocated through ``tracemalloc`` (net and peak, in bytes) and the shapes and dtypes
+of its input and output arrays. Stages can be nested.
+
+Recording is off by default, and then a stage costs one dictionary lookup. Switch it
+on with :func:`enable` (or the ``MICROSCOPY_PROFILE`` environment variable, set to
+``time`` to skip ``tracemalloc``, which slows allocations down noticeably), then
+print :func:`summary` or write a trace with :func:`write_trace` and open it in
+``chrome://tracing`` or https://ui.perfetto.dev::
+
+    profiling.enable()
+    labels = nuclei.segment(image)
+    print(profiling.summary())
+    profiling.write_trace('segment.json')
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+
+_state = {
+    'enabled': os.environ.get('MICROSCOPY_PROFILE', '') not in ('', '0'),
+    'memory': os.environ.get('MICROSCOPY_PROFILE', '') != 'time',
+    'events': [],
+}
+
+# Stages currently open in each thread, innermost last
+_local = threading.local()
+
+
+def enable(memory=True):
+    """Start recording stages; with ``memory`` their allocations are traced too."""
+    _state['enabled'] = True
+    _state['memory'] = memory
+
+
+def disable():
+    """Stop recording; the stages recorded so far are kept."""
+    _state['enabled'] = False
+
+
+def enabled():
+    return _state['enabled']
+
+
+@contextlib.contextmanager
+def recording(memory=True):
+    """Record the stages run inside the block, then go back to the previous setting."""
+    previous = _state['enabled'], _state['memory']
+    enable(memory)
+    try:
+        yield
+    finally:
+        _state['enabled'], _state['memory'] = previous
+
+
+def events():
+    """The stages recorded so far, as dicts, in the order they finished."""
+    return list(_state['events'])
+
+
+def add(recorded):
+    """Append stages recorded elsewhere, e.g. returned by a worker process from :func:`capture`."""
+    _state['events'].extend(recorded)
+
+
+def reset():
+    """Forget every recorded stage."""
+    _state['events'].clear()
+
+
+@contextlib.contextmanager
+def capture():
+    """Move the stages recorded inside the block out of the global record, into the list yielded.
+
+    Worker processes use it to send their stages back to the parent, which :func:`add`\\ s them.
+    """
+    start = len(_state['events'])
+    captured = []
+    try:
+        yield captured
+    finally:
+        captured.extend(_state['events'][start:])
+        del _state['events'][start:]
+
+
+def describe(value):
+    """Short description of the arrays in ``value``: ``'uint8[512, 512]'``, a list of those, or None."""
+    if isinstance(value, np.ndarray):
+        return f'{value.dtype}{list(value.shape)}'
+    if isinstance(value, (tuple, list)):
+        arrays = [describe(v) for v in value if isinstance(v, np.ndarray)]
+        return arrays or None
+    return None
+
+
+class _Stage:
+
+    def __init__(self, name, inputs):
+        self.name = name
+        self.inputs = [d for d in map(describe, inputs) if d is not None]
+        self.outputs = []
+
+    def output(self, *arrays):
+        """Record the arrays the stage produced; returns the first one, for convenience."""
+        self.outputs.extend(d for d in map(describe, arrays) if d is not None)
+        return arrays[0] if arrays else None
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self._memory = _state['memory']
+        # Tracing is started by the outermost stage, and stopped when it ends
+        self._started_tracing = self._memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        if self._memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # The peak of the enclosing stage up to now, before we reset it for ours
+                stack[-1]._peak = max(stack[-1]._peak, peak)
+            tracemalloc.reset_peak()
+            self._start_memory, self._peak = current, current
+        self._depth = len(stack)
+        stack.append(self)
+        self._start_time = time.time()
+        self._start_cpu = time.process_time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._start
+        cpu = time.process_time() - self._start_cpu
+        stack = _local.stack
+        stack.pop()
+        event = {
+            'name': self.name,
+            'start': self._start_time,
+            'wall': wall,
+            'cpu': cpu,
+            'depth': self._depth,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'inputs': self.inputs,
+            'outputs': self.outputs,
+            'allocated': None,
+            'peak': None,
+        }
+        if self._memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(self._peak, peak)
+            event['allocated'] = current - self._start_memory
+            event['peak'] = peak - self._start_memory
+            if stack:
+                stack[-1]._peak = max(stack[-1]._peak, peak)
+            tracemalloc.reset_peak()
+            if self._started_tracing:
+                tracemalloc.stop()
+        _state['events'].append(event)
+        return False
+
+
+class _NullStage:
+
+    def output(self, *arrays):
+        return arrays[0] if arrays else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, *inputs):
+    """Context manager recording the block as stage ``name``, with ``inputs`` as its input arrays.
+
+    Call ``.output(array, ...)`` on the object it yields to record the output arrays.
+    When recording is off it does nothing.
+    """
+    if not _state['enabled']:
+        return _NULL_STAGE
+    return _Stage(name, inputs)
+
+
+def profiled(func=None, *, name=None):
+    """Decorator recording every call of ``func`` as a stage, with its array arguments and results.
+
+    Use it bare (``@profiled``) or with a stage name (``@profiled(name='label')``).
+    """
+    if func is None:
+        return functools.partial(profiled, name=name)
+    stage_name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state['enabled']:
+            return func(*args, **kwargs)
+        with _Stage(stage_name, (*args, *kwargs.values())) as step:
+            result = func(*args, **kwargs)
+            step.output(*(result if isinstance(result, tuple) else (result,)))
+        return result
+    return wrapper
+
+
+def summary(recorded=None):
+    """Table of the time and memory spent in each stage, slowest first.
+
+    Stages with the same name are added up; the share is of the total wall time of the
+    outermost stages. Memory columns are empty when it was not traced.
+    """
+    recorded = events() if recorded is None else recorded
+    if not recorded:
+        return 'No stages recorded'
+    total = sum(e['wall'] for e in recorded if e['depth'] == 0) or 1e-9
+    rows = {}
+    for e in recorded:
+        row = rows.setdefault(e['name'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'allocated': None, 'peak': None})
+        row['calls'] += 1
+        row['wall'] += e['wall']
+        row['cpu'] += e['cpu']
+        if e['peak'] is not None:
+            row['allocated'] = (row['allocated'] or 0) + e['allocated']
+            row['peak'] = max(row['peak'] or 0, e['peak'])
+    width = max(len('stage'), *map(len, rows))
+    lines = [f"{'stage':<{width}} {'calls':>6} {'wall s':>9} {'cpu s':>9} {'share':>6} "
+             f"{'alloc MB':>9} {'peak MB':>9}"]
+    for stage_name, row in sorted(rows.items(), key=lambda item: -item[1]['wall']):
+        allocated, peak = ((f"{row[k] / 2 ** 20:9.1f}" if row[k] is not None else f"{'':>9}")
+                           for k in ('allocated', 'peak'))
+        lines.append(f"{stage_name:<{width}} {row['calls']:>6} {row['wall']:9.3f} {row['cpu']:9.3f} "
+                     f"{100 * row['wall'] / total:5.1f}% {allocated} {peak}")
+    return '\n'.join(lines)
+
+
+def trace(recorded=None):
+    """The recorded stages in the Chrome trace event format, as a dict ready for ``json.dump``."""
+    recorded = events() if recorded is None else recorded
+    trace_events = []
+    for e in recorded:
+        args = {'cpu_ms': round(e['cpu'] * 1e3, 3), 'inputs': e['inputs'], 'outputs': e['outputs']}
+        if e['peak'] is not None:
+            args['allocated_bytes'] = e['allocated']
+            args['peak_bytes'] = e['peak']
+        trace_events.append({
+            'name': e['name'],
+            'ph': 'X',
+            # Wall-clock start, so stages of different processes line up; microseconds
+            'ts': round(e['start'] * 1e6, 1),
+            'dur': round(e['wall'] * 1e6, 1),
+            'pid': e['pid'],
+            'tid': e['tid'],
+            'args': args,
+        })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def write_trace(path, recorded=None):
+    """Write the recorded stages to ``path`` as a Chrome trace / Perfetto JSON file."""
+    with open(path, 'w') as f:
+        json.dump(trace(recorded), f)
@@ -0,0 +1,127 @@
+"""Z projections of image stacks, with every statistic computed in one pass.
+
+Taking a maximum, a minimum and a mean projection with ``np.max`` / ``np.min`` /
+``np.average`` scans the whole stack once per statistic and per channel, usually
+after converting all of it to float64. :func:`project` walks along Z once, a chunk
+of planes at a time, and updates all the requested statistics for all channels
+together, so the stack never has to be in memory (or even exist as one array) and
+the maximum and minimum keep the native dtype of the data.
+"""
+
+import numpy as np
+
+
+STATISTICS = ('max', 'min', 'sum', 'mean', 'std', 'argmax', 'argmin')
+
+
+def _chunks(stack, chunk_size):
+    # Arrays (including memory maps) are sliced; any other iterable yields single planes
+    if isinstance(stack, np.ndarray):
+        for start in range(0, len(stack), chunk_size):
+            yield stack[start:start + chunk_size]
+        return
+    planes = []
+    for plane in stack:
+        planes.append(np.asarray(plane))
+        if len(planes) == chunk_size:
+            yield np.stack(planes)
+            planes = []
+    if planes:
+        yield np.stack(planes)
+
+
+def project(stack, stats=('max', 'min', 'mean'), chunk_size=8):
+    """Project a stack along its first axis, computing several statistics in one pass.
+
+    Parameters
+    ----------
+    stack : ndarray or iterable of ndarray
+        Either a (Z, ...) array - e.g. the (Z, C, Y, X) ``cells3d`` stack or a memory
+        map of it - or any iterable yielding the planes one by one, which lets you
+        project stacks that do not fit in memory (a generator reading one TIFF page
+        at a time, for instance).
+    stats : sequence of str
+        Any of ``'max'``, ``'min'`` (in the input dtype), ``'sum'`` (int64 for
+        integer data, float64 otherwise), ``'mean'``, ``'std'`` (float64, population
+        standard deviation, accumulated with Welford/Chan updates), and
+        ``'argmax'`` / ``'argmin'`` (index of the plane holding the extreme value,
+        first one on ties).
+    chunk_size : int
+        Number of planes processed at a time; memory use is about this many planes
+        in float64 when ``mean`` / ``std`` are requested.
+
+    Returns
+    -------
+    dict of str to ndarray
+        One projection per requested statistic, each with the shape of a plane.
+
+    Examples
+    --------
+    >>> proj = project(datasets.stack('cells3d'), stats=('max', 'mean'))
+    >>> proj['max'].shape
+    (2, 256, 256)
+    """
+    stats = tuple(stats)
+    unknown = set(stats) - set(STATISTICS)
+    if unknown:
+        raise ValueError(f'Unknown statistics {sorted(unknown)}, expected some of {STATISTICS}')
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1')
+
+    need_max = 'max' in stats or 'argmax' in stats
+    need_min = 'min' in stats or 'argmin' in stats
+    need_moments = 'mean' in stats or 'std' in stats
+
+    n = 0
+    result = {}
+    for chunk in _chunks(stack, chunk_size):
+        if not len(chunk):
+            continue
+        # Read each chunk from disk (or a memory map) only once
+        chunk = np.asarray(chunk)
+        if need_max:
+            chunk_arg = np.argmax(chunk, axis=0)
+            chunk_max = np.take_along_axis(chunk, chunk_arg[None], axis=0)[0]
+            if n == 0:
+                result['max'], result['argmax'] = chunk_max, chunk_arg
+            else:
+                # Strictly greater, so that the first plane wins on ties like np.argmax
+                better = chunk_max > result['max']
+                result['max'] = np.where(better, chunk_max, result['max'])
+                result['argmax'] = np.where(better, chunk_arg + n, result['argmax'])
+        if need_min:
+            chunk_arg = np.argmin(chunk, axis=0)
+            chunk_min = np.take_along_axis(chunk, chunk_arg[None], axis=0)[0]
+            if n == 0:
+                result['min'], result['argmin'] = chunk_min, chunk_arg
+            else:
+                better = chunk_min < result['min']
+                result['min'] = np.where(better, chunk_min, result['min'])
+                result['argmin'] = np.where(better, chunk_arg + n, result['argmin'])
+        if 'sum' in stats:
+            dtype = np.int64 if np.issubdtype(chunk.dtype, np.integer) else np.float64
+            chunk_sum = chunk.sum(axis=0, dtype=dtype)
+            result['sum'] = chunk_sum if n == 0 else result['sum'] + chunk_sum
+        if need_moments:
+            # Combine the mean and the sum of squared deviations of this chunk with
+            # the running ones (Chan et al.), which is stable for long stacks
+            m = len(chunk)
+            chunk_mean = chunk.mean(axis=0, dtype=np.float64)
+            if n == 0:
+                mean = chunk_mean
+                m2 = ((chunk - chunk_mean) ** 2).sum(axis=0) if 'std' in stats else None
+            else:
+                delta = chunk_mean - mean
+                mean = mean + delta * (m / (n + m))
+                if 'std' in stats:
+                    chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+                    m2 = m2 + chunk_m2 + delta ** 2 * (n * m / (n + m))
+        n += len(chunk)
+
+    if n == 0:
+        raise ValueError('Cannot project an empty stack')
+    if need_moments:
+        result['mean'] = mean
+        if 'std' in stats:
+            result['std'] = np.sqrt(m2 / n)
+    return {name: result[name] for name in stats}
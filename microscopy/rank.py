@@ -0,0 +1,350 @@
+"""Rank filters that keep the image's own data type, in constant time per pixel for rectangles.
+
+``filters.rank`` only works on 8- and 16-bit integer images: chapter 06 hands it float
+images, which it silently converts to uint8 (losing all but 256 grey levels), and it
+slides a histogram over the image, so the cost per pixel grows with the footprint.
+The minimum, maximum and mean over a rectangle do not need a histogram: a rectangle
+is a line along each axis in turn, and along a line
+
+* the minimum and maximum come from the van Herk / Gil-Werman algorithm - cut the
+  line into blocks as long as the window, take running minima forwards and
+  backwards within each block, and every window is the minimum of one backward
+  and one forward value (three comparisons per pixel, whatever the window size);
+* the sum is a difference of two running sums.
+
+The functions here take ``uint8``, ``uint16`` and float images as they are, with the
+footprints of ``filters.rank`` (centred on index ``n // 2`` along each axis) and
+its border rule: only the pixels inside the image count. :func:`minimum` and
+:func:`maximum` return the input's dtype; :func:`mean` returns floats (``float32``,
+or ``float64`` for ``float64`` images). Footprints that are not rectangles, e.g.
+``morphology.disk(7)``, fall back to the general ``scipy.ndimage`` filters, with the
+same results and dtypes - except the mean, which is a convolution and goes through
+:mod:`.convolution` (by FFT for large footprints).
+
+The median, any other percentile and the entropy do need the histogram of every
+neighbourhood. :func:`median`, :func:`percentile` and :func:`entropy` slide one along
+each row (Huang's algorithm: moving one pixel to the right, only the pixels at the
+edges of the footprint go in or out), for all the rows of a strip of the image at
+once. Looking a rank up in a histogram of ``bins`` levels costs ``bins`` per pixel,
+too much for the 65536 levels of a 16-bit image, so the histograms have two levels:
+coarse bins of about ``sqrt(bins)`` levels each, in which the rank is found first,
+then only the fine bins of that coarse bin - about ``2 * sqrt(bins)`` per pixel. Any
+image type works: the grey levels between the image minimum and maximum are
+divided into ``bins`` bins, by default one per integer level (exact results, the
+same as ``filters.rank`` for uint8 / uint16 images) or ``FLOAT_BINS`` for float
+images. Fewer bins trade accuracy - results are then bin centres - for speed. The
+exact filters of uint8 images are left to ``filters.rank``, which is compiled and
+faster for 256 levels; for 16-bit images these are several times faster than it.
+"""
+
+import math
+
+import numpy as np
+from scipy import ndimage
+from skimage import filters
+
+from . import convolution
+
+
+def _rectangle(footprint, ndim):
+    # The footprint as an array, and whether it is a full rectangle
+    footprint = np.asarray(footprint, dtype=bool)
+    if footprint.ndim != ndim:
+        raise ValueError(f'The footprint has {footprint.ndim} dimensions, the image {ndim}')
+    if not footprint.any():
+        raise ValueError('The footprint is empty')
+    return footprint, bool(footprint.all())
+
+
+def _extreme(dtype, largest):
+    if np.issubdtype(dtype, np.floating):
+        return np.inf if largest else -np.inf
+    info = np.iinfo(dtype)
+    return info.max if largest else info.min
+
+
+def _along(axis, ndim, index):
+    # Index ``index`` along ``axis`` of an ndim-dimensional array
+    return (slice(None),) * axis + (index,) + (slice(None),) * (ndim - axis - 1)
+
+
+def _line_extreme(image, axis, size, ufunc, fill):
+    # van Herk / Gil-Werman along ``axis``: result[i] = ufunc over image[i - c .. i - c + size - 1],
+    # with c = size // 2 and ``fill`` outside the image
+    if size == 1:
+        return image
+    n, c, ndim = image.shape[axis], size // 2, image.ndim
+    # Pad to whole blocks, with room for the windows hanging over both ends
+    n_blocks = -(-(n + size - 1) // size)
+    shape = list(image.shape)
+    shape[axis] = n_blocks * size
+    padded = np.full(shape, fill, dtype=image.dtype)
+    padded[_along(axis, ndim, slice(c, c + n))] = image
+    blocks = padded.reshape(shape[:axis] + [n_blocks, size] + shape[axis + 1:])
+    # Running extremes within each block, one position of every block at a time
+    forward, backward = blocks.copy(), blocks
+    for k in range(1, size):
+        step, back = _along(axis + 1, ndim + 1, k), _along(axis + 1, ndim + 1, size - 1 - k)
+        ufunc(forward[_along(axis + 1, ndim + 1, k - 1)], forward[step], out=forward[step])
+        ufunc(backward[_along(axis + 1, ndim + 1, size - k)], backward[back], out=backward[back])
+    forward, backward = forward.reshape(shape), backward.reshape(shape)
+    # Window i of the padded line starts in one block and ends in the same or the next one
+    return ufunc(backward[_along(axis, ndim, slice(0, n))],
+                 forward[_along(axis, ndim, slice(size - 1, size - 1 + n))])
+
+
+def _line_sum(image, axis, size):
+    # Sum over image[i - c .. i - c + size - 1] along ``axis``, pixels outside the image counting 0
+    if size == 1:
+        return image
+    n, c, ndim = image.shape[axis], size // 2, image.ndim
+    shape = list(image.shape)
+    shape[axis] = n + size
+    cumulative = np.zeros(shape, dtype=image.dtype)
+    np.cumsum(image, axis=axis, out=cumulative[_along(axis, ndim, slice(c + 1, c + 1 + n))])
+    cumulative[_along(axis, ndim, slice(c + 1 + n, None))] = cumulative[_along(axis, ndim, slice(c + n, c + n + 1))]
+    return cumulative[_along(axis, ndim, slice(size, None))] - cumulative[_along(axis, ndim, slice(0, n))]
+
+
+def _filter_extreme(image, footprint, out, largest):
+    image = np.asarray(image)
+    footprint, rectangle = _rectangle(footprint, image.ndim)
+    if not rectangle:
+        # Outside pixels never win, exactly like the pixels ignored by filters.rank
+        func = ndimage.maximum_filter if largest else ndimage.minimum_filter
+        return func(image, footprint=footprint, output=out, mode='constant',
+                    cval=_extreme(image.dtype, not largest))
+    ufunc = np.maximum if largest else np.minimum
+    result = image
+    for axis, size in enumerate(footprint.shape):
+        result = _line_extreme(result, axis, size, ufunc, _extreme(image.dtype, not largest))
+    if out is None:
+        return result.copy() if result is image else result
+    out[...] = result
+    return out
+
+
+def minimum(image, footprint, out=None):
+    """Minimum of ``image`` over ``footprint`` around every pixel, in the image's dtype.
+
+    Same values as ``filters.rank.minimum`` for uint8 / uint16 images, in constant time
+    per pixel for a rectangle (``morphology.square(n)``, ``np.ones((h, w))``) of any size.
+    """
+    return _filter_extreme(image, footprint, out, largest=False)
+
+
+def maximum(image, footprint, out=None):
+    """Maximum of ``image`` over ``footprint`` around every pixel, in the image's dtype.
+
+    Same values as ``filters.rank.maximum`` for uint8 / uint16 images, in constant time
+    per pixel for a rectangle of any size.
+    """
+    return _filter_extreme(image, footprint, out, largest=True)
+
+
+def mean(image, footprint, out=None):
+    """Mean of ``image`` over ``footprint`` around every pixel, as floats.
+
+    Only the pixels inside the image are averaged, as in ``filters.rank.mean``, but
+    nothing is rounded: the result is ``float32`` (``float64`` for a ``float64``
+    image) and keeps the image's scale, e.g. 0 - 1 for a float image, 0 - 65535 for
+    uint16. Constant time per pixel for a rectangle of any size.
+    """
+    image = np.asarray(image)
+    footprint, rectangle = _rectangle(footprint, image.ndim)
+    dtype = np.float64 if image.dtype == np.float64 else np.float32
+    # Integers are summed exactly (in 32 bits when they cannot overflow), floats in double precision
+    if np.issubdtype(image.dtype, np.integer):
+        largest = max(abs(int(np.iinfo(image.dtype).min)), int(np.iinfo(image.dtype).max))
+        total = image.astype(np.int32 if largest * footprint.sum() < 2 ** 31 else np.int64)
+    else:
+        total = image.astype(np.float64)
+    if rectangle:
+        count = np.ones((), dtype=np.int64)
+        for axis, size in enumerate(footprint.shape):
+            total = _line_sum(total, axis, size)
+            # Number of pixels of the window inside the image, along this axis
+            ones = np.ones(image.shape[axis], dtype=np.int64)
+            count = np.multiply.outer(count, _line_sum(ones, 0, size))
+    else:
+        # A sum over the footprint is a correlation; by FFT the counts are only nearly whole
+        weights = footprint.astype(np.float64)
+        total = convolution.correlate(total, weights, mode='constant')
+        count = np.rint(convolution.correlate(np.ones(image.shape), weights, mode='constant'))
+    result = np.divide(total, count, dtype=dtype)
+    if out is None:
+        return result
+    out[...] = result
+    return out
+
+
+# Default number of bins of float images for the histogram filters
+FLOAT_BINS = 4096
+
+# The fine histograms of a strip of rows are kept under this many bytes
+_STRIP_BYTES = 2 ** 26
+
+
+def _quantise(image, bins):
+    # Bin of every pixel, the value each bin stands for (in the image's dtype) and the number of bins
+    low, high = image.min(), image.max()
+    if np.issubdtype(image.dtype, np.integer):
+        levels = int(high) - int(low) + 1
+        bins = min(levels, 2 ** 16) if bins is None else min(int(bins), levels)
+        offsets = image.astype(np.int64) - int(low)
+        if bins == levels:
+            return offsets.astype(np.int32), np.arange(int(low), int(high) + 1).astype(image.dtype), bins
+        # Middle of the integer levels falling into each bin
+        first = -(-np.arange(bins) * levels // bins)
+        last = -(-np.arange(1, bins + 1) * levels // bins) - 1
+        index = (offsets * bins // levels).astype(np.int32)
+        return index, (int(low) + (first + last) // 2).astype(image.dtype), bins
+    if np.isnan(low):
+        raise ValueError('The image contains NaNs, which have no rank')
+    if high == low:
+        # A single level: every pixel is in the one bin, which stands for that level exactly
+        return np.zeros(image.shape, dtype=np.int32), np.array([low], dtype=image.dtype), 1
+    bins = FLOAT_BINS if bins is None else int(bins)
+    width = (float(high) - float(low)) / bins
+    index = np.minimum(((image - low) / width).astype(np.int32), bins - 1)
+    return index, (float(low) + (np.arange(bins) + 0.5) * width).astype(image.dtype), bins
+
+
+def _edges(footprint):
+    # Offsets (row, column) of the footprint pixels that leave the window, and of
+    # those that enter it, when the footprint moves one pixel to the right
+    inside = np.pad(footprint, ((0, 0), (1, 1)))
+    leaving = np.argwhere(inside[:, 1:-1] & ~inside[:, :-2])
+    entering = np.argwhere(inside[:, 1:-1] & ~inside[:, 2:])
+    return leaving, entering
+
+
+class _SlidingHistograms:
+    # Two-level histograms of the windows of a strip of rows, all at the same column.
+    # The last fine and coarse bins count the pixels outside the image, left out of ``n``.
+
+    def __init__(self, n_rows, coarse_bins, fine, max_count, track_entropy):
+        self.coarse_bins, self.fine = coarse_bins, fine
+        self.outside = coarse_bins * fine
+        self.rows = np.arange(n_rows)
+        self.fine_counts = np.zeros((n_rows, self.outside + 1), dtype=np.int32)
+        self.coarse_counts = np.zeros((n_rows, coarse_bins + 1), dtype=np.int32)
+        self.n = np.zeros(n_rows, dtype=np.int64)
+        # Sum of c * log2(c) over the fine bins of each window
+        self.entropy_sum = np.zeros(n_rows) if track_entropy else None
+        counts = np.arange(max_count + 1, dtype=np.float64)
+        self._xlogx = counts * np.log2(np.maximum(counts, 1))
+
+    def update(self, index, coarse, signs):
+        # Add (sign 1) or remove (sign -1) the pixels ``index`` (one row of them per
+        # footprint offset, one column per row of the strip)
+        rows = np.broadcast_to(self.rows, index.shape)
+        signs = np.broadcast_to(signs[:, None], index.shape)
+        fine_bins = (rows * self.fine_counts.shape[1] + index).ravel()
+        flat = self.fine_counts.reshape(-1)
+        if self.entropy_sum is not None:
+            changed = np.unique(fine_bins)
+            before = self._xlogx[flat[changed]]
+        np.add.at(flat, fine_bins, signs.ravel())
+        np.add.at(self.coarse_counts.reshape(-1), (rows * self.coarse_counts.shape[1] + coarse).ravel(), signs.ravel())
+        self.n += (signs * (index != self.outside)).sum(axis=0)
+        if self.entropy_sum is not None:
+            inside = changed % self.fine_counts.shape[1] != self.outside
+            delta = (self._xlogx[flat[changed]] - before) * inside
+            np.add.at(self.entropy_sum, changed // self.fine_counts.shape[1], delta)
+
+    def rank(self, ranks):
+        # Bin holding the pixel of rank ``ranks`` (0 = smallest) of each window: the
+        # coarse bin first, then the fine bin among the fine bins of that coarse bin only
+        target = ranks[:, None]
+        cumulative = np.cumsum(self.coarse_counts[:, :-1], axis=1)
+        coarse = np.minimum((cumulative <= target).sum(axis=1), self.coarse_bins - 1)
+        below = cumulative[self.rows, coarse] - self.coarse_counts[self.rows, coarse]
+        start = coarse * self.fine
+        fine = self.fine_counts[self.rows[:, None], start[:, None] + np.arange(self.fine)]
+        cumulative = below[:, None] + np.cumsum(fine, axis=1)
+        return start + (cumulative <= target).sum(axis=1)
+
+    def entropy(self):
+        n = np.maximum(self.n, 1)
+        return np.log2(n) - self.entropy_sum / n
+
+
+def _sliding(image, footprint, bins, statistic, p=0.5):
+    # Huang's sliding histogram along the rows, for a strip of rows at a time
+    image = np.asarray(image)
+    if image.ndim != 2:
+        raise ValueError(f'Histogram rank filters work on 2D images, got shape {image.shape}')
+    footprint, _ = _rectangle(footprint, 2)
+    if image.dtype == np.uint8 and bins is None:
+        # Exact results are what filters.rank computes, and it is compiled: use it
+        if statistic == 'entropy':
+            return filters.rank.entropy(image, footprint)
+        return filters.rank.percentile(image, footprint, p0=p)
+    index, centres, bins = _quantise(image, bins)
+    fine = 2 ** math.ceil(math.log2(bins) / 2)
+    coarse_bins = -(-bins // fine)
+    outside = coarse_bins * fine
+    (h, w), (cy, cx) = footprint.shape, (footprint.shape[0] // 2, footprint.shape[1] // 2)
+    padded = np.pad(index, ((cy, h - 1 - cy), (cx, w - 1 - cx)), constant_values=outside)
+    coarse_padded = np.where(padded == outside, coarse_bins, padded // fine)
+    # Every footprint pixel at the start of a row, then the pixels leaving (-1) and entering (+1)
+    offsets = np.argwhere(footprint)
+    leaving, entering = _edges(footprint)
+    moving = np.concatenate([leaving - (0, 1), entering])
+    signs = np.repeat([-1, 1], [len(leaving), len(entering)]).astype(np.int32)
+    n_rows, n_cols = image.shape
+    strip = max(1, _STRIP_BYTES // (4 * (outside + 1)))
+    result = np.empty(image.shape, dtype=np.float64 if statistic == 'entropy' else np.int64)
+    for top in range(0, n_rows, strip):
+        rows = min(strip, n_rows - top)
+        histograms = _SlidingHistograms(rows, coarse_bins, fine, len(offsets), statistic == 'entropy')
+        row_index = top + np.arange(rows)
+
+        def update(pixels, x, pixel_signs):
+            y, column = row_index + pixels[:, :1], x + pixels[:, 1:]
+            histograms.update(padded[y, column], coarse_padded[y, column], pixel_signs)
+
+        update(offsets, 0, np.ones(len(offsets), dtype=np.int32))
+        for x in range(n_cols):
+            if x:
+                update(moving, x, signs)
+            if statistic == 'entropy':
+                result[top:top + rows, x] = histograms.entropy()
+            else:
+                ranks = np.minimum(np.floor(p * histograms.n).astype(np.int64), histograms.n - 1)
+                result[top:top + rows, x] = histograms.rank(ranks)
+    if statistic == 'entropy':
+        return result
+    return centres[np.minimum(result, bins - 1)]
+
+
+def percentile(image, footprint, p, bins=None):
+    """Percentile ``p`` (between 0 and 1) of ``image`` over ``footprint`` around every pixel.
+
+    The smallest grey level with more than ``p`` times the number of pixels of the
+    neighbourhood at or below it, as in ``filters.rank.percentile(..., p0=p)``; only
+    pixels inside the image count. Works on 2D images of any dtype and returns that
+    dtype; see the module docstring for ``bins``.
+    """
+    if not 0 <= p <= 1:
+        raise ValueError(f'p must be between 0 and 1, got {p}')
+    return _sliding(image, footprint, bins, 'percentile', p)
+
+
+def median(image, footprint, bins=None):
+    """Median of ``image`` over ``footprint`` around every pixel, like ``filters.rank.median``.
+
+    For an even number of pixels this is the upper of the two middle values. Works on
+    2D images of any dtype and returns that dtype; see the module docstring for ``bins``.
+    """
+    return _sliding(image, footprint, bins, 'percentile', 0.5)
+
+
+def entropy(image, footprint, bins=None):
+    """Shannon entropy (in bits) of the grey levels under ``footprint`` around every pixel.
+
+    The same as ``filters.rank.entropy`` for uint8 / uint16 images with the default
+    ``bins``; with fewer bins, the entropy of the binned grey levels. Returns float64.
+    """
+    return _sliding(image, footprint, bins, 'entropy')
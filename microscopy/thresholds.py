@@ -0,0 +1,221 @@
+"""Global thresholds of an image, all derived from a single histogram.
+
+Each ``filters.threshold_*`` function builds its own histogram of the image, and
+chapter 09 calls each of them three times on the same image (to print the value,
+to make the mask and to draw the line on the histogram). A :class:`ThresholdEngine`
+computes the histogram once - native integer bins for integer images, ``nbins``
+equal bins between the minimum and the maximum otherwise, exactly like
+``skimage.exposure.histogram`` - and derives every method from it, remembering each
+result. :func:`for_image` memoises the engine on the image itself, so asking for
+the same threshold again anywhere in a script costs nothing.
+
+Every method gives the same value as its ``filters`` counterpart. For float images
+two of them still look at the pixels: the mean, and Li's method, whose iteration
+can converge to a different fixed point on binned data. Both are computed once and
+memoised like the others. A constant image, such as a blank field, has the same
+threshold for every method but the minimum: its only grey level, which is what
+``threshold_otsu`` and ``threshold_triangle`` return for it (``threshold_yen`` and
+``threshold_isodata`` return a bin edge or fail on constant float images).
+"""
+
+import math
+
+import numpy as np
+from skimage import exposure, filters
+
+from . import plotting
+from ._cache import ImageKeyedCache
+from .plotting import plt
+
+
+METHODS = ('isodata', 'li', 'mean', 'minimum', 'otsu', 'triangle', 'yen')
+
+_engines = ImageKeyedCache()
+
+
+def _triangle(counts, bin_centers):
+    # Same algorithm as filters.threshold_triangle, on a precomputed histogram
+    nbins = len(counts)
+    arg_peak_height = np.argmax(counts)
+    peak_height = counts[arg_peak_height]
+    arg_low_level, arg_high_level = np.flatnonzero(counts)[[0, -1]]
+    if arg_low_level == arg_high_level:
+        return bin_centers[arg_low_level]
+
+    # Work on the longer tail of the histogram
+    flip = arg_peak_height - arg_low_level < arg_high_level - arg_peak_height
+    if flip:
+        counts = counts[::-1]
+        arg_low_level = nbins - arg_high_level - 1
+        arg_peak_height = nbins - arg_peak_height - 1
+
+    width = arg_peak_height - arg_low_level
+    x1 = np.arange(width)
+    y1 = counts[x1 + arg_low_level]
+    norm = np.sqrt(peak_height ** 2 + width ** 2)
+    length = (peak_height / norm) * x1 - (width / norm) * y1
+    arg_level = np.argmax(length) + arg_low_level
+    if flip:
+        arg_level = nbins - arg_level - 1
+    return bin_centers[arg_level]
+
+
+def _li(counts, bin_centers, tolerance):
+    # Li's minimum cross-entropy iteration, run on the histogram like
+    # filters.threshold_li does for integer images
+    counts = counts.astype(np.float64)
+    offset = bin_centers[0]
+    centers = bin_centers - offset
+    t_next = np.average(centers, weights=counts)
+    t_curr = -2 * tolerance
+    while abs(t_next - t_curr) > tolerance:
+        t_curr = t_next
+        foreground = centers > t_curr
+        mean_fore = np.average(centers[foreground], weights=counts[foreground])
+        mean_back = np.average(centers[~foreground], weights=counts[~foreground])
+        if mean_back == 0:
+            break
+        t_next = (mean_back - mean_fore) / (np.log(mean_back) - np.log(mean_fore))
+    return t_next + offset
+
+
+class ThresholdEngine:
+    """All the global thresholds of one image, computed from one histogram.
+
+    Parameters
+    ----------
+    image : ndarray
+        Grayscale image. It must not be modified while the engine is in use.
+    nbins : int
+        Number of bins for float images; integer images always get one bin per value.
+    """
+
+    def __init__(self, image, nbins=256):
+        self.image = image
+        self.nbins = nbins
+        self.counts, self.bin_centers = exposure.histogram(image.reshape(-1), nbins, source_range='image')
+        self._thresholds = {}
+
+    @property
+    def hist(self):
+        """``(counts, bin_centers)``, in the form the ``filters.threshold_*`` functions accept as ``hist=``."""
+        return self.counts, self.bin_centers
+
+    def _single_level(self):
+        # The grey level of a constant image, None otherwise; float bins span the minimum to
+        # the maximum, so a single occupied bin out of several means a single level
+        occupied = np.flatnonzero(self.counts)
+        if len(occupied) != 1:
+            return None
+        if np.issubdtype(self.image.dtype, np.integer):
+            return self.bin_centers[occupied[0]]
+        low = self.image.min()
+        return low if low == self.image.max() else None
+
+    def _compute(self, method):
+        if method in ('isodata', 'otsu', 'triangle', 'yen'):
+            level = self._single_level()
+            if level is not None:
+                return level
+        if method == 'otsu':
+            return filters.threshold_otsu(hist=self.hist)
+        if method == 'yen':
+            return filters.threshold_yen(hist=self.hist)
+        if method == 'isodata':
+            return filters.threshold_isodata(hist=self.hist)
+        if method == 'minimum':
+            return filters.threshold_minimum(hist=self.hist)
+        if method == 'triangle':
+            return _triangle(self.counts, self.bin_centers)
+        if method == 'mean':
+            if np.issubdtype(self.image.dtype, np.integer):
+                return np.average(self.bin_centers, weights=self.counts)
+            return np.mean(self.image)
+        if method == 'li':
+            if not np.issubdtype(self.image.dtype, np.integer):
+                # Li's iteration has several fixed points, and on binned float data it can
+                # settle on a different one, so float images are iterated on their pixels
+                return filters.threshold_li(self.image)
+            if len(self.bin_centers) == 1:
+                return self.bin_centers[0]
+            return _li(self.counts, self.bin_centers, tolerance=0.5)
+        raise ValueError(f'Unknown threshold method {method!r}, expected one of {METHODS}')
+
+    def threshold(self, method):
+        """Threshold value of ``method`` (one of ``METHODS``), computed once and then remembered."""
+        if method not in self._thresholds:
+            self._thresholds[method] = self._compute(method)
+        return self._thresholds[method]
+
+    def thresholds(self, methods=METHODS):
+        """Dict of method name to threshold value.
+
+        Methods that cannot handle this histogram (``minimum`` needs two peaks)
+        get ``nan`` instead of raising.
+        """
+        result = {}
+        for method in methods:
+            if method not in METHODS:
+                raise ValueError(f'Unknown threshold method {method!r}, expected one of {METHODS}')
+            try:
+                result[method] = self.threshold(method)
+            except (RuntimeError, ValueError):
+                result[method] = math.nan
+        return result
+
+    def mask(self, method):
+        """Boolean mask ``image > threshold`` for ``method``."""
+        return self.image > self.threshold(method)
+
+    def masks(self, methods=METHODS):
+        """Dict of method name to mask, skipping the methods that failed."""
+        return {
+            method: self.image > value
+            for method, value in self.thresholds(methods).items()
+            if not math.isnan(value)
+        }
+
+
+def for_image(image, nbins=256):
+    """Return the (memoised) :class:`ThresholdEngine` of ``image``."""
+    return _engines.get(image, ('thresholds', nbins), lambda: ThresholdEngine(image, nbins))
+
+
+def global_thresholds(image, methods=METHODS, masks=False, nbins=256):
+    """Thresholds of ``image`` for several methods at once.
+
+    Returns a dict of method name to value, or ``(thresholds, masks)`` with
+    ``masks=True``. Results are memoised on the image, so repeated queries are free.
+    """
+    engine = for_image(image, nbins)
+    if masks:
+        return engine.thresholds(methods), engine.masks(methods)
+    return engine.thresholds(methods)
+
+
+def try_all_threshold(image, figsize=(8, 5), verbose=True):
+    """Same figure as ``filters.try_all_threshold``, drawn from the memoised thresholds.
+
+    Returns the matplotlib ``(fig, ax)``, or ``(None, None)`` when plotting is off
+    (see :mod:`microscopy.plotting`), in which case only the thresholds are computed.
+    """
+    engine = for_image(image)
+    if not plotting.enabled():
+        engine.thresholds()
+        return None, None
+    fig, ax = plt.subplots(math.ceil((len(METHODS) + 1) / 2), 2, figsize=figsize, sharex=True, sharey=True)
+    ax = ax.reshape(-1)
+    ax[0].imshow(image, cmap=plt.cm.gray)
+    ax[0].set_title('Original')
+    for i, method in enumerate(METHODS, start=1):
+        ax[i].set_title(method.capitalize())
+        try:
+            ax[i].imshow(engine.mask(method), cmap=plt.cm.gray)
+        except Exception as e:
+            ax[i].text(0.5, 0.5, type(e).__name__, ha='center', va='center', transform=ax[i].transAxes)
+        if verbose:
+            print(f'skimage.filters.thresholding.threshold_{method}')
+    for a in ax:
+        a.axis('off')
+    fig.tight_layout()
+    return fig, ax
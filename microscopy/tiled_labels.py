@@ -0,0 +1,196 @@
+"""Connected-component labelling of masks too large for memory, one tile at a time.
+
+Chapter 11 labels the nuclei with ``measure.label``, which needs the whole mask in
+memory and returns an int64 label image: 8 bytes per pixel, 12.8 GB for a 40k x 40k
+slide, although a few thousand nuclei would fit in 16 bits. :func:`label` reads the
+mask (an array or a memory map) a tile at a time and never holds more than a tile of
+labels, plus the planes on either side of every tile border:
+
+* every tile is labelled on its own with ``ndimage.label``;
+* the labels that touch across a tile border - face, edge or corner, depending on the
+  connectivity - are merged with a union-find, as :mod:`.volumes` does between
+  chunks of planes, and numbered in raster order of their first pixel like
+  ``measure.label`` does;
+* the tiles are labelled again and their final labels written into the output, in
+  the smallest unsigned dtype that holds them, either an array or a ``.npy`` memory
+  map on disk.
+
+The pixel count and the bounding box of every object come out of the first pass for
+free, so there is no need to read the labels again to measure them::
+
+    labeled, areas, bboxes = tiled_labels.label(slide_mask, tile_shape = 4096, out = 'labels.npy')
+
+The result is identical to ``measure.label(mask, connectivity=connectivity)``, but
+for its dtype.
+"""
+
+import os
+
+import numpy as np
+from scipy import ndimage, sparse
+from scipy.sparse import csgraph
+
+
+def _touching_pairs(upper, lower, structure, axis=0):
+    # Label pairs (a, b), a in plane ``upper`` and b in the next plane ``lower`` along ``axis``,
+    # that are connected according to the +1 face of ``structure`` along that axis
+    pairs = [np.empty((0, 2), dtype=upper.dtype)]
+    face = np.take(structure, 2, axis=axis)
+    if face.ndim == 0:
+        # A 1D mask: the planes are single pixels, which touch if the structure connects neighbours
+        face = np.array([False, bool(face), False])
+        upper, lower = upper.reshape(1), lower.reshape(1)
+    for offset in zip(*np.nonzero(face)):
+        a = upper[tuple(slice(max(1 - d, 0), n - max(d - 1, 0)) for d, n in zip(offset, upper.shape))]
+        b = lower[tuple(slice(max(d - 1, 0), n - max(1 - d, 0)) for d, n in zip(offset, lower.shape))]
+        both = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[both], b[both]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def _merge_labels(n_labels, pairs):
+    # Union-find over the touching pairs: lookup table from chunk labels to final labels,
+    # numbered in order of their smallest chunk label
+    lut = np.zeros(n_labels + 1, dtype=np.int64)
+    if not n_labels:
+        return lut
+    graph = sparse.coo_matrix((np.ones(len(pairs)), (pairs[:, 0] - 1, pairs[:, 1] - 1)),
+                              shape=(n_labels, n_labels))
+    # connected_components numbers the components in order of their smallest node
+    _, component = csgraph.connected_components(graph, directed=False)
+    lut[1:] = component + 1
+    return lut
+
+
+def _tiles(shape, tile_shape):
+    # Slices of all tiles, in C order
+    starts = [range(0, n, t) for n, t in zip(shape, tile_shape)]
+    for corner in np.ndindex(*(len(s) for s in starts)):
+        yield tuple(slice(s[i], min(s[i] + t, n)) for s, i, t, n in zip(starts, corner, tile_shape, shape))
+
+
+def _first_pixels(labels):
+    # Flat index in the tile of the first pixel of each of the labels 1..n; ndimage.label numbers
+    # the labels in order of their first pixel, so label k first appears where the running maximum reaches k
+    flat = labels.ravel()
+    where = np.flatnonzero(flat)
+    running = np.maximum.accumulate(flat[where])
+    new = np.ones(len(where), dtype=bool)
+    new[1:] = running[1:] > running[:-1]
+    return where[new]
+
+
+def label(mask, connectivity=None, tile_shape=1024, out=None, dtype=None):
+    """Label the connected components of ``mask`` a tile at a time.
+
+    Parameters
+    ----------
+    mask : ndarray
+        Binary image of any number of dimensions; a memory map is read one tile at a time.
+    connectivity : int, optional
+        Largest number of orthogonal steps between neighbours, as in ``measure.label``:
+        by default ``mask.ndim`` (8-connectivity in 2D).
+    tile_shape : int or sequence of int
+        Size of the tiles.
+    out : ndarray, str or os.PathLike, optional
+        Array to write the labels into, or the path of a ``.npy`` file to create as a
+        memory map.
+    dtype : dtype, optional
+        Dtype of the label image created when ``out`` is not an array; by default the
+        smallest unsigned integer type holding the number of objects. A ``ValueError``
+        is raised, before anything is written, if the objects do not fit in it (or in
+        the dtype of ``out``).
+
+    Returns
+    -------
+    labels : ndarray
+        Labels 1..N in raster order, 0 for the background.
+    counts : ndarray of int64
+        Number of pixels of each object, ``counts[k - 1]`` for label ``k``.
+    bboxes : ndarray of int64
+        Bounding box of each object as in ``regionprops``: the first pixel along each
+        axis, then the pixel past the last one, ``(min_row, min_col, max_row, max_col)``
+        in 2D.
+    """
+    shape = mask.shape
+    ndim = len(shape)
+    if connectivity is None:
+        connectivity = ndim
+    structure = ndimage.generate_binary_structure(ndim, connectivity)
+    tile_shape = tuple(int(t) for t in np.broadcast_to(tile_shape, (ndim,)))
+
+    # First pass: label every tile and keep what the merge needs - the planes on both sides of each
+    # tile border, and for every tile label its size, bounding box and first pixel
+    planes = {}
+    for axis, (n, t) in enumerate(zip(shape, tile_shape)):
+        for start in range(t, n, t):
+            for index in (start - 1, start):
+                planes[axis, index] = np.zeros(shape[:axis] + shape[axis + 1:], dtype=np.int64)
+    n_labels, counts, firsts, lows, highs = 0, [], [], [], []
+    for tile in _tiles(shape, tile_shape):
+        labels, n = ndimage.label(np.asarray(mask[tile]), structure=structure)
+        counts.append(np.bincount(labels.ravel(), minlength=n + 1)[1:])
+        starts = np.array([s.start for s in tile])
+        local = np.unravel_index(_first_pixels(labels), labels.shape)
+        firsts.append(np.ravel_multi_index(tuple(c + s for c, s in zip(local, starts)), shape))
+        boxes = ndimage.find_objects(labels)
+        lows.append(np.array([[s.start for s in box] for box in boxes], dtype=np.int64).reshape(n, ndim) + starts)
+        highs.append(np.array([[s.stop for s in box] for box in boxes], dtype=np.int64).reshape(n, ndim) + starts)
+        for axis, s in enumerate(tile):
+            rest = tile[:axis] + tile[axis + 1:]
+            for index, position in ((s.start, 0), (s.stop - 1, -1)):
+                if (axis, index) in planes:
+                    plane = np.take(labels, position, axis=axis)
+                    planes[axis, index][rest] = np.where(plane > 0, plane + np.int64(n_labels), 0)
+        n_labels += n
+
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    for axis, (n, t) in enumerate(zip(shape, tile_shape)):
+        for start in range(t, n, t):
+            pairs.append(_touching_pairs(planes[axis, start - 1], planes[axis, start], structure, axis))
+    del planes
+    lut = _merge_labels(n_labels, np.concatenate(pairs))
+
+    # Renumber the merged objects in raster order of their first pixel, like measure.label
+    n_objects = int(lut.max())
+    first = np.full(n_objects + 1, np.iinfo(np.int64).max, dtype=np.int64)
+    if n_labels:
+        np.minimum.at(first, lut[1:], np.concatenate(firsts))
+    order = np.zeros(n_objects + 1, dtype=np.int64)
+    order[np.argsort(first[1:], kind='stable') + 1] = np.arange(1, n_objects + 1)
+    lut = order[lut]
+
+    object_counts = np.zeros(n_objects, dtype=np.int64)
+    bboxes = np.empty((n_objects, 2 * ndim), dtype=np.int64)
+    bboxes[:, :ndim] = np.iinfo(np.int64).max
+    bboxes[:, ndim:] = -1
+    if n_labels:
+        objects = lut[1:] - 1
+        np.add.at(object_counts, objects, np.concatenate(counts))
+        np.minimum.at(bboxes[:, :ndim], objects, np.concatenate(lows))
+        np.maximum.at(bboxes[:, ndim:], objects, np.concatenate(highs))
+
+    if dtype is None:
+        dtype = np.min_scalar_type(n_objects)
+    dtype = out.dtype if isinstance(out, np.ndarray) else np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer) or n_objects > np.iinfo(dtype).max:
+        raise ValueError(f'{n_objects} objects do not fit in labels of dtype {dtype}')
+    if out is None:
+        result = np.empty(shape, dtype=dtype)
+    elif isinstance(out, np.ndarray):
+        result = out
+    else:
+        result = np.lib.format.open_memmap(os.fspath(out), mode='w+', dtype=dtype, shape=shape)
+    lut = lut.astype(result.dtype)
+
+    # Second pass: label the tiles again, the same way, and write their final labels
+    n_labels = 0
+    for tile in _tiles(shape, tile_shape):
+        labels, n = ndimage.label(np.asarray(mask[tile]), structure=structure)
+        tile_lut = lut[n_labels:n_labels + n + 1].copy()
+        tile_lut[0] = 0
+        result[tile] = tile_lut[labels]
+        n_labels += n
+    if isinstance(result, np.memmap):
+        result.flush()
+    return result, object_counts, bboxes
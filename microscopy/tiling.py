@@ -0,0 +1,196 @@
+"""Run a neighbourhood filter tile by tile, for images too large to filter in one go.
+
+Every filter in chapter 06 works on the whole image at once and allocates several
+full-size temporaries while doing so, which is fine for a 256 x 256 plane and hopeless
+for a 40k x 40k slide. :func:`apply_tiled` cuts the image into tiles, extends each tile
+by a *halo* of neighbouring pixels (as many as the filter can reach), filters the
+extended tile, keeps only its core and writes it into the output - a preallocated
+array or a ``.npy`` memory map on disk - so that only a few tiles are ever in memory.
+
+Tiles touching the image border are filtered with the image border, and interior
+tiles see every pixel the filter can reach, so the result is bit-identical to calling
+the filter on the whole image. That holds for *local* filters only: ``meijering`` and
+``frangi`` with ``gamma=None`` normalise by a maximum over the whole image, and
+``unsharp_mask`` picks its clipping range from the image minimum, so those need
+explicit parameters (or an image known to be non-negative for ``unsharp_mask``).
+
+The halo is derived from the filter's arguments for the common ``skimage`` filters
+(footprint size, ``sigma`` and ``truncate``, ...); pass ``halo=`` for anything else.
+"""
+
+import math
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+
+# Filters whose halo is the reach of their footprint, applied once or twice (opening = erosion + dilation)
+_FOOTPRINT_PASSES = {
+    'mean': 1, 'minimum': 1, 'maximum': 1, 'median': 1, 'sum': 1, 'gradient': 1,
+    'majority': 1, 'modal': 1, 'entropy': 1, 'enhance_contrast': 1, 'equalize': 1,
+    'autolevel': 1, 'percentile': 1, 'subtract_mean': 1, 'threshold': 1,
+    'erosion': 1, 'dilation': 1, 'binary_erosion': 1, 'binary_dilation': 1,
+    'opening': 2, 'closing': 2, 'binary_opening': 2, 'binary_closing': 2,
+    'white_tophat': 2, 'black_tophat': 2,
+}
+
+# Fixed-size stencils
+_STENCIL_REACH = {
+    'sobel': 1, 'sobel_h': 1, 'sobel_v': 1, 'scharr': 1, 'scharr_h': 1, 'scharr_v': 1,
+    'prewitt': 1, 'prewitt_h': 1, 'prewitt_v': 1, 'roberts': 1, 'roberts_pos_diag': 1,
+    'roberts_neg_diag': 1, 'farid': 2, 'farid_h': 2, 'farid_v': 2,
+}
+
+
+def _gaussian_reach(sigma, truncate=4.0):
+    # Radius of the kernel used by ndimage.gaussian_filter
+    return int(truncate * float(sigma) + 0.5)
+
+
+def _argument(args, kwargs, position, name, default=None):
+    if name in kwargs:
+        return kwargs[name]
+    return args[position] if len(args) > position else default
+
+
+def halo_for(func, args=(), kwargs=None, ndim=2):
+    """Number of pixels ``func(image, *args, **kwargs)`` can reach along each axis.
+
+    Knows the ``skimage`` rank, median, morphology, Gaussian, edge and ridge filters;
+    raises ``ValueError`` for anything else, in which case pass ``halo=`` to
+    :func:`apply_tiled` yourself.
+    """
+    kwargs = kwargs or {}
+    name = func.__name__
+    if name in _FOOTPRINT_PASSES:
+        footprint = _argument(args, kwargs, 0, 'footprint')
+        if footprint is None:
+            # Default footprint of the morphology functions is the cross of reach 1
+            return (_FOOTPRINT_PASSES[name],) * ndim
+        if isinstance(footprint, tuple):
+            # Decomposed footprint: sequence of (footprint, repetitions), the repetitions as uint8
+            reach = [sum(int(n) * (f.shape[axis] // 2) for f, n in footprint) for axis in range(ndim)]
+        else:
+            reach = [s // 2 for s in np.shape(footprint)]
+        return tuple(_FOOTPRINT_PASSES[name] * r for r in reach)
+    if name in _STENCIL_REACH:
+        return (_STENCIL_REACH[name],) * ndim
+    if name == 'laplace':
+        return (_argument(args, kwargs, 0, 'ksize', 3) // 2,) * ndim
+    if name == 'gaussian':
+        sigma = _argument(args, kwargs, 0, 'sigma', 1)
+        truncate = kwargs.get('truncate', 4.0)
+        return tuple(_gaussian_reach(s, truncate) for s in np.broadcast_to(sigma, (ndim,)))
+    if name == 'unsharp_mask':
+        radius = _argument(args, kwargs, 0, 'radius', 1.0)
+        return (_gaussian_reach(radius),) * ndim
+    if name == 'difference_of_gaussians':
+        low = _argument(args, kwargs, 0, 'low_sigma')
+        high = _argument(args, kwargs, 1, 'high_sigma')
+        sigma = np.max(high) if high is not None else 1.6 * np.max(low)
+        return (_gaussian_reach(sigma, kwargs.get('truncate', 4.0)),) * ndim
+    if name in ('sato', 'frangi', 'hessian'):
+        if name == 'frangi' and kwargs.get('gamma') is None:
+            raise ValueError('frangi with gamma=None depends on the whole image; pass an explicit gamma to tile it')
+        sigmas = _argument(args, kwargs, 0, 'sigmas', range(1, 10, 2))
+        # Two Gaussian derivative passes of sigma / sqrt(2), with skimage's enlarged truncate
+        reach = 0
+        for sigma in sigmas:
+            truncate = 8 if sigma > 1 else 100
+            reach = max(reach, 2 * _gaussian_reach(sigma / math.sqrt(2), truncate))
+        return (reach,) * ndim
+    raise ValueError(f'Cannot derive the halo of {name!r}; pass halo= explicitly')
+
+
+def _tiles(shape, tile_shape):
+    # Core slices of all tiles, in C order
+    starts = [range(0, n, t) for n, t in zip(shape, tile_shape)]
+    for corner in np.ndindex(*(len(s) for s in starts)):
+        yield tuple(
+            slice(starts[axis][i], min(starts[axis][i] + tile_shape[axis], shape[axis]))
+            for axis, i in enumerate(corner)
+        )
+
+
+def _filter_tile(func, block, inner, args, kwargs):
+    result = np.asarray(func(block, *args, **kwargs))
+    if result.shape != block.shape:
+        raise ValueError(f'{func.__name__} changed the shape of a tile from {block.shape} to {result.shape}')
+    return result[inner]
+
+
+def apply_tiled(func, image, *args, halo=None, tile_shape=1024, n_workers=None, out=None, **kwargs):
+    """Apply ``func(image, *args, **kwargs)`` tile by tile and stitch the result.
+
+    Parameters
+    ----------
+    func : callable
+        Shape-preserving filter, e.g. ``filters.gaussian`` or ``filters.rank.mean``.
+        With ``n_workers`` it must be picklable (any module-level function is).
+    image : ndarray
+        Image to filter; a memory map is read one tile at a time.
+    halo : int or sequence of int, optional
+        Pixels added around each tile along each axis. Derived with :func:`halo_for`
+        when not given.
+    tile_shape : int or sequence of int
+        Size of the tile cores. For a multichannel image give the full channel axis.
+    n_workers : int, optional
+        Filter the tiles in that many processes. When this is used from a script, put
+        the call under ``if __name__ == '__main__':`` so the workers can import it.
+    out : ndarray, str or os.PathLike, optional
+        Array to write the result into, or the path of a ``.npy`` file to create as a
+        memory map. By default a new array is allocated, with the dtype of the first
+        filtered tile.
+
+    Returns
+    -------
+    ndarray
+        ``out``, equal to ``func(image, *args, **kwargs)``.
+
+    Examples
+    --------
+    >>> blurred = apply_tiled(filters.gaussian, slide, sigma=2, tile_shape=2048, out='blurred.npy')
+    """
+    shape = image.shape
+    tile_shape = tuple(np.broadcast_to(tile_shape, (len(shape),)))
+    if halo is None:
+        halo = halo_for(func, args, kwargs, len(shape))
+    halo = tuple(np.broadcast_to(halo, (len(shape),)))
+
+    result = out if isinstance(out, np.ndarray) else None
+
+    def store(core, values):
+        nonlocal result
+        if result is None:
+            if out is None:
+                result = np.empty(shape, dtype=values.dtype)
+            else:
+                result = np.lib.format.open_memmap(os.fspath(out), mode='w+', dtype=values.dtype, shape=shape)
+        result[core] = values
+
+    def tasks():
+        for core in _tiles(shape, tile_shape):
+            block = tuple(slice(max(c.start - h, 0), min(c.stop + h, n)) for c, h, n in zip(core, halo, shape))
+            inner = tuple(slice(c.start - b.start, c.stop - b.start) for c, b in zip(core, block))
+            yield core, np.asarray(image[block]), inner
+
+    if n_workers is not None and n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            # Keep only a couple of tiles per worker in flight, so memory use does not grow with the image
+            pending = {}
+            for core, block, inner in tasks():
+                if len(pending) >= 2 * n_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        store(pending.pop(future), future.result())
+                pending[pool.submit(_filter_tile, func, block, inner, args, kwargs)] = core
+            for future in wait(pending).done:
+                store(pending[future], future.result())
+    else:
+        for core, block, inner in tasks():
+            store(core, _filter_tile(func, block, inner, args, kwargs))
+
+    if isinstance(result, np.memmap):
+        result.flush()
+    return result
@@ -0,0 +1,248 @@
+"""Sato, Frangi and Meijering ridge filters sharing one set of Hessian eigenvalues per sigma.
+
+Chapter 06 runs ``filters.sato``, ``filters.frangi`` and ``filters.meijering`` one
+after the other on the retina. All three smooth the image with Gaussian derivatives
+at every sigma, build the Hessian matrix of every pixel and compute its eigenvalues
+- ten 1D filter passes and an eigen decomposition per sigma in 2D - and only then
+differ, in a few array operations on the eigenvalues. With their default sigmas they
+compute 13 Hessians between them, for 7 different sigmas.
+
+A :class:`RidgeFilters` computes the eigenvalues once per sigma, exactly as
+``skimage.feature.hessian_matrix(..., use_gaussian_derivatives=True)`` and
+``hessian_matrix_eigvals`` do, keeps them in float32 (least recently used sigmas are
+dropped past a memory budget) and derives every filter from them::
+
+    ridges = vesselness.for_image(img_retina)
+    img_sato = ridges.sato()
+    img_frangi = ridges.frangi(sigmas = range(4, 7))
+    img_meijering = ridges.meijering()
+
+Dark and bright ridges share the eigenvalues too: negating the image negates the
+Hessian, which negates its eigenvalues and reverses their order. Sigmas that are not
+cached yet are computed in ``n_workers`` threads (``scipy.ndimage`` releases the GIL
+while it filters). Any other measure of the eigenvalues can be maximised over the
+sigmas with :meth:`RidgeFilters.ridge`. Results are float32: the same as the
+``skimage.filters`` functions give for a float32 image, and as close to their float64
+results as float32 allows (within about 1e-3 for Frangi, whose ratios of small
+eigenvalues amplify rounding).
+"""
+
+import itertools
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import linalg, ndimage
+
+from ._cache import ImageKeyedCache
+
+
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+# The default sigmas of the skimage ridge filters
+DEFAULT_SIGMAS = range(1, 10, 2)
+
+_filters = ImageKeyedCache()
+
+
+def hessian_eigenvalues(image, sigma, mode='reflect', cval=0):
+    """Eigenvalues of the Hessian of ``image`` at scale ``sigma``, in decreasing order (float32).
+
+    The same as ``hessian_matrix_eigvals(hessian_matrix(image, sigma, mode=mode,
+    cval=cval, use_gaussian_derivatives=True))``, with an array of shape
+    ``(image.ndim, *image.shape)``.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    ndim = image.ndim
+    # Two first derivatives of a Gaussian of sigma / sqrt(2) make a second derivative at sigma
+    # (with a long kernel for small sigmas, which are badly sampled), as skimage does
+    truncate = 8 if sigma > 1 else 100
+    scaled = sigma / math.sqrt(2)
+    orders = [[0] * d + [1] + [0] * (ndim - d - 1) for d in range(ndim)]
+
+    def derivative(array, axis):
+        return ndimage.gaussian_filter(array, scaled, order=orders[axis], mode=mode, cval=cval, truncate=truncate)
+
+    gradients = [derivative(image, axis) for axis in range(ndim)]
+    elements = [derivative(gradients[a], b) for a, b in itertools.combinations_with_replacement(range(ndim), 2)]
+    del gradients
+    if ndim == 2:
+        h00, h01, h11 = elements
+        eigenvalues = np.empty((2, *image.shape), dtype=np.float32)
+        np.add(h00, h11, out=eigenvalues[0])
+        eigenvalues[0] /= 2
+        eigenvalues[1] = eigenvalues[0]
+        half_root = np.sqrt(h01 ** 2 + ((h00 - h11) / 2) ** 2)
+        eigenvalues[0] += half_root
+        eigenvalues[1] -= half_root
+        return eigenvalues
+    matrices = np.empty((*image.shape, ndim, ndim), dtype=np.float32)
+    for element, (a, b) in zip(elements, itertools.combinations_with_replacement(range(ndim), 2)):
+        matrices[..., a, b] = element
+        matrices[..., b, a] = element
+    del elements
+    # eigvalsh sorts in increasing order
+    return np.moveaxis(np.linalg.eigvalsh(matrices)[..., ::-1], -1, 0).copy()
+
+
+def sato(eigenvalues, sigma):
+    """Sato tubeness at one sigma: ``sigma ** 2`` times the geometric mean of the clipped leading eigenvalues."""
+    leading = np.maximum(eigenvalues[:-1], 0)
+    return (sigma ** 2 * np.prod(leading, axis=0) ** (1 / len(leading))).astype(np.float32, copy=False)
+
+
+def meijering(eigenvalues, sigma, alpha=None):
+    """Meijering neuriteness at one sigma, normalised to a maximum of 1 (``sigma`` is unused)."""
+    ndim = len(eigenvalues)
+    if alpha is None:
+        alpha = 1 / (ndim + 1)
+    mixing = linalg.circulant([1, *[alpha] * (ndim - 1)]).astype(np.float32)
+    values = np.tensordot(mixing, eigenvalues, 1)
+    values = np.take_along_axis(values, abs(values).argmax(0)[None], 0)[0]
+    values = np.maximum(values, 0)
+    largest = values.max()
+    if largest > 0:
+        values /= largest
+    return values
+
+
+def _frangi(eigenvalues, alpha, beta, gamma):
+    # Frangi vesselness at one sigma; ``gamma`` must already be set
+    ndim = len(eigenvalues)
+    eigenvalues = np.take_along_axis(eigenvalues, abs(eigenvalues).argsort(0), 0)
+    lambda1 = eigenvalues[0]
+    if ndim == 2:
+        (lambda2,) = np.maximum(eigenvalues[1:], 1e-10)
+        r_a = np.inf
+        r_b = abs(lambda1) / lambda2
+    else:
+        lambda2, lambda3 = np.maximum(eigenvalues[1:], 1e-10)
+        r_a = lambda2 / lambda3
+        r_b = abs(lambda1) / np.sqrt(lambda2 * lambda3)
+    s = np.sqrt((eigenvalues ** 2).sum(0))
+    # The blobness factor underflows to 0 wherever a leading eigenvalue has the wrong sign
+    values = 1.0 - np.exp(-(r_a ** 2) / (2 * alpha ** 2), dtype=np.float32)
+    values *= np.exp(-(r_b ** 2) / (2 * beta ** 2), dtype=np.float32)
+    values *= 1.0 - np.exp(-(s ** 2) / (2 * gamma ** 2), dtype=np.float32)
+    return values
+
+
+def _structure(eigenvalues):
+    # Frangi's default gamma: half the largest Frobenius norm of the Hessian
+    gamma = np.sqrt((eigenvalues ** 2).sum(0)).max() / 2
+    return float(gamma) if gamma != 0 else 1.0
+
+
+class RidgeFilters:
+    """Hessian-based ridge filters of one image, sharing the eigenvalues at each sigma.
+
+    Parameters
+    ----------
+    image : ndarray
+        Grayscale 2D or 3D image. It is converted to float32 without rescaling, as
+        the ``skimage.filters`` ridge filters do.
+    mode, cval :
+        Boundary handling of the Gaussian derivatives (``'reflect'``, like skimage).
+    max_bytes : int
+        Memory budget for the cached eigenvalues.
+    n_workers : int, optional
+        Threads computing the eigenvalues of several sigmas at once; None or 1 computes
+        them one after the other.
+    """
+
+    def __init__(self, image, mode='reflect', cval=0, max_bytes=DEFAULT_MAX_BYTES, n_workers=None):
+        image = np.asarray(image)
+        if image.ndim not in (2, 3):
+            raise ValueError('ridge filters need a 2D or 3D image')
+        self.image = image.astype(np.float32)
+        self.image.flags.writeable = False
+        self.mode = mode
+        self.cval = cval
+        self.max_bytes = max_bytes
+        self.n_workers = n_workers
+        self._eigenvalues = OrderedDict()
+
+    @property
+    def nbytes(self):
+        return sum(e.nbytes for e in self._eigenvalues.values())
+
+    def _compute(self, sigma):
+        return hessian_eigenvalues(self.image, sigma, self.mode, self.cval)
+
+    def eigenvalues(self, sigmas, black_ridges=True):
+        """Hessian eigenvalues at each of ``sigmas`` (a list of arrays, decreasing order, read-only).
+
+        With ``black_ridges=False`` they are the eigenvalues for the negated image,
+        which is how the skimage filters look for bright ridges.
+        """
+        sigmas = [float(s) for s in sigmas]
+        missing = list(dict.fromkeys(s for s in sigmas if s not in self._eigenvalues))
+        if self.n_workers is not None and self.n_workers > 1 and len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+                computed = list(pool.map(self._compute, missing))
+        else:
+            computed = [self._compute(s) for s in missing]
+        found = {}
+        for sigma, values in zip(missing, computed):
+            values.flags.writeable = False
+            found[sigma] = values
+        for sigma in sigmas:
+            if sigma in self._eigenvalues:
+                self._eigenvalues.move_to_end(sigma)
+                found[sigma] = self._eigenvalues[sigma]
+            else:
+                self._eigenvalues[sigma] = found[sigma]
+        # The sigmas just asked for are the most recently used, so they are dropped last
+        while self.nbytes > self.max_bytes and len(self._eigenvalues) > 1:
+            self._eigenvalues.popitem(last=False)
+        if black_ridges:
+            return [found[s] for s in sigmas]
+        return [-found[s][::-1] for s in sigmas]
+
+    def ridge(self, measure, sigmas=DEFAULT_SIGMAS, black_ridges=True):
+        """Maximum over ``sigmas`` of ``measure(eigenvalues, sigma)``, never less than 0.
+
+        ``measure`` takes the eigenvalues at one sigma (as returned by
+        :meth:`eigenvalues`) and that sigma, and returns an image; :func:`sato` and
+        :func:`meijering` are such measures.
+        """
+        sigmas = list(sigmas)
+        result = np.zeros(self.image.shape, dtype=np.float32)
+        for sigma, values in zip(sigmas, self.eigenvalues(sigmas, black_ridges)):
+            np.maximum(result, measure(values, sigma), out=result)
+        return result
+
+    def sato(self, sigmas=DEFAULT_SIGMAS, black_ridges=True):
+        """Like ``filters.sato(image, sigmas, black_ridges)``."""
+        return self.ridge(sato, sigmas, black_ridges)
+
+    def meijering(self, sigmas=DEFAULT_SIGMAS, alpha=None, black_ridges=True):
+        """Like ``filters.meijering(image, sigmas, alpha, black_ridges)``."""
+        return self.ridge(lambda values, sigma: meijering(values, sigma, alpha), sigmas, black_ridges)
+
+    def frangi(self, sigmas=DEFAULT_SIGMAS, alpha=0.5, beta=0.5, gamma=None, black_ridges=True):
+        """Like ``filters.frangi(image, sigmas, alpha=alpha, beta=beta, gamma=gamma, black_ridges=black_ridges)``.
+
+        As in skimage, the default ``gamma`` is half the largest Hessian norm at the
+        first sigma, and is kept for the others.
+        """
+        sigmas = list(sigmas)
+        result = np.zeros(self.image.shape, dtype=np.float32)
+        for values in self.eigenvalues(sigmas, black_ridges):
+            if gamma is None:
+                gamma = _structure(values)
+            np.maximum(result, _frangi(values, alpha, beta, gamma), out=result)
+        return result
+
+    def clear(self):
+        self._eigenvalues.clear()
+
+
+def for_image(image, **kwargs):
+    """Return the :class:`RidgeFilters` of ``image``, creating it on first use.
+
+    Like :func:`.scale_space.for_image`, it is cached on the identity of ``image``;
+    keyword arguments only apply when it is first created.
+    """
+    return _filters.get(image, 'ridges', lambda: RidgeFilters(image, **kwargs))